@@ -0,0 +1,300 @@
+#!/usr/bin/env python3
+"""
+Server-side analytics for CashFlow AI
+Keeps each account's stored transactions in columnar arrays and answers
+monthly, per-account, per-category, fee and rolling-window aggregates
+"""
+
+import array
+import logging
+import threading
+from collections import OrderedDict
+from datetime import date
+from typing import Dict, List, Optional
+
+try:
+    import numpy as np
+except ImportError:  # optional dependency, pure-Python loops without it
+    np = None
+
+logger = logging.getLogger(__name__)
+
+ENGINE = 'numpy' if np is not None else 'python'
+
+# Store columns a ledger is built from
+SOURCE_COLUMNS = ['amount', 'vat', 'service_fee', 'date', 'account_name', 'account_number', 'category']
+# Rows read from the store per query while catching up
+LOAD_BATCH = 5000
+
+METRICS = ('count', 'income', 'spending', 'vat', 'service_fee')
+_FLOAT_COLUMNS = ('amount', 'vat', 'service_fee')
+_INT_COLUMNS = ('day', 'month', 'account', 'category')
+_MAX_DAY = date.max.toordinal()
+
+
+class _Codes:
+    """Interns labels as small integer codes"""
+
+    def __init__(self):
+        self.labels = []
+        self._index = {}
+
+    def code(self, label) -> int:
+        index = self._index.get(label)
+        if index is None:
+            index = self._index[label] = len(self.labels)
+            self.labels.append(label)
+        return index
+
+
+class Ledger:
+    """One account's transactions as parallel columns, appended in store order.
+
+    ``day`` is the date ordinal, ``month`` is year * 12 + month - 1, and
+    ``account``/``category`` are codes into ``accounts``/``categories``.
+    ``cursor`` is the store cursor of the last row applied. With NumPy the
+    columns are arrays grown by doubling; without it they are array.array.
+    """
+
+    def __init__(self):
+        self.size = 0
+        self.cursor = 0
+        self.skipped = 0
+        self.accounts = _Codes()
+        self.categories = _Codes()
+        self.lock = threading.Lock()
+        if np is not None:
+            self._columns = {name: np.zeros(64, dtype=np.float64) for name in _FLOAT_COLUMNS}
+            self._columns.update({name: np.zeros(64, dtype=np.int32) for name in _INT_COLUMNS})
+        else:
+            self._columns = {name: array.array('d') for name in _FLOAT_COLUMNS}
+            self._columns.update({name: array.array('i') for name in _INT_COLUMNS})
+
+    def append(self, transactions: List[Dict]):
+        """Add store rows; rows without a valid date are counted in ``skipped``"""
+        rows = {name: [] for name in self._columns}
+        for tx in transactions:
+            try:
+                day = date.fromisoformat(str(tx.get('date') or '')[:10])
+            except ValueError:
+                self.skipped += 1
+                continue
+            rows['amount'].append(float(tx.get('amount') or 0.0))
+            rows['vat'].append(float(tx.get('vat') or 0.0))
+            rows['service_fee'].append(float(tx.get('service_fee') or 0.0))
+            rows['day'].append(day.toordinal())
+            rows['month'].append(day.year * 12 + day.month - 1)
+            rows['account'].append(self.accounts.code((tx.get('account_name') or '', tx.get('account_number') or '')))
+            rows['category'].append(self.categories.code(tx.get('category') or ''))
+        added = len(rows['day'])
+        if not added:
+            return
+        if np is not None:
+            self._reserve(added)
+            for name, values in rows.items():
+                self._columns[name][self.size:self.size + added] = values
+        else:
+            for name, values in rows.items():
+                self._columns[name].extend(values)
+        self.size += added
+
+    def column(self, name: str):
+        """The first ``size`` values of a column (a view with NumPy)"""
+        values = self._columns[name]
+        return values[:self.size] if np is not None else values
+
+    def _reserve(self, added: int):
+        capacity = len(self._columns['day'])
+        if self.size + added <= capacity:
+            return
+        capacity = max(capacity * 2, self.size + added)
+        for name, values in self._columns.items():
+            grown = np.zeros(capacity, dtype=values.dtype)
+            grown[:self.size] = values[:self.size]
+            self._columns[name] = grown
+
+
+def _aggregate_numpy(ledger: Ledger, lo: int, hi: int, first: int, ndays: int) -> Dict:
+    day = ledger.column('day')
+    mask = (day >= lo) & (day <= hi)
+    amount = ledger.column('amount')[mask]
+    day = day[mask]
+    spending = np.where(amount < 0, -amount, 0.0)
+    weights = {
+        'count': None,
+        'income': np.where(amount > 0, amount, 0.0),
+        'spending': spending,
+        'vat': ledger.column('vat')[mask],
+        'service_fee': ledger.column('service_fee')[mask],
+    }
+
+    def grouped(keys, size):
+        return {name: np.bincount(keys, weights=w, minlength=size).tolist() for name, w in weights.items()}
+
+    month = ledger.column('month')[mask]
+    first_month = int(month.min()) if len(month) else 0
+    in_series = (day >= first) & (day < first + ndays)
+    return {
+        'count': int(len(amount)),
+        'totals': {name: float(len(amount)) if w is None else float(w.sum()) for name, w in weights.items()},
+        'first_month': first_month,
+        'by_month': grouped(month - first_month, int(month.max()) - first_month + 1 if len(month) else 0),
+        'by_account': grouped(ledger.column('account')[mask], len(ledger.accounts.labels)),
+        'by_category': grouped(ledger.column('category')[mask], len(ledger.categories.labels)),
+        'daily': np.bincount(day[in_series] - first, weights=spending[in_series], minlength=ndays).tolist(),
+    }
+
+
+def _aggregate_python(ledger: Ledger, lo: int, hi: int, first: int, ndays: int) -> Dict:
+    columns = {name: ledger.column(name) for name in _FLOAT_COLUMNS + _INT_COLUMNS}
+    totals = dict.fromkeys(METRICS, 0.0)
+    by_month, by_account, by_category = {}, {}, {}
+    daily = [0.0] * ndays
+    for amount, vat, fee, day, month, account, category in zip(*(columns[name] for name in
+                                                                  _FLOAT_COLUMNS + _INT_COLUMNS)):
+        if day < lo or day > hi:
+            continue
+        values = (1.0, amount if amount > 0 else 0.0, -amount if amount < 0 else 0.0, vat, fee)
+        for groups, key in ((by_month, month), (by_account, account), (by_category, category)):
+            sums = groups.get(key)
+            if sums is None:
+                sums = groups[key] = [0.0] * len(METRICS)
+            for i, value in enumerate(values):
+                sums[i] += value
+        for i, name in enumerate(METRICS):
+            totals[name] += values[i]
+        if first <= day < first + ndays:
+            daily[day - first] += values[2]
+
+    def grouped(groups, size, offset=0):
+        return {name: [groups.get(key + offset, [0.0] * len(METRICS))[i] for key in range(size)]
+                for i, name in enumerate(METRICS)}
+
+    first_month = min(by_month) if by_month else 0
+    return {
+        'count': int(totals['count']),
+        'totals': totals,
+        'first_month': first_month,
+        'by_month': grouped(by_month, max(by_month) - first_month + 1 if by_month else 0, first_month),
+        'by_account': grouped(by_account, len(ledger.accounts.labels)),
+        'by_category': grouped(by_category, len(ledger.categories.labels)),
+        'daily': daily,
+    }
+
+
+def _rows(sums: Dict[str, List[float]], labels: List[Dict]) -> List[Dict]:
+    """One dict per group that has transactions"""
+    return [dict(label, **{name: _number(name, sums[name][i]) for name in METRICS})
+            for i, label in enumerate(labels) if sums['count'][i]]
+
+
+def _number(name: str, value: float):
+    return int(value) if name == 'count' else round(value, 2)
+
+
+def _by_spending(row: Dict) -> float:
+    """Sort key putting the biggest spenders first"""
+    return -row['spending']
+
+
+def summarize(ledger: Ledger, start: Optional[date] = None, end: Optional[date] = None,
+              window: int = 30, days: int = 90) -> Dict:
+    """Aggregates of the ledger's transactions dated within [start, end].
+
+    ``daily`` covers the last ``days`` days up to ``end`` (or the newest
+    transaction): spending per day and the spending over the trailing
+    ``window`` days, both oldest first.
+    """
+    lo = start.toordinal() if start else 1
+    hi = end.toordinal() if end else _MAX_DAY
+    if end:
+        last = hi
+    else:
+        day = ledger.column('day')
+        last = int(day.max() if np is not None else max(day)) if ledger.size else date.today().toordinal()
+    # The rolling sum of the first reported day needs window - 1 earlier days
+    ndays = days + window - 1
+    first = last - ndays + 1
+    aggregate = _aggregate_numpy if np is not None else _aggregate_python
+    result = aggregate(ledger, lo, hi, first, ndays)
+
+    totals = {name: _number(name, value) for name, value in result['totals'].items()}
+    fees = result['totals']['vat'] + result['totals']['service_fee']
+    totals['fees'] = round(fees, 2)
+    totals['fee_ratio'] = round(fees / result['totals']['spending'], 4) if result['totals']['spending'] else 0.0
+    totals['net'] = round(result['totals']['income'] - result['totals']['spending'] - fees, 2)
+
+    first_month = result['first_month']
+    months = [{'month': f"{(first_month + i) // 12:04d}-{(first_month + i) % 12 + 1:02d}"}
+              for i in range(len(result['by_month']['count']))]
+    accounts = [{'account_name': name, 'account_number': number} for name, number in ledger.accounts.labels]
+    categories = [{'category': category} for category in ledger.categories.labels]
+
+    daily = result['daily']
+    running = [0.0]
+    for value in daily:
+        running.append(running[-1] + value)
+    return {
+        'count': result['count'],
+        'totals': totals,
+        'monthly': _rows(result['by_month'], months),
+        'accounts': sorted(_rows(result['by_account'], accounts), key=_by_spending),
+        'categories': sorted(_rows(result['by_category'], categories), key=_by_spending),
+        'daily': {
+            'start': date.fromordinal(last - days + 1).isoformat(),
+            'window': window,
+            'spending': [round(value, 2) for value in daily[window - 1:]],
+            'rolling': [round(running[i + window] - running[i], 2) for i in range(days)],
+        },
+    }
+
+
+class Analytics:
+    """Per-account ledgers kept in step with the transaction store.
+
+    Each query first appends whatever the store gained since the ledger's
+    cursor, so a ledger is read from SQLite once and then only grows by
+    the new rows. The least recently queried ledgers are dropped past
+    ``max_accounts``.
+    """
+
+    def __init__(self, store=None, max_accounts: int = 64):
+        self.store = store
+        self.max_accounts = max_accounts
+        self._ledgers = OrderedDict()  # account -> Ledger
+        self._lock = threading.Lock()
+
+    def summary(self, account: str, start: Optional[date] = None, end: Optional[date] = None,
+                window: int = 30, days: int = 90) -> Dict:
+        ledger = self._ledger(account.lower())
+        with ledger.lock:
+            self._catch_up(account.lower(), ledger)
+            result = summarize(ledger, start, end, window, days)
+            result.update(cursor=ledger.cursor, skipped=ledger.skipped, engine=ENGINE)
+        return result
+
+    def stats(self) -> Dict:
+        with self._lock:
+            ledgers = list(self._ledgers.values())
+        return {'accounts': len(ledgers), 'rows': sum(ledger.size for ledger in ledgers)}
+
+    def _ledger(self, account: str) -> Ledger:
+        with self._lock:
+            ledger = self._ledgers.get(account)
+            if ledger is None:
+                ledger = self._ledgers[account] = Ledger()
+                while len(self._ledgers) > self.max_accounts:
+                    self._ledgers.popitem(last=False)
+            else:
+                self._ledgers.move_to_end(account)
+            return ledger
+
+    def _catch_up(self, account: str, ledger: Ledger):
+        while True:
+            transactions, cursor, has_more = self.store.delta(account, ledger.cursor, LOAD_BATCH,
+                                                              columns=SOURCE_COLUMNS)
+            if transactions:
+                ledger.append(transactions)
+                ledger.cursor = cursor
+            if not has_more:
+                break
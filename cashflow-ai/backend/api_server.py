@@ -4,11 +4,29 @@ Flask API server for CashFlow AI backend
 Provides REST endpoints for email parsing and transaction management
 """
 
-from flask import Flask, request, jsonify
+from flask import Flask, Response, request, jsonify, stream_with_context
 from flask_cors import CORS
 import os
+import hmac
+import json
+import queue
+from datetime import date
 from dotenv import load_dotenv
-from email_parser import parse_emails, EmailParser
+from analytics import Analytics
+from batch_parse import BatchParser, BatchTooLarge, Busy
+from email_parser import FETCH_BATCH_SIZE, FETCH_MODES, PREFILTER_MODES, LoginFailed, iter_parse_emails, parse_emails
+from idle_watch import EventBroker, IdleWatchers, TooManyWatchers
+from imap_governor import GOVERNORS
+from imap_pool import IMAPConnectionPool
+from multi_sync import MultiAccountSync
+from parse_cache import DEFAULT_CACHE_PATH, ParseCache
+from request_profiler import RequestProfiler, account_hash
+from storage import AccountConflict, CheckpointStore, TransactionStore
+from sync_jobs import QueueFull, SyncJobQueue
+from template_registry import TemplateRegistry
+from wire_format import WireOptions, parse_fields, project
+import metrics
+import atexit
 import logging
 
 load_dotenv()
@@ -19,6 +37,115 @@ CORS(app)  # Enable CORS for Flutter app
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# Off unless PROFILE_SAMPLE_RATE or PROFILE_HEADER_TOKEN is set
+request_profiler = RequestProfiler(
+    sample_rate=float(os.getenv('PROFILE_SAMPLE_RATE', 0)),
+    header_token=os.getenv('PROFILE_HEADER_TOKEN', ''),
+    slow_ms=float(os.getenv('SLOW_REQUEST_MS', 1000)),
+    keep=int(os.getenv('PROFILE_KEEP', 50))
+)
+request_profiler.init_app(app)
+
+# Bank templates from TEMPLATES_DIR override the built-in ones and are
+# re-read when the files change
+template_registry = TemplateRegistry(poll_interval=float(os.getenv('TEMPLATES_POLL_SECONDS', 5)))
+template_registry.reload(force=True)
+if template_registry.poll_interval > 0:
+    template_registry.watch()
+
+imap_pool = IMAPConnectionPool(
+    max_size=int(os.getenv('IMAP_POOL_SIZE', 16)),
+    idle_timeout=float(os.getenv('IMAP_POOL_IDLE_TIMEOUT', 300))
+)
+atexit.register(imap_pool.close_all)
+
+parse_cache = ParseCache(
+    max_bytes=int(os.getenv('PARSE_CACHE_MB', 32)) * 1024 * 1024,
+    path=DEFAULT_CACHE_PATH if os.getenv('PARSE_CACHE_DISK', '1') == '1' else None
+)
+atexit.register(parse_cache.close)
+
+multi_sync = MultiAccountSync(
+    max_workers=int(os.getenv('SYNC_MAX_WORKERS', 8)),
+    per_server_limit=int(os.getenv('SYNC_PER_SERVER_LIMIT', 4)),
+    pool=imap_pool,
+    cache=parse_cache
+)
+
+# Default for the sync "prefilter" option: '', 'search' or 'headers'
+DEFAULT_PREFILTER = os.getenv('SYNC_PREFILTER', '')
+
+# Defaults for the sync "fetch_mode" ('full' or 'text') and "keep_raw" options
+DEFAULT_FETCH_MODE = os.getenv('SYNC_FETCH_MODE', 'full')
+DEFAULT_KEEP_RAW = os.getenv('SYNC_KEEP_RAW', '1') == '1'
+
+_checkpoints = None
+_transactions = None
+
+metrics.REGISTRY.callback('cashflow_imap_pool_events_total', 'IMAP pool session events',
+                          lambda: dict(imap_pool.stats), 'event', kind='counter')
+metrics.REGISTRY.callback('cashflow_imap_governor_events_total', 'IMAP pacing and throttle events over all accounts',
+                          GOVERNORS.stats, 'event', kind='counter')
+metrics.REGISTRY.callback('cashflow_parse_cache_events_total', 'Parse cache hits, misses and evictions',
+                          lambda: dict(parse_cache.stats), 'event', kind='counter')
+
+
+def get_checkpoints() -> CheckpointStore:
+    """Shared sync checkpoint store, opened on first use"""
+    global _checkpoints
+    if _checkpoints is None:
+        _checkpoints = CheckpointStore()
+    return _checkpoints
+
+
+def get_transaction_store() -> TransactionStore:
+    """Shared transaction store, opened on first use"""
+    global _transactions
+    if _transactions is None:
+        _transactions = TransactionStore()
+        multi_sync.store = _transactions
+        sync_jobs.store = _transactions
+        idle_watchers.store = _transactions
+        analytics.store = _transactions
+    return _transactions
+
+
+sync_jobs = SyncJobQueue(
+    max_workers=int(os.getenv('SYNC_JOB_WORKERS', 4)),
+    max_pending=int(os.getenv('SYNC_JOB_MAX_PENDING', 64)),
+    keep_seconds=float(os.getenv('SYNC_JOB_KEEP_SECONDS', 3600)),
+    pool=imap_pool,
+    cache=parse_cache,
+    checkpoints=get_checkpoints
+)
+metrics.REGISTRY.callback('cashflow_sync_jobs', 'Background sync jobs by status', sync_jobs.stats, 'status')
+
+# New mail pushed over /api/events by IMAP IDLE watchers
+event_broker = EventBroker(queue_size=int(os.getenv('EVENTS_QUEUE_SIZE', 100)))
+idle_watchers = IdleWatchers(
+    event_broker,
+    max_watchers=int(os.getenv('IDLE_MAX_WATCHERS', 100)),
+    cache=parse_cache,
+    poll_seconds=float(os.getenv('IDLE_POLL_SECONDS', 60)),
+    max_backoff=float(os.getenv('IDLE_MAX_BACKOFF', 300))
+)
+atexit.register(idle_watchers.stop_all)
+EVENTS_HEARTBEAT_SECONDS = float(os.getenv('EVENTS_HEARTBEAT_SECONDS', 15))
+# Client-supplied SMS parsing; PARSE_WORKERS=0 parses every batch in the request thread
+batch_parser = BatchParser(
+    workers=int(os.getenv('PARSE_WORKERS', os.cpu_count() or 1)),
+    max_records=int(os.getenv('PARSE_MAX_RECORDS', 1000)),
+    max_body_chars=int(os.getenv('PARSE_MAX_BODY_CHARS', 8192)),
+    max_inflight=int(os.getenv('PARSE_MAX_INFLIGHT', 4)),
+    inline_below=int(os.getenv('PARSE_INLINE_BELOW', 64))
+)
+atexit.register(batch_parser.shutdown)
+PARSE_MAX_BYTES = int(os.getenv('PARSE_MAX_BYTES', 4 * 1024 * 1024))
+metrics.REGISTRY.callback('cashflow_idle_watchers', 'IMAP IDLE watchers by state', idle_watchers.stats, 'state')
+metrics.REGISTRY.callback('cashflow_event_subscribers', 'Open /api/events streams', event_broker.count)
+# Columnar per-account ledgers behind /api/analytics
+analytics = Analytics(max_accounts=int(os.getenv('ANALYTICS_MAX_ACCOUNTS', 64)))
+
 
 @app.route('/api/health', methods=['GET'])
 def health():
@@ -26,6 +153,60 @@ def health():
     return jsonify({'status': 'ok', 'service': 'CashFlow AI Backend'})
 
 
+@app.route('/api/metrics', methods=['GET'])
+def metrics_endpoint():
+    """Sync pipeline metrics in the Prometheus text format"""
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+
+def _admin_denied():
+    """403 response unless the request carries the admin token; always 403 when none is configured"""
+    token = os.getenv('ADMIN_TOKEN') or os.getenv('TEMPLATES_ADMIN_TOKEN', '')
+    if not token or not hmac.compare_digest(request.headers.get('X-Admin-Token', ''), token):
+        return jsonify({'error': 'Invalid admin token'}), 403
+    return None
+
+
+@app.route('/api/debug/slow-requests', methods=['GET'])
+def slow_requests():
+    """Recent slow or profiled requests, newest first"""
+    denied = _admin_denied()
+    if denied:
+        return denied
+    limit = request.args.get('limit', type=int)
+    entries = request_profiler.slow_requests(limit)
+    return jsonify({'count': len(entries), 'slow_ms': request_profiler.slow_ms, 'requests': entries})
+
+
+@app.route('/api/debug/throttles', methods=['GET'])
+def throttle_events():
+    """Recent IMAP throttle events across accounts, newest first"""
+    denied = _admin_denied()
+    if denied:
+        return denied
+    limit = request.args.get('limit', default=50, type=int)
+    events = GOVERNORS.recent_events(account_hash, limit)
+    return jsonify({'count': len(events), 'stats': GOVERNORS.stats(), 'events': events})
+
+
+@app.route('/api/templates', methods=['GET'])
+def templates_status():
+    """Active template version and any errors from the last reload"""
+    return jsonify(template_registry.status())
+
+
+@app.route('/api/templates/reload', methods=['POST'])
+def reload_templates():
+    """Re-read template files now; a rejected set leaves the current one active"""
+    denied = _admin_denied()
+    if denied:
+        return denied
+    compiled, errors = template_registry.reload(force=True)
+    if errors:
+        return jsonify(dict(template_registry.status(), success=False)), 422
+    return jsonify(dict(template_registry.status(), success=True))
+
+
 @app.route('/api/sync', methods=['POST'])
 def sync_emails():
     """Sync and parse unread emails"""
@@ -34,22 +215,427 @@ def sync_emails():
         imap_server = data.get('imap_server', 'imap.gmail.com')
         email_address = data.get('email_address')
         app_password = data.get('app_password')
+        batch_size = data.get('batch_size')
+        incremental = bool(data.get('incremental', False))
+        prefilter = data.get('prefilter', DEFAULT_PREFILTER) or None
+        fetch_mode = data.get('fetch_mode') or DEFAULT_FETCH_MODE
+        keep_raw = bool(data.get('keep_raw', DEFAULT_KEEP_RAW))
         
         if not email_address or not app_password:
             return jsonify({'error': 'Missing email credentials'}), 400
         
-        transactions = parse_emails(imap_server, email_address, app_password)
+        if prefilter and prefilter not in PREFILTER_MODES:
+            return jsonify({'error': f"prefilter must be one of {', '.join(PREFILTER_MODES)}"}), 400
         
-        return jsonify({
+        if fetch_mode not in FETCH_MODES:
+            return jsonify({'error': f"fetch_mode must be one of {', '.join(FETCH_MODES)}"}), 400
+        
+        try:
+            wire = _wire_options(data)
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+        
+        if data.get('async') or request.args.get('async'):
+            get_transaction_store()
+            try:
+                job, created = sync_jobs.submit(imap_server, email_address, app_password,
+                                                folders=data.get('folders'),
+                                                batch_size=int(batch_size) if batch_size else None,
+                                                incremental=incremental, prefilter=prefilter,
+                                                fetch_mode=fetch_mode, keep_raw=keep_raw)
+            except QueueFull as e:
+                return jsonify({'error': str(e)}), 503
+            status_url = f"/api/sync/{job.job_id}"
+            body = dict(job.to_dict(include_transactions=False), created=created, status_url=status_url)
+            return jsonify(body), 202, {'Location': status_url}
+        
+        stream = bool(data.get('stream') or request.args.get('stream'))
+        # A stream is always NDJSON; only an explicit format is refused,
+        # an Accept header preferring MessagePack still gets the stream
+        if stream and data.get('format', request.args.get('format')) and wire.format != 'json':
+            return jsonify({'error': f"format={wire.format} is not supported with stream"}), 400
+        
+        denied = _login(imap_server, email_address, app_password)
+        if denied:
+            return denied
+        
+        progress = {}
+        if stream:
+            transactions = iter_parse_emails(imap_server, email_address, app_password,
+                                             batch_size=int(batch_size or FETCH_BATCH_SIZE),
+                                             checkpoints=get_checkpoints() if incremental else None,
+                                             pool=imap_pool, cache=parse_cache, prefilter=prefilter,
+                                             fetch_mode=fetch_mode, keep_raw=keep_raw, progress=progress)
+            transactions = _stored(transactions, email_address, int(batch_size or FETCH_BATCH_SIZE))
+            headers = {'Content-Encoding': wire.encoding, 'Vary': 'Accept-Encoding'} if wire.encoding else {}
+            return Response(stream_with_context(wire.stream(_ndjson_stream(transactions, wire, progress))),
+                            mimetype='application/x-ndjson', headers=headers)
+        
+        try:
+            transactions = parse_emails(imap_server, email_address, app_password,
+                                        batch_size=int(batch_size) if batch_size else None,
+                                        checkpoints=get_checkpoints() if incremental else None,
+                                        pool=imap_pool, cache=parse_cache, prefilter=prefilter,
+                                        fetch_mode=fetch_mode, keep_raw=keep_raw, progress=progress)
+        except LoginFailed:
+            # Never record the credential of a login the server refused
+            return jsonify({'error': 'Connection failed'}), 401
+        store = get_transaction_store()
+        store.add(email_address, transactions)
+        
+        return _encoded(wire, {
             'success': True,
             'count': len(transactions),
-            'transactions': transactions
+            'throttled': progress.get('throttled', 0),
+            'unmarked': progress.get('unmarked', []),
+            'transactions': transactions,
+            'cursor': store.latest_cursor(email_address)
         })
     except Exception as e:
         logger.error(f"Sync error: {e}")
         return jsonify({'error': str(e)}), 500
 
 
+@app.route('/api/sync/<job_id>', methods=['GET'])
+def sync_job_status(job_id):
+    """Progress and, once done, results of a background sync"""
+    email_address = request.headers.get('X-Email-Address')
+    app_password = request.headers.get('X-App-Password')
+    if not email_address or not app_password:
+        return jsonify({'error': 'Missing credentials'}), 400
+    job = sync_jobs.get(job_id)
+    # Someone else's job looks the same as an unknown one
+    if job is None or not job.owned_by(email_address, app_password):
+        return jsonify({'error': 'Unknown or expired job'}), 404
+    try:
+        wire = _wire_options()
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    include = request.args.get('transactions', '1') != '0'
+    return _encoded(wire, job.to_dict(include_transactions=include))
+
+
+@app.route('/api/sync/accounts', methods=['POST'])
+def sync_accounts():
+    """Sync several mailboxes concurrently and merge their transactions"""
+    try:
+        data = request.json
+        accounts = data.get('accounts') or []
+        batch_size = data.get('batch_size')
+        incremental = bool(data.get('incremental', False))
+        prefilter = data.get('prefilter', DEFAULT_PREFILTER) or None
+        fetch_mode = data.get('fetch_mode') or DEFAULT_FETCH_MODE
+        keep_raw = bool(data.get('keep_raw', DEFAULT_KEEP_RAW))
+        
+        if not accounts:
+            return jsonify({'error': 'No accounts given'}), 400
+        
+        if any((a.get('prefilter', prefilter) or None) not in (None,) + PREFILTER_MODES for a in accounts):
+            return jsonify({'error': f"prefilter must be one of {', '.join(PREFILTER_MODES)}"}), 400
+        
+        if any((a.get('fetch_mode') or fetch_mode) not in FETCH_MODES for a in accounts):
+            return jsonify({'error': f"fetch_mode must be one of {', '.join(FETCH_MODES)}"}), 400
+        
+        try:
+            wire = _wire_options(data)
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+        
+        get_transaction_store()
+        result = multi_sync.sync(accounts,
+                                 batch_size=int(batch_size) if batch_size else None,
+                                 checkpoints=get_checkpoints() if incremental else None,
+                                 prefilter=prefilter, fetch_mode=fetch_mode, keep_raw=keep_raw)
+        
+        return _encoded(wire, {
+            'success': True,
+            'count': len(result['transactions']),
+            'transactions': result['transactions'],
+            'accounts': result['accounts']
+        })
+    except Exception as e:
+        logger.error(f"Multi-account sync error: {e}")
+        return jsonify({'error': str(e)}), 500
+
+
+@app.route('/api/transactions', methods=['GET'])
+def list_transactions():
+    """Stored transactions added after a cursor, for incremental client refresh"""
+    try:
+        email_address = request.headers.get('X-Email-Address')
+        app_password = request.headers.get('X-App-Password')
+        
+        if not email_address or not app_password:
+            return jsonify({'error': 'Missing credentials'}), 400
+        
+        try:
+            since = int(request.args.get('since', 0))
+            limit = min(max(int(request.args.get('limit', 500)), 1), 5000)
+        except ValueError:
+            return jsonify({'error': 'since and limit must be integers'}), 400
+        
+        try:
+            wire = _wire_options()
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+        
+        store = get_transaction_store()
+        if not store.verify(email_address, app_password):
+            return jsonify({'error': 'Unknown account or wrong credentials'}), 401
+        
+        transactions, cursor, has_more = store.delta(email_address, since, limit)
+        return _encoded(wire, {
+            'success': True,
+            'count': len(transactions),
+            'transactions': transactions,
+            'cursor': cursor,
+            'has_more': has_more
+        })
+    except Exception as e:
+        logger.error(f"Transaction listing error: {e}")
+        return jsonify({'error': str(e)}), 500
+
+
+@app.route('/api/analytics', methods=['GET'])
+def transaction_analytics():
+    """Monthly, per-account, per-category, fee and rolling totals of stored transactions"""
+    try:
+        email_address = request.headers.get('X-Email-Address')
+        app_password = request.headers.get('X-App-Password')
+        
+        if not email_address or not app_password:
+            return jsonify({'error': 'Missing credentials'}), 400
+        
+        try:
+            start = date.fromisoformat(request.args['start']) if request.args.get('start') else None
+            end = date.fromisoformat(request.args['end']) if request.args.get('end') else None
+            window = min(max(int(request.args.get('window', 30)), 1), 366)
+            days = min(max(int(request.args.get('days', 90)), 1), 3660)
+        except ValueError:
+            return jsonify({'error': 'start and end must be YYYY-MM-DD dates, window and days integers'}), 400
+        
+        try:
+            wire = _wire_options()
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+        
+        store = get_transaction_store()
+        if not store.verify(email_address, app_password):
+            return jsonify({'error': 'Unknown account or wrong credentials'}), 401
+        
+        summary = analytics.summary(email_address, start, end, window, days)
+        return _encoded(wire, dict(summary, success=True))
+    except Exception as e:
+        logger.error(f"Analytics error: {e}")
+        return jsonify({'error': str(e)}), 500
+
+
+@app.route('/api/parse', methods=['POST'])
+def parse_records():
+    """Parse SMS records sent by the client, without IMAP"""
+    try:
+        if request.content_length and request.content_length > PARSE_MAX_BYTES:
+            return jsonify({'error': f"Request body larger than {PARSE_MAX_BYTES} bytes"}), 413
+        
+        data = request.get_json(silent=True)
+        records = data.get('records') if isinstance(data, dict) else data
+        if not isinstance(records, list):
+            return jsonify({'error': 'Expected {"records": [{"sender", "body", "date"}, ...]}'}), 400
+        
+        try:
+            wire = _wire_options(data)
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+        
+        try:
+            results, errors = batch_parser.parse(records)
+        except BatchTooLarge as e:
+            return jsonify({'error': str(e)}), 413
+        except Busy as e:
+            return jsonify({'error': str(e)}), 503, {'Retry-After': '1'}
+        
+        return _encoded(wire, {
+            'success': True,
+            'count': sum(1 for tx in results if tx is not None),
+            'results': results,
+            'errors': errors
+        }, key='results')
+    except Exception as e:
+        logger.error(f"Batch parse error: {e}")
+        return jsonify({'error': str(e)}), 500
+
+
+@app.route('/api/watch', methods=['POST'])
+def watch_mailbox():
+    """Keep an IMAP IDLE session open and push new transactions to /api/events"""
+    try:
+        data = request.json
+        imap_server = data.get('imap_server', 'imap.gmail.com')
+        email_address = data.get('email_address')
+        app_password = data.get('app_password')
+        
+        if not email_address or not app_password:
+            return jsonify({'error': 'Missing email credentials'}), 400
+        
+        denied = _login(imap_server, email_address, app_password)
+        if denied:
+            return denied
+        
+        store = get_transaction_store()
+        try:
+            watchers = idle_watchers.watch(imap_server, email_address, app_password, data.get('folders'))
+        except TooManyWatchers as e:
+            return jsonify({'error': str(e)}), 503
+        
+        return jsonify({
+            'success': True,
+            'watchers': [w.to_dict() for w in watchers],
+            'cursor': store.latest_cursor(email_address)
+        })
+    except Exception as e:
+        logger.error(f"Watch error: {e}")
+        return jsonify({'error': str(e)}), 500
+
+
+@app.route('/api/watch', methods=['DELETE'])
+def unwatch_mailbox():
+    """Stop the IDLE watchers of an account"""
+    email_address = request.headers.get('X-Email-Address')
+    app_password = request.headers.get('X-App-Password')
+    imap_server = request.args.get('imap_server', 'imap.gmail.com')
+    
+    if not email_address or not app_password:
+        return jsonify({'error': 'Missing credentials'}), 400
+    
+    if not get_transaction_store().verify(email_address, app_password):
+        return jsonify({'error': 'Unknown account or wrong credentials'}), 401
+    
+    return jsonify({'success': True, 'stopped': idle_watchers.unwatch(imap_server, email_address)})
+
+
+@app.route('/api/events', methods=['GET'])
+def events():
+    """Server-sent events carrying transactions as IDLE watchers find them"""
+    email_address = request.headers.get('X-Email-Address')
+    app_password = request.headers.get('X-App-Password')
+    
+    if not email_address or not app_password:
+        return jsonify({'error': 'Missing credentials'}), 400
+    
+    try:
+        since = int(request.headers.get('Last-Event-ID') or request.args.get('since', 0))
+    except ValueError:
+        return jsonify({'error': 'since must be an integer'}), 400
+    
+    try:
+        names = parse_fields(request.args.get('fields'))
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    
+    store = get_transaction_store()
+    if not store.verify(email_address, app_password):
+        return jsonify({'error': 'Unknown account or wrong credentials'}), 401
+    
+    subscription = event_broker.subscribe(email_address)
+    return Response(stream_with_context(_sse_stream(email_address, subscription, since, names)),
+                    mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+
+def _sse_event(event, data, event_id=None):
+    lines = [f"id: {event_id}"] if event_id else []
+    lines += [f"event: {event}", f"data: {json.dumps(data)}"]
+    return '\n'.join(lines) + '\n\n'
+
+
+def _sse_stream(email_address, subscription, since, names):
+    """Replay what was stored after ``since``, then relay broker events"""
+    try:
+        store = get_transaction_store()
+        while since:
+            transactions, since, has_more = store.delta(email_address, since)
+            if transactions:
+                yield _sse_event('transactions', {'transactions': project(transactions, names),
+                                                  'count': len(transactions),
+                                                  'cursor': since}, since)
+            if not has_more:
+                break
+        yield _sse_event('ready', {'watchers': idle_watchers.status(email_address)})
+        while True:
+            try:
+                event, data = subscription.get(timeout=EVENTS_HEARTBEAT_SECONDS)
+            except queue.Empty:
+                # Comment line: keeps proxies from closing an idle stream
+                yield ': keepalive\n\n'
+                continue
+            if 'transactions' in data:
+                data = dict(data, transactions=project(data['transactions'], names))
+            yield _sse_event(event, data, data.get('cursor'))
+    finally:
+        event_broker.unsubscribe(email_address, subscription)
+
+
+def _login(imap_server, email_address, app_password):
+    """Check the login and register the account with the server that accepted it.
+
+    Returns an error response, or None once the credential is recorded.
+    """
+    with imap_pool.session(imap_server, email_address, app_password) as parser:
+        if parser is None:
+            # Never record the credential of a login the server refused
+            return jsonify({'error': 'Connection failed'}), 401
+    try:
+        get_transaction_store().register(email_address, imap_server, app_password)
+    except AccountConflict as e:
+        return jsonify({'error': str(e)}), 409
+    return None
+
+
+def _stored(transactions, email_address, batch_size):
+    """Pass transactions through, saving them to the store in batches"""
+    store = get_transaction_store()
+    pending = []
+    try:
+        for tx in transactions:
+            pending.append(tx)
+            if len(pending) >= batch_size:
+                store.add(email_address, pending)
+                pending = []
+            yield tx
+    finally:
+        if pending:
+            store.add(email_address, pending)
+
+
+def _ndjson_stream(transactions, wire, progress=None):
+    """Write transactions as NDJSON lines, ending with a summary line"""
+    count = 0
+    progress = {} if progress is None else progress
+    try:
+        for tx in transactions:
+            count += 1
+            yield (json.dumps(wire.transaction(tx), ensure_ascii=False) + '\n').encode('utf-8')
+        summary = {'success': True, 'count': count, 'throttled': progress.get('throttled', 0),
+                   'unmarked': progress.get('unmarked', [])}
+        yield (json.dumps(summary) + '\n').encode('utf-8')
+    except Exception as e:
+        logger.error(f"Streaming sync error: {e}")
+        yield (json.dumps({'error': str(e), 'count': count}) + '\n').encode('utf-8')
+
+
+def _wire_options(data=None) -> WireOptions:
+    """Field projection, format and compression from the request; ValueError on bad values"""
+    data = data if isinstance(data, dict) else {}
+    return WireOptions.negotiate(data.get('fields', request.args.get('fields')),
+                                 data.get('format', request.args.get('format')),
+                                 request.headers.get('Accept'), request.headers.get('Accept-Encoding'))
+
+
+def _encoded(wire, payload, status=200, key='transactions'):
+    body, headers = wire.encode(payload, key)
+    return Response(body, status, headers)
+
+
 @app.route('/api/test-connection', methods=['POST'])
 def test_connection():
     """Test IMAP connection"""
@@ -62,12 +648,10 @@ def test_connection():
         if not email_address or not app_password:
             return jsonify({'error': 'Missing credentials'}), 400
         
-        parser = EmailParser(imap_server, email_address, app_password)
-        if parser.connect():
-            parser.disconnect()
-            return jsonify({'success': True, 'message': 'Connection successful'})
-        else:
-            return jsonify({'success': False, 'message': 'Connection failed'}), 400
+        with imap_pool.session(imap_server, email_address, app_password) as parser:
+            if parser is not None:
+                return jsonify({'success': True, 'message': 'Connection successful'})
+        return jsonify({'success': False, 'message': 'Connection failed'}), 400
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
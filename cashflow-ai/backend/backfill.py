@@ -0,0 +1,207 @@
+#!/usr/bin/env python3
+"""
+Offline bulk backfill for CashFlow AI
+Parses bank alerts from mbox files (e.g. Google Takeout) or Maildir folders
+on all CPU cores and writes the transactions to JSONL or SQLite
+"""
+
+import argparse
+import json
+import logging
+import mmap
+import os
+import re
+import sqlite3
+import sys
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import fields
+from typing import Dict, Iterator, List, Tuple
+
+from email_parser import EmailParser, ParsedTransaction, parse_email_transaction
+
+logger = logging.getLogger(__name__)
+
+# mboxrd quoting: ">From " at line start stands for "From "
+_MBOXRD_QUOTE_RE = re.compile(rb'^>(>*From )', re.MULTILINE)
+
+
+def iter_mbox_messages(path: str) -> Iterator[bytes]:
+    """Yield raw messages from an mbox file without reading it into memory"""
+    with open(path, 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            start = 0 if mm[:5] == b'From ' else mm.find(b'\nFrom ')
+            while start != -1:
+                if mm[start:start + 1] == b'\n':
+                    start += 1
+                end = mm.find(b'\nFrom ', start)
+                # Skip the "From sender date" separator line itself
+                body_start = mm.find(b'\n', start)
+                if body_start == -1:
+                    break
+                raw = mm[body_start + 1:end if end != -1 else len(mm)]
+                yield _MBOXRD_QUOTE_RE.sub(rb'\1', raw)
+                start = end
+
+
+def iter_maildir_messages(path: str) -> Iterator[bytes]:
+    """Yield raw messages from a Maildir (cur/ and new/) or any directory of message files"""
+    subdirs = [os.path.join(path, d) for d in ('cur', 'new') if os.path.isdir(os.path.join(path, d))]
+    for root in subdirs or [path]:
+        for dirpath, _, filenames in os.walk(root):
+            for name in sorted(filenames):
+                if name.startswith('.'):
+                    continue
+                with open(os.path.join(dirpath, name), 'rb') as f:
+                    yield f.read()
+
+
+def iter_source_messages(path: str) -> Iterator[Tuple[str, bytes]]:
+    """Yield (message id, raw bytes) from an mbox file or Maildir directory"""
+    reader = iter_maildir_messages if os.path.isdir(path) else iter_mbox_messages
+    label = os.path.basename(os.path.normpath(path))
+    for index, raw in enumerate(reader(path)):
+        yield f"{label}:{index}", raw
+
+
+_decoder = None
+
+
+def _parse_chunk(chunk: List[Tuple[str, bytes]], keep_raw: bool = False) -> Tuple[int, List[Dict]]:
+    """Worker: decode and parse one chunk of raw messages"""
+    global _decoder
+    if _decoder is None:
+        _decoder = EmailParser('', '', '')
+    transactions = []
+    for email_id, raw in chunk:
+        try:
+            email_data = _decoder.parse_raw_email(email_id, raw)
+            if not keep_raw:
+                email_data['raw'] = ''
+            transaction = parse_email_transaction(email_data)
+        except Exception as e:
+            logger.error(f"Error parsing {email_id}: {e}")
+            continue
+        if transaction:
+            transactions.append(transaction.to_dict())
+    return len(chunk), transactions
+
+
+def _chunks(messages: Iterator[Tuple[str, bytes]], size: int) -> Iterator[List[Tuple[str, bytes]]]:
+    chunk = []
+    for item in messages:
+        chunk.append(item)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def parse_sources(paths: List[str], workers: int = None, chunk_size: int = 500,
+                  keep_raw: bool = False) -> Iterator[Tuple[int, List[Dict]]]:
+    """Parse every message of the given sources on a process pool.
+
+    Yields (messages in chunk, transactions) per chunk in input order. At
+    most two chunks per worker are in flight, so memory stays bounded
+    however large the archive is.
+    """
+    workers = workers or os.cpu_count() or 1
+    messages = (item for path in paths for item in iter_source_messages(path))
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        in_flight = deque()
+        for chunk in _chunks(messages, chunk_size):
+            in_flight.append(executor.submit(_parse_chunk, chunk, keep_raw))
+            if len(in_flight) >= workers * 2:
+                yield in_flight.popleft().result()
+        while in_flight:
+            yield in_flight.popleft().result()
+
+
+class JsonlWriter:
+    """Append transactions to a JSON Lines file"""
+
+    def __init__(self, path: str):
+        self._file = sys.stdout if path == '-' else open(path, 'a', encoding='utf-8')
+
+    def write(self, transactions: List[Dict]):
+        for tx in transactions:
+            self._file.write(json.dumps(tx) + '\n')
+
+    def close(self):
+        if self._file is not sys.stdout:
+            self._file.close()
+
+
+class SqliteWriter:
+    """Insert transactions into a SQLite table, one transaction per batch"""
+
+    COLUMNS = [f.name for f in fields(ParsedTransaction)]
+
+    def __init__(self, path: str):
+        self._conn = sqlite3.connect(path)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute(f"CREATE TABLE IF NOT EXISTS transactions ({', '.join(self.COLUMNS)})")
+        self._insert = (f"INSERT INTO transactions ({', '.join(self.COLUMNS)}) "
+                        f"VALUES ({', '.join('?' for _ in self.COLUMNS)})")
+
+    def write(self, transactions: List[Dict]):
+        with self._conn:
+            self._conn.executemany(self._insert, [[tx[c] for c in self.COLUMNS] for tx in transactions])
+
+    def close(self):
+        self._conn.close()
+
+
+def run_backfill(paths: List[str], output: str, fmt: str = 'jsonl', workers: int = None,
+                 chunk_size: int = 500, keep_raw: bool = False, progress_every: float = 5.0) -> Dict:
+    """Parse the sources into ``output`` and return throughput totals"""
+    writer = SqliteWriter(output) if fmt == 'sqlite' else JsonlWriter(output)
+    totals = {'messages': 0, 'transactions': 0, 'seconds': 0.0}
+    started = last_report = time.monotonic()
+    try:
+        for count, transactions in parse_sources(paths, workers, chunk_size, keep_raw):
+            writer.write(transactions)
+            totals['messages'] += count
+            totals['transactions'] += len(transactions)
+            now = time.monotonic()
+            if now - last_report >= progress_every:
+                last_report = now
+                _report(totals, now - started)
+    finally:
+        writer.close()
+    totals['seconds'] = round(time.monotonic() - started, 3)
+    _report(totals, totals['seconds'])
+    return totals
+
+
+def _report(totals: Dict, elapsed: float):
+    rate = totals['messages'] / elapsed if elapsed > 0 else 0.0
+    logger.info(f"{totals['messages']} messages, {totals['transactions']} transactions, "
+                f"{elapsed:.1f}s, {rate:.0f} msg/s")
+
+
+def main(argv: List[str] = None) -> int:
+    parser = argparse.ArgumentParser(description='Backfill transactions from mbox files or Maildir folders')
+    parser.add_argument('sources', nargs='+', help='mbox files or Maildir directories')
+    parser.add_argument('-o', '--output', default='-', help="output file ('-' for stdout, JSONL only)")
+    parser.add_argument('-f', '--format', choices=['jsonl', 'sqlite'], default='jsonl')
+    parser.add_argument('-w', '--workers', type=int, default=None, help='worker processes (default: all cores)')
+    parser.add_argument('--chunk-size', type=int, default=500, help='messages per worker task')
+    parser.add_argument('--keep-raw', action='store_true', help='keep the full raw email in raw_email')
+    parser.add_argument('--progress-every', type=float, default=5.0, help='seconds between progress lines')
+    args = parser.parse_args(argv)
+
+    if args.format == 'sqlite' and args.output == '-':
+        parser.error('--format sqlite needs --output')
+
+    run_backfill(args.sources, args.output, args.format, args.workers,
+                 args.chunk_size, args.keep_raw, args.progress_every)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,212 @@
+#!/usr/bin/env python3
+"""
+Stateless batch parsing for CashFlow AI
+Parses client-supplied SMS records without IMAP, spreading large batches
+over a process pool started on first use
+"""
+
+import logging
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timezone
+from time import perf_counter
+from typing import Dict, List, Optional, Tuple
+
+from email_parser import get_compiled_templates, parse_email_transaction, reload_templates
+from metrics import BATCH_PARSE_RECORDS, BATCH_PARSE_SECONDS, REGISTRY, TEMPLATE_HITS, TEMPLATE_MISSES
+
+logger = logging.getLogger(__name__)
+
+
+class BatchTooLarge(ValueError):
+    """Raised when a batch has more records than allowed"""
+
+
+class Busy(Exception):
+    """Raised when too many batches are already being parsed"""
+
+
+def parse_record_date(value) -> datetime:
+    """Accept ISO 8601 text or a Unix timestamp in seconds or milliseconds; naive times are UTC"""
+    if value is None or value == '':
+        return datetime.now(timezone.utc)
+    if isinstance(value, bool):
+        raise ValueError('date must be ISO 8601 text or a Unix timestamp')
+    if isinstance(value, (int, float)):
+        # Android SMS timestamps are in milliseconds
+        seconds = value / 1000 if abs(value) >= 1e11 else value
+        return datetime.fromtimestamp(seconds, tz=timezone.utc)
+    if isinstance(value, str):
+        text = value.strip()
+        # fromisoformat only accepts a trailing Z from Python 3.11
+        dt = datetime.fromisoformat(text[:-1] + '+00:00' if text.endswith(('Z', 'z')) else text)
+        return dt if dt.tzinfo else dt.replace(tzinfo=timezone.utc)
+    raise ValueError('date must be ISO 8601 text or a Unix timestamp')
+
+
+def _worker_context():
+    """Start method for the worker pool.
+
+    Not fork: the server has template, IDLE and job threads running, and a
+    forked child could inherit a lock one of them held. The fork server is
+    preloaded with this module only, so it holds no server state.
+    """
+    if 'forkserver' in multiprocessing.get_all_start_methods():
+        context = multiprocessing.get_context('forkserver')
+        context.set_forkserver_preload([__name__])
+        return context
+    return multiprocessing.get_context('spawn')
+
+
+def _ready() -> int:
+    return os.getpid()
+
+
+def _parse_group(version: str, templates: List[Dict], name: str,
+                 items: List[Tuple[int, Dict]]) -> Tuple[List[Tuple[int, Optional[Dict], str]], Dict]:
+    """Worker: parse records already matched to template ``name``.
+
+    Returns the rows and the metrics recorded while parsing them, for the
+    parent to merge into its own registry.
+    """
+    REGISTRY.take()  # drop anything recorded outside a task, such as at import
+    compiled = get_compiled_templates()
+    if compiled.version != version:
+        # The parent reloaded its templates since this worker last synced
+        compiled = reload_templates(templates)
+    template = next((t for t in compiled.templates if t.get('name') == name), None)
+    rows = [_parse_one(index, email_data, template) for index, email_data in items]
+    return rows, REGISTRY.take()
+
+
+def _parse_one(index: int, email_data: Dict, template: Optional[Dict]) -> Tuple[int, Optional[Dict], str]:
+    try:
+        transaction = parse_email_transaction(email_data, template)
+    except Exception as e:
+        logger.error(f"Error parsing record {index}: {e}")
+        return index, None, str(e)
+    return index, transaction.to_dict() if transaction else None, ''
+
+
+class BatchParser:
+    """Parses batches of {sender, body, date} records in input order.
+
+    Records are matched in the calling thread and grouped by template, so
+    only bank messages travel to the workers and each worker chunk runs a
+    single template's patterns. Batches with fewer than ``inline_below``
+    matches are parsed in place, where the pool round trip would cost more
+    than it saves. At most ``max_inflight`` batches use the pool at once;
+    a batch that cannot get a slot within ``queue_timeout`` seconds raises
+    Busy. The pool is started by the first batch that needs it, so importing
+    the server, or running it under the reloader, spawns no processes.
+    """
+
+    def __init__(self, workers: int = 0, max_records: int = 1000, max_body_chars: int = 8192,
+                 max_inflight: int = 4, inline_below: int = 64, chunk_size: int = 100,
+                 queue_timeout: float = 1.0):
+        self.workers = workers
+        self.max_records = max_records
+        self.max_body_chars = max_body_chars
+        self.inline_below = inline_below
+        self.chunk_size = chunk_size
+        self.queue_timeout = queue_timeout
+        self._slots = threading.BoundedSemaphore(max_inflight)
+        self._executor = None
+        self._start_lock = threading.Lock()
+
+    def start(self) -> bool:
+        """Fork the worker processes if not yet running; False when workers is 0"""
+        if self.workers <= 0:
+            return False
+        with self._start_lock:
+            if self._executor is None:
+                executor = ProcessPoolExecutor(max_workers=self.workers, mp_context=_worker_context())
+                pids = {f.result() for f in [executor.submit(_ready) for _ in range(self.workers)]}
+                self._executor = executor
+                logger.info(f"Batch parser started {len(pids)} worker processes")
+        return True
+
+    def shutdown(self):
+        with self._start_lock:
+            if self._executor is not None:
+                self._executor.shutdown(wait=False)
+                self._executor = None
+
+    def parse(self, records: List) -> Tuple[List[Optional[Dict]], List[Dict]]:
+        """Return (one transaction or None per record, [{'index', 'error'}])"""
+        if len(records) > self.max_records:
+            raise BatchTooLarge(f"{len(records)} records, at most {self.max_records} per batch")
+        start = perf_counter()
+        results = [None] * len(records)
+        errors = []
+        compiled = get_compiled_templates()
+        groups = {}  # template name -> [(index, email_data)]
+        for index, record in enumerate(records):
+            try:
+                email_data = self._email_data(record)
+            except ValueError as e:
+                errors.append({'index': index, 'error': str(e)})
+                continue
+            template = compiled.match(email_data['sender'], email_data['body'].strip())
+            if template is None:
+                TEMPLATE_MISSES.inc()
+                continue
+            TEMPLATE_HITS.inc(template.get('name', ''))
+            groups.setdefault(template.get('name', ''), []).append((index, email_data))
+
+        matched = sum(len(items) for items in groups.values())
+        mode = 'pool' if matched >= self.inline_below and self.start() else 'inline'
+        if mode == 'pool':
+            parsed = self._parse_pooled(compiled, groups)
+        else:
+            templates = {t.get('name', ''): t for t in compiled.templates}
+            parsed = [_parse_one(index, email_data, templates[name])
+                      for name, items in groups.items() for index, email_data in items]
+        for index, transaction, error in parsed:
+            if error:
+                errors.append({'index': index, 'error': error})
+            results[index] = transaction
+        errors.sort(key=lambda e: e['index'])
+
+        count = sum(1 for tx in results if tx is not None)
+        BATCH_PARSE_SECONDS.observe(perf_counter() - start, mode)
+        BATCH_PARSE_RECORDS.inc('parsed', amount=count)
+        BATCH_PARSE_RECORDS.inc('unmatched', amount=len(records) - count - len(errors))
+        BATCH_PARSE_RECORDS.inc('invalid', amount=len(errors))
+        return results, errors
+
+    def _parse_pooled(self, compiled, groups: Dict[str, List[Tuple[int, Dict]]]) -> List:
+        if not self._slots.acquire(timeout=self.queue_timeout):
+            BATCH_PARSE_RECORDS.inc('rejected', amount=sum(len(items) for items in groups.values()))
+            raise Busy('Too many batches in progress, retry shortly')
+        try:
+            futures = [self._executor.submit(_parse_group, compiled.version, compiled.templates, name,
+                                             items[i:i + self.chunk_size])
+                       for name, items in groups.items() for i in range(0, len(items), self.chunk_size)]
+            parsed = []
+            for future in futures:
+                rows, recorded = future.result()
+                REGISTRY.merge(recorded)
+                parsed.extend(rows)
+            return parsed
+        finally:
+            self._slots.release()
+
+    def _email_data(self, record) -> Dict:
+        if not isinstance(record, dict):
+            raise ValueError('record must be an object')
+        body = record.get('body')
+        sender = record.get('sender') or ''
+        if not isinstance(body, str) or not body.strip():
+            raise ValueError('body is required')
+        if not isinstance(sender, str):
+            raise ValueError('sender must be a string')
+        if len(body) > self.max_body_chars:
+            raise ValueError(f"body longer than {self.max_body_chars} characters")
+        try:
+            date = parse_record_date(record.get('date'))
+        except (ValueError, TypeError, OverflowError, OSError) as e:
+            raise ValueError(f"invalid date: {e}")
+        return {'id': str(record.get('id') or ''), 'sender': sender, 'body': body, 'date': date, 'raw': ''}
@@ -0,0 +1,153 @@
+#!/usr/bin/env python3
+"""
+Parser micro-benchmarks for CashFlow AI
+Times each parsing stage over a synthetic per-bank corpus and flags
+regressions against a saved baseline
+"""
+
+import argparse
+import json
+import logging
+import sys
+import time
+import tracemalloc
+from typing import Callable, Dict, List
+
+import email_parser
+from synthetic_corpus import generate_messages
+
+logger = logging.getLogger(__name__)
+
+
+def _percentile(sorted_values: List[int], pct: float) -> int:
+    if not sorted_values:
+        return 0
+    index = min(len(sorted_values) - 1, int(round(pct / 100 * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+def _time_stage(calls: List[Callable[[], object]], repeat: int) -> Dict:
+    """Time each call individually; exceptions are counted, not raised"""
+    samples = []
+    errors = 0
+    perf_ns = time.perf_counter_ns
+    for _ in range(repeat):
+        for call in calls:
+            start = perf_ns()
+            try:
+                call()
+            except Exception:
+                errors += 1
+            samples.append(perf_ns() - start)
+    samples.sort()
+    total_s = sum(samples) / 1e9
+    return {
+        'calls': len(samples),
+        'errors': errors,
+        'msgs_per_sec': round(len(samples) / total_s, 1) if total_s else 0.0,
+        'p50_us': round(_percentile(samples, 50) / 1000, 2),
+        'p90_us': round(_percentile(samples, 90) / 1000, 2),
+        'p99_us': round(_percentile(samples, 99) / 1000, 2),
+        'max_us': round(samples[-1] / 1000, 2) if samples else 0.0,
+    }
+
+
+def _stage_calls(messages: List[Dict]) -> Dict[str, List[Callable[[], object]]]:
+    """Build one zero-argument call per message for every parsing stage"""
+    ep = email_parser
+    matched = []
+    for msg in messages:
+        template = ep.match_template(msg['sender'], msg['body'])
+        if template:
+            matched.append((template, msg))
+    return {
+        'match_template': [lambda m=m: ep.match_template(m['sender'], m['body']) for m in messages],
+        'parse_context': [lambda m=m: ep.ParseContext(m['body']) for _, m in matched],
+        'extract_fields': [lambda t=t, m=m: ep.extract_fields(t, m['body']) for t, m in matched],
+        'extract_vat_and_service': [lambda m=m: ep.extract_vat_and_service(m['body'], 100.0) for _, m in matched],
+        'extract_counterparty': [lambda m=m: ep.extract_counterparty(m['body']) for _, m in matched],
+        'parse_email_transaction': [lambda m=m: ep.parse_email_transaction(m) for m in messages],
+    }
+
+
+def run_benchmark(count: int = 5000, repeat: int = 3, seed: int = 0, noise_ratio: float = 0.1) -> Dict:
+    """Benchmark every stage and measure peak memory of a full parse pass"""
+    messages = generate_messages(count, seed=seed, noise_ratio=noise_ratio)
+    stages = {name: _time_stage(calls, repeat) for name, calls in _stage_calls(messages).items()}
+
+    tracemalloc.start()
+    for msg in messages:
+        try:
+            email_parser.parse_email_transaction(msg)
+        except Exception:
+            pass
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return {
+        'messages': count,
+        'repeat': repeat,
+        'seed': seed,
+        'template_version': email_parser.get_compiled_templates().version,
+        'peak_memory_kb': round(peak / 1024, 1),
+        'stages': stages,
+    }
+
+
+def compare(result: Dict, baseline: Dict, threshold: float) -> List[str]:
+    """List stages whose p50 latency or throughput regressed beyond ``threshold``"""
+    regressions = []
+    for name, current in result['stages'].items():
+        previous = baseline.get('stages', {}).get(name)
+        if not previous:
+            continue
+        if previous['p50_us'] and current['p50_us'] > previous['p50_us'] * (1 + threshold):
+            regressions.append(f"{name}: p50 {previous['p50_us']}us -> {current['p50_us']}us")
+        if previous['msgs_per_sec'] and current['msgs_per_sec'] < previous['msgs_per_sec'] / (1 + threshold):
+            regressions.append(f"{name}: {previous['msgs_per_sec']} -> {current['msgs_per_sec']} msg/s")
+    return regressions
+
+
+def _print_table(result: Dict):
+    print(f"{result['messages']} messages x {result['repeat']}, "
+          f"templates {result['template_version']}, peak memory {result['peak_memory_kb']} KiB")
+    print(f"{'stage':<26}{'msg/s':>12}{'p50 us':>10}{'p90 us':>10}{'p99 us':>10}{'max us':>10}{'errors':>8}")
+    for name, s in result['stages'].items():
+        print(f"{name:<26}{s['msgs_per_sec']:>12}{s['p50_us']:>10}{s['p90_us']:>10}"
+              f"{s['p99_us']:>10}{s['max_us']:>10}{s['errors']:>8}")
+
+
+def main(argv: List[str] = None) -> int:
+    parser = argparse.ArgumentParser(description='Benchmark the email parsing hot path')
+    parser.add_argument('-n', '--messages', type=int, default=5000)
+    parser.add_argument('-r', '--repeat', type=int, default=3)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--noise', type=float, default=0.1, help='fraction of non-matching messages')
+    parser.add_argument('--save', help='write results as a JSON baseline')
+    parser.add_argument('--compare', help='baseline JSON to check for regressions')
+    parser.add_argument('--threshold', type=float, default=0.2, help='allowed slowdown, e.g. 0.2 = 20%%')
+    parser.add_argument('--json', action='store_true', help='print results as JSON')
+    args = parser.parse_args(argv)
+
+    result = run_benchmark(args.messages, args.repeat, args.seed, args.noise)
+    if args.json:
+        print(json.dumps(result, indent=2))
+    else:
+        _print_table(result)
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(result, f, indent=2)
+
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare(result, json.load(f), args.threshold)
+        for line in regressions:
+            print(f"REGRESSION {line}")
+        if regressions:
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -5,20 +5,60 @@ Converts IMAP email fetching to parse forwarded SMS messages from Ethiopian bank
 """
 
 import imaplib
+import os
 import email
+import binascii
+import quopri
 from email.header import decode_header
 from datetime import datetime, timezone
 import re
 import json
+import select
+import ssl
+import hashlib
 import logging
-from typing import Dict, List, Optional, Tuple
-from dataclasses import dataclass, asdict
+import threading
+from contextlib import contextmanager
+from functools import lru_cache
+from time import monotonic, perf_counter
+from typing import Dict, Iterable, Iterator, List, Optional, Pattern, Tuple
+from dataclasses import dataclass, fields
+from operator import attrgetter
+
+from imap_governor import GOVERNORS, is_throttled
+from metrics import (IMAP_COMMAND_ERRORS, IMAP_COMMAND_SECONDS, IMAP_FETCH_BYTES, IMAP_FETCH_MESSAGES,
+                     IMAP_LOGIN_SECONDS, IMAP_THROTTLES, PARSE_STAGE_SECONDS, PREFILTER_SKIPPED,
+                     TEMPLATE_FIELD_MISSES, TEMPLATE_HITS, TEMPLATE_MISSES, TRANSACTIONS_PARSED, ZERO_AMOUNT_DROPS)
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 DEC_AMOUNT = r'((?:\d{1,3}(?:,\d{3})*|\d+)(?:\.\d+)?)'
 
+# Messages requested per batched IMAP FETCH command
+FETCH_BATCH_SIZE = 200
+
+# Prefilter modes: narrow the server-side SEARCH to known bank senders, or
+# fetch From headers first and download bodies only for sender matches
+PREFILTER_MODES = ('search', 'headers')
+
+# Fetch modes: the whole RFC822 message, or headers plus the text/plain part
+FETCH_MODES = ('full', 'text')
+
+# imap://host:port connects without TLS. It is meant for local test servers
+# such as fake_imap.py, so it must be enabled explicitly
+IMAP_ALLOW_PLAINTEXT = os.getenv('IMAP_ALLOW_PLAINTEXT', '0') == '1'
+
+# Stage timers bound once, so the per-message cost is a single observe()
+_STAGE_MIME_DECODE = PARSE_STAGE_SECONDS.labels('mime_decode')
+_STAGE_MATCH_TEMPLATE = PARSE_STAGE_SECONDS.labels('match_template')
+_STAGE_EXTRACT_FIELDS = PARSE_STAGE_SECONDS.labels('extract_fields')
+_STAGE_EXTRACT_AMOUNT = PARSE_STAGE_SECONDS.labels('extract_amount')
+_STAGE_EXTRACT_VAT_AND_SERVICE = PARSE_STAGE_SECONDS.labels('extract_vat_and_service')
+_STAGE_EXTRACT_COUNTERPARTY = PARSE_STAGE_SECONDS.labels('extract_counterparty')
+_STAGE_DETECT_TAGS = PARSE_STAGE_SECONDS.labels('detect_tags')
+_STAGE_SERIALIZE = PARSE_STAGE_SECONDS.labels('serialize')
+
 TEMPLATES = [
     {
         'name': 'CBE',
@@ -109,6 +149,139 @@ TEMPLATES = [
 ]
 
 
+@lru_cache(maxsize=512)
+def _compile_pattern(pattern: str) -> Optional[Pattern]:
+    """Compile a template pattern, returning None if it is invalid"""
+    try:
+        return re.compile(pattern, re.IGNORECASE)
+    except re.error as e:
+        logger.warning(f"Skipping invalid template pattern {pattern!r}: {e}")
+        return None
+
+
+def _templates_fingerprint(templates: List[Dict]) -> str:
+    """Stable hash of a template set, used as its version"""
+    payload = json.dumps(templates, sort_keys=True, default=str)
+    return hashlib.sha1(payload.encode('utf-8')).hexdigest()[:12]
+
+
+class CompiledTemplates:
+    """Template set precompiled into flat lookup tables.
+
+    Sender substrings are lowercased once into an ordered index, and every
+    body/field pattern is compiled up front, so matching a message is a single
+    walk over precompiled patterns with no per-call lowercasing or compiling.
+    """
+
+    def __init__(self, templates: List[Dict], revision: int = 0):
+        self.templates = templates
+        self.version = _templates_fingerprint(templates)
+        # Bumped on every reload, even when the content hash is unchanged
+        self.revision = revision
+        self._senders = []
+        self._body_patterns = []
+        self._fields = {}
+        for idx, template in enumerate(templates):
+            for sender in template.get('senders', []):
+                self._senders.append((sender.lower(), idx))
+            for pat in template.get('body_patterns', []):
+                compiled = _compile_pattern(pat)
+                if compiled is not None:
+                    self._body_patterns.append((idx, compiled))
+            self._fields[id(template)] = (template, self._compile_fields(template))
+
+    @staticmethod
+    def _compile_fields(template: Dict) -> List[Tuple[str, List[Pattern]]]:
+        compiled = []
+        for field, pats in template.get('fields', {}).items():
+            compiled.append((field, [c for c in map(_compile_pattern, pats) if c is not None]))
+        return compiled
+
+    def matches_sender(self, sender: str) -> bool:
+        """Whether any template's sender substring occurs in ``sender``"""
+        sl = (sender or '').lower()
+        return any(needle in sl for needle, _ in self._senders)
+    
+    def search_criteria(self) -> str:
+        """IMAP SEARCH key matching mail from any template sender, or '' if there are none"""
+        needles = list(dict.fromkeys(needle for needle, _ in self._senders))
+        # "dashen super app" adds nothing once "dashen" is searched
+        needles = [n for n in needles if not any(o != n and o in n for o in needles)]
+        if not needles or not all(needle.isascii() for needle in needles):
+            # Non-ASCII keys would need SEARCH CHARSET, which servers support unevenly
+            return ''
+        keys = ['FROM "{}"'.format(n.replace('\\', '\\\\').replace('"', '\\"')) for n in needles]
+        # OR takes exactly two keys, so n keys need n - 1 leading ORs
+        return ' '.join(['OR'] * (len(keys) - 1) + keys)
+    
+    def match(self, sender: str, body: str) -> Optional[Dict]:
+        """Return the first template whose sender or body patterns match"""
+        best = len(self.templates)
+        sl = (sender or '').lower()
+        for needle, idx in self._senders:
+            if needle in sl:
+                best = idx
+                break
+        # Only templates ahead of the sender hit can still win on body patterns
+        body = body or ''
+        for idx, pat in self._body_patterns:
+            if idx >= best:
+                break
+            if pat.search(body):
+                best = idx
+                break
+        return self.templates[best] if best < len(self.templates) else None
+
+    def field_patterns(self, template: Dict) -> List[Tuple[str, List[Pattern]]]:
+        """Compiled field patterns for a template, compiling unknown ones on the fly"""
+        entry = self._fields.get(id(template))
+        if entry is not None and entry[0] is template:
+            return entry[1]
+        return self._compile_fields(template)
+
+
+_compiled_templates: Optional[CompiledTemplates] = None
+_templates_lock = threading.Lock()
+
+
+def get_compiled_templates() -> CompiledTemplates:
+    """Compiled form of TEMPLATES, rebuilt if the module list was replaced"""
+    global _compiled_templates
+    compiled = _compiled_templates
+    if compiled is None or compiled.templates is not TEMPLATES:
+        with _templates_lock:
+            compiled = _compiled_templates
+            if compiled is None or compiled.templates is not TEMPLATES:
+                revision = compiled.revision + 1 if compiled else 0
+                compiled = _compiled_templates = CompiledTemplates(TEMPLATES, revision)
+    return compiled
+
+
+def reload_templates(templates: Optional[List[Dict]] = None) -> CompiledTemplates:
+    """Replace TEMPLATES (or pick up in-place edits) and recompile.
+
+    The new set is compiled before it is published, so readers see either
+    the old set or the new one, never a mix.
+    """
+    global TEMPLATES, _compiled_templates
+    with _templates_lock:
+        current = _compiled_templates
+        compiled = CompiledTemplates(TEMPLATES if templates is None else templates,
+                                     current.revision + 1 if current else 0)
+        TEMPLATES = compiled.templates
+        _compiled_templates = compiled
+    return compiled
+
+
+def _slotted(cls):
+    """Rebuild a dataclass with __slots__, as dataclass(slots=True) does from Python 3.10"""
+    names = tuple(f.name for f in fields(cls))
+    namespace = {k: v for k, v in cls.__dict__.items() if k not in names + ('__dict__', '__weakref__')}
+    namespace['__slots__'] = names
+    return type(cls)(cls.__name__, cls.__bases__, namespace)
+
+
+@_slotted
 @dataclass
 class ParsedTransaction:
     """Data class for parsed transaction"""
@@ -131,6 +304,24 @@ class ParsedTransaction:
     email_id: str = ''  # IMAP message ID
     raw_email: str = ''  # Full email content for debugging
 
+    def to_dict(self, names: Optional[Tuple[str, ...]] = None) -> Dict:
+        """Fields as a dict, optionally only ``names``; a shallow stand-in for asdict()"""
+        if names is None:
+            return dict(zip(TRANSACTION_FIELDS, _transaction_row(self)))
+        return {name: getattr(self, name) for name in names}
+
+    def as_row(self) -> Tuple:
+        """Field values in TRANSACTION_FIELDS order"""
+        return _transaction_row(self)
+
+
+TRANSACTION_FIELDS = tuple(f.name for f in fields(ParsedTransaction))
+_transaction_row = attrgetter(*TRANSACTION_FIELDS)
+
+
+class LoginFailed(ConnectionError):
+    """The IMAP server refused the connection or the credentials"""
+
 
 class EmailParser:
     """IMAP-based email parser for bank SMS messages"""
@@ -140,35 +331,119 @@ class EmailParser:
         self.email_address = email_address
         self.app_password = app_password
         self.imap = None
+        # Shared with every other session of this account; see imap_governor
+        self.governor = GOVERNORS.get(imap_server, email_address)
+        # Throttle events seen by this session, for iter_sync_mailbox's progress
+        self.throttle_events = []
+        self.fetched_bytes = 0
+        self.login_refused = False  # last connect() reached the server and LOGIN was refused
     
     def connect(self) -> bool:
-        """Connect to IMAP server"""
-        try:
-            self.imap = imaplib.IMAP4_SSL(self.imap_server)
-            self.imap.login(self.email_address, self.app_password)
-            logger.info(f"Connected to {self.imap_server}")
-            return True
-        except Exception as e:
-            logger.error(f"IMAP connection failed: {e}")
+        """Connect to IMAP server.
+
+        A login refused for too many connections or commands is retried
+        with backoff like any other throttled command.
+        """
+        attempt = 0
+        while True:
+            self.governor.wait()
+            start = perf_counter()
+            self.login_refused = False
+            opened = False
+            try:
+                host, port, tls = imap_address(self.imap_server)
+                if tls:
+                    self.imap = imaplib.IMAP4_SSL(host, port)
+                elif IMAP_ALLOW_PLAINTEXT:
+                    self.imap = imaplib.IMAP4(host, port)
+                else:
+                    raise ValueError('Plaintext IMAP is disabled (set IMAP_ALLOW_PLAINTEXT=1)')
+                opened = True
+                self.imap.login(self.email_address, self.app_password)
+                IMAP_LOGIN_SECONDS.observe(perf_counter() - start, 'ok')
+                logger.info(f"Connected to {self.imap_server}")
+                return True
+            except Exception as e:
+                IMAP_LOGIN_SECONDS.observe(perf_counter() - start, 'error')
+                self.disconnect()
+                self.imap = None
+                if is_throttled(e) and self._throttled('login', attempt, e):
+                    attempt += 1
+                    continue
+                # A NO to LOGIN, as opposed to a network or TLS failure
+                self.login_refused = (opened and isinstance(e, imaplib.IMAP4.error)
+                                      and not isinstance(e, imaplib.IMAP4.abort))
+                logger.error(f"IMAP connection failed: {e}")
+                return False
+    
+    def _timed(self, command: str, func, *args) -> Tuple[str, List]:
+        """Run one IMAP command, recording its latency and failures.
+
+        The account's governor paces the command, and a throttled command is
+        retried after a jittered exponential backoff. A throttled command
+        that dropped the connection is not retried.
+        """
+        attempt = 0
+        while True:
+            self.governor.wait()
+            start = perf_counter()
+            try:
+                result = func(*args)
+            except Exception as e:
+                IMAP_COMMAND_SECONDS.observe(perf_counter() - start, command)
+                IMAP_COMMAND_ERRORS.inc(command)
+                if is_throttled(e) and self._throttled(command, attempt, e,
+                                                       retry=not isinstance(e, imaplib.IMAP4.abort)):
+                    attempt += 1
+                    continue
+                raise
+            IMAP_COMMAND_SECONDS.observe(perf_counter() - start, command)
+            if result[0] == 'OK':
+                return result
+            IMAP_COMMAND_ERRORS.inc(command)
+            if not (is_throttled(result[1]) and self._throttled(command, attempt, result[1])):
+                return result
+            attempt += 1
+    
+    def _throttled(self, command: str, attempt: int, detail, retry: bool = True) -> bool:
+        """Record a throttled command; True if it should be retried"""
+        event = self.governor.throttled(command, attempt, detail, retry)
+        self.throttle_events.append(event)
+        IMAP_THROTTLES.inc(command, 'gave_up' if event.gave_up else 'retried')
+        if event.gave_up:
+            logger.error(f"IMAP {command} for {self.email_address} throttled, giving up after "
+                         f"{event.attempt} attempts: {event.detail}")
             return False
+        logger.warning(f"IMAP {command} for {self.email_address} throttled, retrying in {event.delay:.1f}s")
+        return True
     
     def disconnect(self):
         """Disconnect from IMAP server"""
         if self.imap:
             try:
                 self.imap.close()
+            except:
+                pass
+            try:
                 self.imap.logout()
             except:
                 pass
     
-    def fetch_unread_emails(self, folder: str = 'INBOX') -> List[Dict]:
-        """Fetch unread emails from specified folder"""
+    def fetch_unread_emails(self, folder: str = 'INBOX', batch_size: Optional[int] = None) -> List[Dict]:
+        """Fetch unread emails from specified folder.
+
+        With ``batch_size`` set, messages are fetched in batched UID FETCH
+        commands via BODY.PEEK, so they are not implicitly flagged as seen.
+        """
         if not self.imap:
             return []
         
+        if batch_size:
+            return list(self.iter_unread_emails(folder, batch_size))
+        
         try:
-            self.imap.select(folder)
-            status, messages = self.imap.search(None, 'UNSEEN')
+            self._timed('select', self.imap.select, folder)
+            status, messages = self._timed('search', self.imap.search, None, 'UNSEEN')
             if status != 'OK':
                 return []
             
@@ -177,41 +452,11 @@ class EmailParser:
             
             for email_id in email_ids:
                 try:
-                    status, msg_data = self.imap.fetch(email_id, '(RFC822)')
+                    status, msg_data = self._timed('fetch', self.imap.fetch, email_id, '(RFC822)')
                     if status != 'OK':
                         continue
                     
-                    raw_email = msg_data[0][1]
-                    email_message = email.message_from_bytes(raw_email)
-                    
-                    # Decode subject
-                    subject, encoding = decode_header(email_message['Subject'])[0]
-                    if isinstance(subject, bytes):
-                        subject = subject.decode(encoding or 'utf-8')
-                    
-                    # Get body
-                    body = self._get_email_body(email_message)
-                    
-                    # Get sender
-                    sender, _ = decode_header(email_message['From'])[0]
-                    if isinstance(sender, bytes):
-                        sender = sender.decode('utf-8')
-                    
-                    # Get date
-                    date_tuple = email.utils.parsedate_tz(email_message['Date'])
-                    if date_tuple:
-                        dt = datetime(*date_tuple[:6], tzinfo=timezone.utc)
-                    else:
-                        dt = datetime.now(timezone.utc)
-                    
-                    emails.append({
-                        'id': email_id.decode(),
-                        'subject': subject or '',
-                        'sender': sender or '',
-                        'body': body,
-                        'date': dt,
-                        'raw': raw_email.decode('utf-8', errors='ignore')
-                    })
+                    emails.append(self.parse_raw_email(email_id.decode(), msg_data[0][1]))
                 except Exception as e:
                     logger.error(f"Error parsing email {email_id}: {e}")
                     continue
@@ -221,6 +466,391 @@ class EmailParser:
             logger.error(f"Error fetching emails: {e}")
             return []
     
+    def iter_unread_emails(self, folder: str = 'INBOX', batch_size: int = FETCH_BATCH_SIZE,
+                           prefilter: Optional[str] = None, fetch_mode: str = 'full',
+                           keep_raw: bool = True) -> Iterator[Dict]:
+        """Yield unread emails batch by batch as each FETCH response arrives.
+
+        ``prefilter`` ('search' or 'headers') skips downloading mail that no
+        template sender matches; see PREFILTER_MODES. ``fetch_mode`` and
+        ``keep_raw`` are passed on to _fetch_batch.
+        """
+        if not self.imap:
+            return
+        
+        try:
+            self._timed('select', self.imap.select, folder)
+            status, messages = self._timed('search', self.imap.uid, 'SEARCH', None,
+                                           *self._search_keys('UNSEEN', prefilter))
+            if status != 'OK':
+                return
+            uids = messages[0].split()
+        except Exception as e:
+            logger.error(f"Error searching emails: {e}")
+            return
+        
+        yield from self.iter_emails_by_uid(uids, batch_size, prefilter, fetch_mode, keep_raw)
+    
+    def iter_emails_by_uid(self, uids: List, batch_size: int = FETCH_BATCH_SIZE,
+                           prefilter: Optional[str] = None, fetch_mode: str = 'full',
+                           keep_raw: bool = True) -> Iterator[Dict]:
+        """Fetch messages by UID, at most ``batch_size`` messages per FETCH command"""
+        for chunk in self._batches(uids, batch_size):
+            if prefilter == 'headers':
+                candidates = self._sender_candidates(chunk)
+                # Without the headers, fall back to fetching the whole chunk
+                chunk = chunk if candidates is None else candidates
+            if chunk:
+                yield from self._measured_fetch(chunk, fetch_mode, keep_raw) or []
+    
+    def iter_new_emails(self, checkpoints, folder: str = 'INBOX', batch_size: int = FETCH_BATCH_SIZE,
+                        prefilter: Optional[str] = None, fetch_mode: str = 'full',
+                        keep_raw: bool = True) -> Iterator[Dict]:
+        """Yield messages that arrived since the last checkpoint for this folder.
+
+        Only ``UID n+1:*`` is searched while the folder's UIDVALIDITY matches
+        the stored one; otherwise the whole folder is rescanned. The
+        checkpoint advances once the caller has consumed every fetched batch,
+        and stops short of the first batch that failed to fetch.
+        """
+        if not self.imap:
+            return
+        
+        try:
+            uidvalidity = self._select_uidvalidity(folder)
+            saved = checkpoints.get(self.imap_server, self.email_address, folder)
+            if saved and saved[0] == uidvalidity:
+                last_uid = saved[1]
+                criteria = f'UID {last_uid + 1}:*'
+            else:
+                if saved:
+                    logger.info(f"UIDVALIDITY changed for {folder}, rescanning")
+                last_uid = 0
+                criteria = 'ALL'
+            status, messages = self._timed('search', self.imap.uid, 'SEARCH', None,
+                                           *self._search_keys(criteria, prefilter))
+            if status != 'OK':
+                return
+            # "n+1:*" always matches the newest message, even if it is <= n
+            uids = sorted(u for u in map(int, messages[0].split()) if u > last_uid)
+        except Exception as e:
+            logger.error(f"Error searching new emails: {e}")
+            return
+        
+        high_uid = last_uid
+        for chunk in self._batches(uids, batch_size):
+            candidates = self._sender_candidates(chunk) if prefilter == 'headers' else chunk
+            if candidates is None:
+                break
+            batch = self._measured_fetch(candidates, fetch_mode, keep_raw) if candidates else []
+            if batch is None:
+                break
+            yield from batch
+            high_uid = chunk[-1]
+        
+        if saved != (uidvalidity, high_uid):
+            checkpoints.save(self.imap_server, self.email_address, folder, uidvalidity, high_uid)
+    
+    def _batches(self, uids: List, batch_size: int) -> Iterator[List]:
+        """Split ``uids`` into batches of at most ``batch_size``, sized by the governor from earlier FETCHes"""
+        start = 0
+        while start < len(uids):
+            size = self.governor.batch.next_size(batch_size)
+            yield uids[start:start + size]
+            start += size
+    
+    def _measured_fetch(self, uids: List, fetch_mode: str, keep_raw: bool) -> Optional[List[Dict]]:
+        """_fetch_batch, reporting its latency and bytes to the batch sizer"""
+        start = perf_counter()
+        fetched = self.fetched_bytes
+        throttled = len(self.throttle_events)
+        batch = self._fetch_batch(uids, fetch_mode, keep_raw)
+        # Backoff sleeps say nothing about how long a batch takes
+        if batch is not None and len(self.throttle_events) == throttled:
+            self.governor.batch.observe(len(uids), perf_counter() - start, self.fetched_bytes - fetched)
+        return batch
+    
+    def _search_keys(self, criteria: str, prefilter: Optional[str]) -> Tuple[str, ...]:
+        """SEARCH keys for ``criteria``, ANDed with the template senders in 'search' mode"""
+        if prefilter == 'search':
+            senders = get_compiled_templates().search_criteria()
+            if senders:
+                return (criteria, senders)
+        return (criteria,)
+    
+    def _sender_candidates(self, uids: List) -> Optional[List]:
+        """UIDs among ``uids`` whose From header matches a template sender.
+
+        Only the header fields are downloaded. Returns None if the FETCH failed.
+        """
+        try:
+            status, msg_data = self._timed('fetch', self.imap.uid, 'FETCH', compact_id_set(uids),
+                                           '(UID BODY.PEEK[HEADER.FIELDS (FROM SUBJECT DATE)])')
+        except Exception as e:
+            logger.error(f"Error fetching headers of {len(uids)} emails: {e}")
+            return None
+        if status != 'OK':
+            return None
+        
+        compiled = get_compiled_templates()
+        candidates = set()
+        for _, uid, header in _iter_fetch_literals(msg_data):
+            IMAP_FETCH_BYTES.inc(amount=len(header))
+            try:
+                sender, encoding = decode_header(email.message_from_bytes(header)['From'] or '')[0]
+                if isinstance(sender, bytes):
+                    sender = sender.decode(encoding or 'utf-8', errors='ignore')
+            except Exception:
+                sender = ''
+            if compiled.matches_sender(sender):
+                candidates.add(uid)
+        kept = [uid for uid in uids if _uid_text(uid) in candidates]
+        PREFILTER_SKIPPED.inc(amount=len(uids) - len(kept))
+        return kept
+    
+    def _select_uidvalidity(self, folder: str) -> int:
+        """Select a folder and return its UIDVALIDITY"""
+        self._timed('select', self.imap.select, folder)
+        _, data = self.imap.response('UIDVALIDITY')
+        if not data or data[0] is None:
+            _, data = self.imap.status(folder, '(UIDVALIDITY)')
+            m = re.search(rb'UIDVALIDITY (\d+)', data[0] or b'')
+            return int(m.group(1)) if m else 0
+        return int(data[0])
+
+    def supports_idle(self) -> bool:
+        """Whether the server advertises the IDLE extension (RFC 2177)"""
+        return bool(self.imap) and 'IDLE' in getattr(self.imap, 'capabilities', ())
+
+    def idle(self, timeout: float, stop: Optional[threading.Event] = None) -> bool:
+        """Wait in IDLE on the selected folder until new mail, ``timeout`` or ``stop``.
+
+        Returns True once the server reports EXISTS. imaplib has no IDLE
+        command, so the exchange is written by hand on the session socket;
+        raises imaplib.IMAP4.abort if the connection drops.
+        """
+        imap = self.imap
+        tag = imap._new_tag()
+        imap.send(tag + b' IDLE\r\n')
+        line = imap.readline()
+        if not line.startswith(b'+'):
+            raise imaplib.IMAP4.error(f"IDLE refused: {line.strip()!r}")
+
+        arrived = False
+        deadline = monotonic() + timeout
+        sock = imap.sock
+        try:
+            while not arrived and not (stop is not None and stop.is_set()):
+                remaining = deadline - monotonic()
+                if remaining <= 0:
+                    break
+                # Wake up every second so ``stop`` is noticed promptly
+                pending = getattr(sock, 'pending', lambda: 0)()
+                if not pending and not select.select([sock], [], [], min(remaining, 1.0))[0]:
+                    continue
+                for line in self._idle_lines(sock):
+                    if line.startswith(b'* BYE'):
+                        raise imaplib.IMAP4.abort(f"Server closed IDLE: {line.strip()!r}")
+                    if line.startswith(b'*') and line.rstrip().upper().endswith(b'EXISTS'):
+                        arrived = True
+        finally:
+            sock.setblocking(True)
+
+        imap.send(b'DONE\r\n')
+        while True:
+            line = imap.readline()
+            if not line:
+                raise imaplib.IMAP4.abort('Connection closed while ending IDLE')
+            if line.startswith(tag):
+                break
+            if line.startswith(b'*') and line.rstrip().upper().endswith(b'EXISTS'):
+                arrived = True
+        return arrived
+
+    def _idle_lines(self, sock) -> Iterator[bytes]:
+        """Read the untagged lines the server has sent so far without blocking"""
+        sock.setblocking(False)
+        partial = b''
+        received = False
+        while True:
+            try:
+                chunk = self.imap.readline()
+            except (BlockingIOError, ssl.SSLWantReadError):
+                chunk = None
+            if not chunk:
+                if not received and not partial and chunk is not None:
+                    raise imaplib.IMAP4.abort('Connection closed during IDLE')
+                break
+            received = True
+            partial += chunk
+            if partial.endswith(b'\n'):
+                yield partial
+                partial = b''
+        sock.setblocking(True)
+        if partial:
+            # Finish a line cut short by the non-blocking read
+            yield partial + self.imap.readline()
+
+    def _fetch_batch(self, uids: List, fetch_mode: str = 'full', keep_raw: bool = True) -> Optional[List[Dict]]:
+        """Fetch one batch of messages by UID, or None if the FETCH failed.
+
+        ``fetch_mode='text'`` downloads only the headers and the text part;
+        see _fetch_text_batch. Without ``keep_raw`` the 'raw' field is empty.
+        """
+        if fetch_mode == 'text':
+            return self._fetch_text_batch(uids, keep_raw)
+        try:
+            status, msg_data = self._timed('fetch', self.imap.uid, 'FETCH', compact_id_set(uids), '(UID BODY.PEEK[])')
+        except Exception as e:
+            logger.error(f"Error fetching batch of {len(uids)} emails: {e}")
+            return None
+        if status != 'OK':
+            return None
+        
+        emails = []
+        for seq, uid, raw_email in _iter_fetch_literals(msg_data):
+            IMAP_FETCH_BYTES.inc(amount=len(raw_email))
+            self.fetched_bytes += len(raw_email)
+            IMAP_FETCH_MESSAGES.inc()
+            try:
+                email_data = self.parse_raw_email(seq, raw_email, keep_raw)
+            except Exception as e:
+                logger.error(f"Error parsing email UID {uid}: {e}")
+                continue
+            email_data['uid'] = uid
+            emails.append(email_data)
+        return emails
+    
+    def _fetch_text_batch(self, uids: List, keep_raw: bool = True) -> Optional[List[Dict]]:
+        """Fetch one batch downloading only headers and the first text/plain part.
+
+        BODYSTRUCTURE picks the section _get_email_body would read, then one
+        FETCH per distinct section pulls the headers and that section, and
+        the transfer encoding is undone locally. Messages whose structure
+        cannot be read are fetched in full. 'raw' holds only the fetched
+        headers, or nothing without ``keep_raw``.
+        """
+        sections = self._fetch_text_sections(uids)
+        if sections is None:
+            return None
+        
+        by_section = {}
+        for uid in uids:
+            key = _uid_text(uid)
+            if key in sections:
+                # Messages without a text/plain part only need their headers
+                part = sections[key]
+                by_section.setdefault(part[0] if part else None, []).append(uid)
+        
+        emails = {}
+        for section, group in by_section.items():
+            items = 'UID BODY.PEEK[HEADER.FIELDS (FROM SUBJECT DATE MESSAGE-ID)]'
+            if section:
+                items += f' BODY.PEEK[{section}]'
+            try:
+                status, msg_data = self._timed('fetch', self.imap.uid, 'FETCH', compact_id_set(group), f'({items})')
+            except Exception as e:
+                logger.error(f"Error fetching text parts of {len(group)} emails: {e}")
+                return None
+            if status != 'OK':
+                return None
+            for seq, uid, items in _iter_fetch_sections(msg_data):
+                header = next((v for k, v in items.items() if b'HEADER' in k), b'')
+                payload = next((v for k, v in items.items() if b'HEADER' not in k), b'')
+                IMAP_FETCH_BYTES.inc(amount=len(header) + len(payload))
+                self.fetched_bytes += len(header) + len(payload)
+                IMAP_FETCH_MESSAGES.inc()
+                try:
+                    start = perf_counter()
+                    body = decode_transfer_encoding(payload, section and sections[uid][1]).decode('utf-8', errors='ignore')
+                    _STAGE_MIME_DECODE.observe(perf_counter() - start)
+                    email_data = self._header_fields(seq, email.message_from_bytes(header))
+                except Exception as e:
+                    logger.error(f"Error parsing email UID {uid}: {e}")
+                    continue
+                email_data.update(body=body, uid=uid,
+                                  raw=header.decode('utf-8', errors='ignore') if keep_raw else '')
+                emails[uid] = email_data
+        
+        unstructured = [uid for uid in uids if _uid_text(uid) not in sections]
+        if unstructured:
+            emails.update((e['uid'], e) for e in self._fetch_batch(unstructured, 'full', keep_raw) or [])
+        return [emails[_uid_text(uid)] for uid in uids if _uid_text(uid) in emails]
+    
+    def _fetch_text_sections(self, uids: List) -> Optional[Dict[str, Tuple[str, str]]]:
+        """Map UID -> (body section, transfer encoding) from BODYSTRUCTURE, or None if the FETCH failed.
+
+        UIDs whose structure has no text/plain part map to None; UIDs whose
+        structure could not be read are left out.
+        """
+        try:
+            status, msg_data = self._timed('fetch', self.imap.uid, 'FETCH', compact_id_set(uids),
+                                           '(UID BODYSTRUCTURE)')
+        except Exception as e:
+            logger.error(f"Error fetching structure of {len(uids)} emails: {e}")
+            return None
+        if status != 'OK':
+            return None
+        
+        sections = {}
+        for line in msg_data:
+            # Structures holding literals arrive as tuples; those fall back to a full fetch
+            if not isinstance(line, bytes):
+                continue
+            uid = _FETCH_UID_RE.search(line)
+            start = line.find(b'BODYSTRUCTURE (')
+            if not uid or start < 0:
+                continue
+            try:
+                structure = parse_imap_list(line[start + len(b'BODYSTRUCTURE '):])
+                part = find_text_part(structure)
+            except ValueError as e:
+                logger.warning(f"Unreadable BODYSTRUCTURE for UID {uid.group(1).decode()}: {e}")
+                continue
+            sections[uid.group(1).decode()] = part
+        return sections
+    
+    def parse_raw_email(self, email_id: str, raw_email: bytes, keep_raw: bool = True) -> Dict:
+        """Decode an RFC822 message into the dict consumed by the parser"""
+        email_message = email.message_from_bytes(raw_email)
+        
+        # Get body
+        start = perf_counter()
+        body = self._get_email_body(email_message)
+        _STAGE_MIME_DECODE.observe(perf_counter() - start)
+        
+        email_data = self._header_fields(email_id, email_message)
+        email_data['body'] = body
+        email_data['raw'] = raw_email.decode('utf-8', errors='ignore') if keep_raw else ''
+        return email_data
+    
+    def _header_fields(self, email_id: str, email_message) -> Dict:
+        """Subject, sender, date and Message-ID of a parsed message or header block"""
+        # Decode subject
+        subject, encoding = decode_header(email_message['Subject'])[0]
+        if isinstance(subject, bytes):
+            subject = subject.decode(encoding or 'utf-8')
+        
+        # Get sender
+        sender, _ = decode_header(email_message['From'])[0]
+        if isinstance(sender, bytes):
+            sender = sender.decode('utf-8')
+        
+        # Get date
+        date_tuple = email.utils.parsedate_tz(email_message['Date'])
+        if date_tuple:
+            dt = datetime(*date_tuple[:6], tzinfo=timezone.utc)
+        else:
+            dt = datetime.now(timezone.utc)
+        
+        return {
+            'id': email_id,
+            'subject': subject or '',
+            'sender': sender or '',
+            'date': dt,
+            'message_id': (email_message['Message-ID'] or '').strip(),
+        }
+    
     def _get_email_body(self, msg) -> str:
         """Extract plain text body from email"""
         body = ""
@@ -250,9 +880,331 @@ class EmailParser:
     def mark_as_read(self, email_id: str):
         """Mark email as read"""
         try:
-            self.imap.store(email_id, '+FLAGS', '\\Seen')
+            self._timed('store', self.imap.store, email_id, '+FLAGS', '\\Seen')
         except Exception as e:
             logger.error(f"Error marking email as read: {e}")
+    
+    def mark_many_as_read(self, email_ids: Iterable, use_uid: bool = False) -> List[str]:
+        """Mark emails as read with one STORE over compacted ID ranges.
+
+        Returns the IDs that could not be flagged. If the combined command is
+        rejected, each range is retried alone to isolate the failing ones.
+        """
+        id_set = compact_id_set(email_ids)
+        if not id_set or self._store_seen(id_set, use_uid):
+            return []
+        
+        failed = []
+        for id_range in id_set.split(','):
+            if not self._store_seen(id_range, use_uid):
+                failed.extend(_expand_id_range(id_range))
+        if failed:
+            logger.error(f"Could not mark {len(failed)} emails as read: {compact_id_set(failed)}")
+        return failed
+    
+    def _store_seen(self, id_set: str, use_uid: bool) -> bool:
+        try:
+            if use_uid:
+                status, _ = self._timed('store', self.imap.uid, 'STORE', id_set, '+FLAGS', '(\\Seen)')
+            else:
+                status, _ = self._timed('store', self.imap.store, id_set, '+FLAGS', '\\Seen')
+            return status == 'OK'
+        except Exception as e:
+            logger.error(f"Error marking emails {id_set} as read: {e}")
+            return False
+
+
+_FETCH_SEQ_RE = re.compile(rb'^(\d+) \(')
+_FETCH_UID_RE = re.compile(rb'\bUID (\d+)')
+
+
+def imap_address(imap_server: str) -> Tuple[str, int, bool]:
+    """(host, port, TLS) from ``host``, ``host:port``, ``imaps://host:port`` or ``imap://host:port``"""
+    tls = not imap_server.startswith('imap://')
+    address = imap_server.split('://', 1)[-1]
+    default_port = imaplib.IMAP4_SSL_PORT if tls else imaplib.IMAP4_PORT
+    host, sep, port = address.rpartition(':')
+    # A bare IPv6 address has colons but no port; bracket it to add one
+    if not sep or not port.isdigit() or (':' in host and not host.startswith('[')):
+        return address.strip('[]'), default_port, tls
+    return host.strip('[]'), int(port), tls
+
+
+def compact_id_set(ids: Iterable) -> str:
+    """Compress message IDs into an IMAP sequence set, e.g. ``101:180,200``"""
+    nums = sorted({int(i) for i in ids})
+    ranges = []
+    for n in nums:
+        if ranges and n == ranges[-1][1] + 1:
+            ranges[-1][1] = n
+        else:
+            ranges.append([n, n])
+    return ','.join(str(lo) if lo == hi else f"{lo}:{hi}" for lo, hi in ranges)
+
+
+def _expand_id_range(id_range: str) -> List[str]:
+    """Expand one ``lo:hi`` element of a sequence set into its IDs"""
+    lo, _, hi = id_range.partition(':')
+    return [str(n) for n in range(int(lo), int(hi or lo) + 1)]
+
+
+def _uid_text(uid) -> str:
+    return uid.decode() if isinstance(uid, bytes) else str(uid)
+
+
+def _iter_fetch_literals(msg_data: List) -> Iterator[Tuple[str, str, bytes]]:
+    """Yield (sequence number, UID, literal) from a multi-message FETCH response"""
+    pending = None
+    for item in msg_data:
+        if isinstance(item, tuple):
+            if pending:
+                yield tuple(pending)
+            seq = _FETCH_SEQ_RE.match(item[0])
+            uid = _FETCH_UID_RE.search(item[0])
+            pending = [
+                seq.group(1).decode() if seq else '',
+                uid.group(1).decode() if uid else '',
+                item[1],
+            ]
+        elif pending and isinstance(item, bytes):
+            # Some servers send UID after the literal, e.g. b' UID 101)'
+            if not pending[1]:
+                uid = _FETCH_UID_RE.search(item)
+                if uid:
+                    pending[1] = uid.group(1).decode()
+            yield tuple(pending)
+            pending = None
+    if pending:
+        yield tuple(pending)
+
+
+_FETCH_ITEM_RE = re.compile(rb'(BODY\[[^\]]*\])(?:<\d+>)? \{\d+\}$')
+
+
+def _iter_fetch_sections(msg_data: List) -> Iterator[Tuple[str, str, Dict[bytes, bytes]]]:
+    """Yield (sequence number, UID, {item name: literal}) from a FETCH of several BODY items"""
+    current = None
+    for item in msg_data:
+        if isinstance(item, tuple):
+            seq = _FETCH_SEQ_RE.match(item[0])
+            if seq:
+                if current:
+                    yield tuple(current)
+                current = [seq.group(1).decode(), '', {}]
+            if current is None:
+                continue
+            uid = _FETCH_UID_RE.search(item[0])
+            if uid and not current[1]:
+                current[1] = uid.group(1).decode()
+            name = _FETCH_ITEM_RE.search(item[0])
+            current[2][name.group(1) if name else item[0]] = item[1]
+        elif current and isinstance(item, bytes):
+            # Closing b')', possibly carrying the UID
+            uid = _FETCH_UID_RE.search(item)
+            if uid and not current[1]:
+                current[1] = uid.group(1).decode()
+            yield tuple(current)
+            current = None
+    if current:
+        yield tuple(current)
+
+
+_IMAP_TOKEN_RE = re.compile(rb'\s*(?:(\()|(\))|"((?:[^"\\]|\\.)*)"|([^\s()"]+))')
+
+
+def parse_imap_list(data: bytes) -> List:
+    """Parse the first parenthesized IMAP list in ``data`` (e.g. a BODYSTRUCTURE).
+
+    Quoted strings and atoms become str, NIL becomes None. Raises ValueError
+    on malformed input or literals, which are not supported here.
+    """
+    stack = []
+    pos = 0
+    while pos < len(data):
+        m = _IMAP_TOKEN_RE.match(data, pos)
+        if not m or m.end() == pos:
+            raise ValueError(f"unexpected data at offset {pos}")
+        pos = m.end()
+        if m.group(1):
+            stack.append([])
+        elif m.group(2):
+            if not stack:
+                raise ValueError('unbalanced parenthesis')
+            done = stack.pop()
+            if not stack:
+                return done
+            stack[-1].append(done)
+        elif not stack:
+            raise ValueError('expected a list')
+        elif m.group(3) is not None:
+            stack[-1].append(re.sub(rb'\\(.)', rb'\1', m.group(3)).decode('utf-8', errors='replace'))
+        else:
+            atom = m.group(4).decode('ascii', errors='replace')
+            if atom.startswith('{'):
+                raise ValueError('literals are not supported')
+            stack[-1].append(None if atom.upper() == 'NIL' else atom)
+    raise ValueError('unterminated list')
+
+
+def find_text_part(structure: List) -> Optional[Tuple[str, str]]:
+    """(section, transfer encoding) of the part _get_email_body would read, from a BODYSTRUCTURE.
+
+    For multipart messages that is the first non-attachment, non-empty
+    text/plain part in walk order, descending into attached messages; a
+    single-part message is read whole, whatever its type.
+    """
+    if structure and isinstance(structure[0], list):
+        return _find_plain_part(structure, '')
+    return '1', _transfer_encoding(structure)
+
+
+def _find_plain_part(structure: List, prefix: str) -> Optional[Tuple[str, str]]:
+    number = 0
+    for part in structure:
+        if not isinstance(part, list):
+            break  # the multipart subtype follows the parts
+        number += 1
+        section = f"{prefix}{number}"
+        if isinstance(part[0], list):
+            found = _find_plain_part(part, section + '.')
+        elif _lower(part, 0) == 'message' and _lower(part, 1) == 'rfc822' and len(part) > 8 \
+                and isinstance(part[8], list):
+            inner = part[8]
+            if inner and isinstance(inner[0], list):
+                found = _find_plain_part(inner, section + '.')
+            else:
+                found = _plain_part(inner, section + '.1')
+        else:
+            found = _plain_part(part, section)
+        if found:
+            return found
+    return None
+
+
+def _plain_part(part: List, section: str) -> Optional[Tuple[str, str]]:
+    if _lower(part, 0) != 'text' or _lower(part, 1) != 'plain':
+        return None
+    if len(part) > 6 and str(part[6]) == '0':
+        return None  # empty, _get_email_body would move on
+    # text parts carry a line count, so the disposition is the tenth field
+    disposition = part[9] if len(part) > 9 else None
+    if isinstance(disposition, list) and disposition and str(disposition[0]).lower() == 'attachment':
+        return None
+    return section, _transfer_encoding(part)
+
+
+def _lower(part: List, index: int) -> str:
+    value = part[index] if len(part) > index else None
+    return value.lower() if isinstance(value, str) else ''
+
+
+def _transfer_encoding(part: List) -> str:
+    return _lower(part, 5) or '7bit'
+
+
+def decode_transfer_encoding(payload: bytes, encoding: str) -> bytes:
+    """Undo a Content-Transfer-Encoding the way email's get_payload(decode=True) does"""
+    encoding = (encoding or '').lower()
+    if encoding == 'base64':
+        try:
+            return binascii.a2b_base64(payload)
+        except binascii.Error:
+            # Lenient like the email package: pad and retry
+            return binascii.a2b_base64(payload + b'===')
+    if encoding == 'quoted-printable':
+        return quopri.decodestring(payload)
+    return payload
+
+
+_ETB_AMOUNT_RE = re.compile(r'ETB\s*([0-9,]+(?:\.\d+)?)', re.IGNORECASE)
+_LINK_RE = re.compile(r'https?://\S+')
+_CREDIT_WORD_RE = re.compile(r'\bcredit(?:ed|s)?\b')
+_DEBIT_WORD_RE = re.compile(r'\bdebit(?:ed|s)?\b')
+_PRIMARY_AMOUNT_RE = re.compile(
+    r'(?:You have transfer(?:ed|red)|has been debited with|has been credited with|'
+    r'was debited with|was credited with|debited with ETB|credited with ETB|transferred ETB)\s*'
+    r'(?:ETB\s*)?([0-9,]+(?:\.\d+)?)',
+    re.IGNORECASE
+)
+_SERVICE_FEE_RE = re.compile(
+    r'(S\.charge|Service(?:\s+charge)?|service fee|service charge)[^\dE]{0,30}ETB\s*([0-9,]+(?:\.\d+)?)',
+    re.IGNORECASE
+)
+_VAT_PERCENT_RE = re.compile(r'([0-9]{1,3})%\s*VAT(?:\s+of)?\s*(?:ETB)?\s*([0-9,]+(?:\.\d+)?)', re.IGNORECASE)
+_VAT_RE = re.compile(r'VAT(?:\s*(?:of)?)\s*(?:ETB)?\s*([0-9,]+(?:\.\d+)?)', re.IGNORECASE)
+_TOTAL_RE = re.compile(r'(?:total(?:\s+of)?|with a total of|total:)\s*ETB\s*([0-9,]+(?:\.\d+)?)', re.IGNORECASE)
+
+
+class ParseContext:
+    """Facts about one message body, computed once and shared by every extraction stage.
+
+    The lowercased body is built once; keyword positions, ETB amounts and
+    links are found on first use and kept, so later stages reuse them
+    instead of rescanning. ``may_contain`` lets a stage skip a
+    case-insensitive regex whose literal text is absent: for ASCII bodies
+    lowercase substring search is exact, other bodies always run the regex.
+    """
+
+    __slots__ = ('body', 'lower', 'ascii', 'aligned', '_hits', '_amounts', '_links')
+
+    def __init__(self, body: str):
+        self.body = body
+        self.lower = body.lower()
+        self.ascii = body.isascii()
+        # lower() can change the length of some non-ASCII text
+        self.aligned = len(self.lower) == len(body)
+        self._hits = {}
+        self._amounts = None
+        self._links = None
+
+    def hits(self, keyword: str) -> Tuple[int, ...]:
+        """Positions of ``keyword`` (lowercase) in the lowercased body"""
+        found = self._hits.get(keyword)
+        if found is None:
+            positions = []
+            lower = self.lower
+            pos = lower.find(keyword)
+            while pos != -1:
+                positions.append(pos)
+                pos = lower.find(keyword, pos + 1)
+            found = self._hits[keyword] = tuple(positions)
+        return found
+
+    def has(self, keyword: str) -> bool:
+        """Whether the lowercased body contains ``keyword``"""
+        found = self._hits.get(keyword)
+        if found is not None:
+            return bool(found)
+        return keyword in self.lower
+
+    def may_contain(self, keyword: str) -> bool:
+        """False only if no case-insensitive match of ``keyword`` can exist"""
+        return not self.ascii or keyword in self.lower
+
+    def has_word(self, pattern: Pattern, keyword: str) -> bool:
+        """Whether ``pattern`` matches the lowercased body at a hit of ``keyword``"""
+        lower = self.lower
+        return any(pattern.match(lower, pos) for pos in self.hits(keyword))
+
+    def window(self, start: int, end: int) -> str:
+        """Lowercased ``body[start:end]``"""
+        if self.aligned:
+            return self.lower[max(0, start):end]
+        return self.body[max(0, start):end].lower()
+
+    @property
+    def amounts(self) -> List[Tuple[int, str]]:
+        """(position, digits) of every 'ETB <amount>' in the body"""
+        if self._amounts is None:
+            self._amounts = [(m.start(), m.group(1)) for m in _ETB_AMOUNT_RE.finditer(self.body)] \
+                if self.may_contain('etb') else []
+        return self._amounts
+
+    @property
+    def links(self) -> List[str]:
+        if self._links is None:
+            self._links = _LINK_RE.findall(self.body) if 'http' in self.lower else []
+        return self._links
 
 
 def safe_float(amount_str) -> float:
@@ -267,80 +1219,69 @@ def safe_float(amount_str) -> float:
     return float(m.group(1)) if m else 0.0
 
 
-def match_template(sender: str, body: str) -> Optional[Dict]:
+def match_template(sender: str, body: str, compiled: Optional[CompiledTemplates] = None) -> Optional[Dict]:
     """Match email to bank template"""
-    sl = (sender or '').lower()
-    bl = (body or '').lower()
-    
-    for template in TEMPLATES:
-        # Check sender
-        if any(s.lower() in sl for s in template.get('senders', [])):
-            return template
-        
-        # Check body patterns
-        if any(re.search(pat, bl, re.IGNORECASE) for pat in template.get('body_patterns', [])):
-            return template
-    
-    return None
+    return (compiled or get_compiled_templates()).match(sender, body)
 
 
-def extract_fields(template: Dict, body: str) -> Dict:
+def extract_fields(template: Dict, body: str, compiled: Optional[CompiledTemplates] = None) -> Dict:
     """Extract fields from SMS body using template patterns"""
     data = {}
-    for field, pats in template.get('fields', {}).items():
+    for field, pats in (compiled or get_compiled_templates()).field_patterns(template):
         for pat in pats:
-            try:
-                m = re.search(pat, body, re.IGNORECASE)
-                if m:
-                    data[field] = m.group(1).strip() if m.lastindex and m.group(1) else ''
-                    break
-            except re.error:
-                continue
+            m = pat.search(body)
+            if m:
+                data[field] = m.group(1).strip() if m.lastindex and m.group(1) else ''
+                break
     return data
 
 
-def is_near_total(match_obj, body: str) -> bool:
+def is_near_total(match_obj, body: str, ctx: Optional[ParseContext] = None) -> bool:
     """Check if match is near 'total' keyword (to ignore)"""
     if not match_obj:
         return False
-    try:
-        start = match_obj.start()
-        context = body[max(0, start-30):start].lower()
-        return 'total' in context or 'with a total' in context or 'total of' in context
-    except:
+    ctx = ctx or ParseContext(body)
+    if not ctx.has('total'):
         return False
+    start = match_obj.start()
+    # 'with a total' and 'total of' both contain 'total'
+    return 'total' in ctx.window(start - 30, start)
 
 
-def extract_vat_and_service(body: str, principal_amount: Optional[float] = None) -> Tuple[float, float, Optional[float]]:
+def extract_vat_and_service(body: str, principal_amount: Optional[float] = None,
+                            ctx: Optional[ParseContext] = None) -> Tuple[float, float, Optional[float]]:
     """Extract VAT and service fees from SMS body"""
+    ctx = ctx or ParseContext(body)
     vat = 0.0
     service = 0.0
     total = None
     
     # Service fee
-    for m_s in re.finditer(r'(S\.charge|Service(?:\s+charge)?|service fee|service charge)[^\dE]{0,30}ETB\s*([0-9,]+(?:\.\d+)?)', body, re.IGNORECASE):
-        if is_near_total(m_s, body):
-            continue
-        service = safe_float(m_s.group(2))
-        break
-    
-    # VAT with percentage
-    for m_vp in re.finditer(r'([0-9]{1,3})%\s*VAT(?:\s+of)?\s*(?:ETB)?\s*([0-9,]+(?:\.\d+)?)', body, re.IGNORECASE):
-        if is_near_total(m_vp, body):
-            continue
-        vat = safe_float(m_vp.group(2))
-        break
+    if ctx.may_contain('service') or ctx.may_contain('s.charge'):
+        for m_s in _SERVICE_FEE_RE.finditer(body):
+            if is_near_total(m_s, body, ctx):
+                continue
+            service = safe_float(m_s.group(2))
+            break
     
-    # VAT without percentage
-    if vat == 0.0:
-        for m_v in re.finditer(r'VAT(?:\s*(?:of)?)\s*(?:ETB)?\s*([0-9,]+(?:\.\d+)?)', body, re.IGNORECASE):
-            if is_near_total(m_v, body):
+    if ctx.may_contain('vat'):
+        # VAT with percentage
+        for m_vp in _VAT_PERCENT_RE.finditer(body):
+            if is_near_total(m_vp, body, ctx):
                 continue
-            vat = safe_float(m_v.group(1))
+            vat = safe_float(m_vp.group(2))
             break
+        
+        # VAT without percentage
+        if vat == 0.0:
+            for m_v in _VAT_RE.finditer(body):
+                if is_near_total(m_v, body, ctx):
+                    continue
+                vat = safe_float(m_v.group(1))
+                break
     
     # Total
-    m_tot = re.search(r'(?:total(?:\s+of)?|with a total of|total:)\s*ETB\s*([0-9,]+(?:\.\d+)?)', body, re.IGNORECASE)
+    m_tot = _TOTAL_RE.search(body) if ctx.may_contain('total') else None
     if m_tot:
         total = safe_float(m_tot.group(1))
     
@@ -361,65 +1302,128 @@ def extract_vat_and_service(body: str, principal_amount: Optional[float] = None)
     return vat, service, total
 
 
+# Keywords that introduce a counterparty, scanned in a single pass. Longer
+# anchors come first so "credited by" and "BY FROM" win over a bare "by".
+_COUNTERPARTY_ANCHOR_RE = re.compile(r'\b(credited by|by from|to|from|by)\s+', re.IGNORECASE)
+# Bounded name capture: a letter plus at most 80 name characters, no backtracking
+_COUNTERPARTY_NAME_RE = re.compile(r"[A-Za-z][A-Za-z.'\s-]{0,80}")
+_COUNTERPARTY_WORD_RE = re.compile(r'\S+')
+_COUNTERPARTY_RANK = {'to': 0, 'from': 1, 'credited by': 2, 'by from': 2, 'by': 3}
+# What must follow a 'to'/'from' name for it to count; 'by' names need nothing
+_COUNTERPARTY_TERMINATORS = {
+    'to': {'on', 'at', 'account', ',', '('},
+    'from': {'on', 'account', ',', '.', '('},
+}
+_COUNTERPARTY_STOPWORDS = frozenset([
+    'on', 'at', 'account', 'acc', 'with', 'for', 'via', 'ref', 'your', 'and',
+    'has', 'is', 'was', 'in', 'using', 'through', 'dated', 'date', 'to', 'from', 'by',
+])
+
+
+def _capture_counterparty(body: str, pos: int, anchor: str) -> str:
+    """Read the name starting at ``pos``, or '' if it is not confirmed"""
+    m = _COUNTERPARTY_NAME_RE.match(body, pos)
+    if not m:
+        return ''
+    words = []
+    terminator = body[m.end():m.end() + 1]
+    for word_match in _COUNTERPARTY_WORD_RE.finditer(body, pos, m.end()):
+        word = word_match.group(0)
+        if word.lower().rstrip('.,') in _COUNTERPARTY_STOPWORDS:
+            terminator = word.lower().rstrip('.,')
+            break
+        words.append(word)
+        # A full stop after anything longer than an initial ends the sentence
+        if word.endswith('.') and len(word.rstrip('.')) > 2:
+            terminator = '.'
+            break
+    if not words:
+        return ''
+    
+    required = _COUNTERPARTY_TERMINATORS.get(anchor)
+    if required is not None and terminator not in required:
+        if not ('.' in required and words[-1].endswith('.')):
+            return ''
+    return ' '.join(words).rstrip(' ,.')
+
+
 def extract_counterparty(body: str) -> str:
-    """Extract counterparty name from SMS body"""
-    patterns = [
-        r'\bto\s+([A-Z][A-Za-z.\'-\s]{1,80}?)\s+on\s+\d{2}/\d{2}/\d{4}',
-        r'\bto\s+([A-Z][A-Za-z.\'-\s]{1,80}?)\s+at\s+\d{2}:\d{2}:\d{2}',
-        r'\bto\s+([A-Z][A-Za-z.\'-\s]{1,80}?)\b,',
-        r'\bto\s+([A-Z][A-Za-z.\'-\s]{1,80}?)\s+on\b',
-        r'\bfrom\s+([A-Z][A-Za-z.\'-\s]{1,80}?)\s+on\b',
-        r'\bfrom\s+([A-Z][A-Za-z.\'-\s]{1,80}?)\b[,.]',
-        r'credited with ETB\s*[0-9,]+(?:\.\d+)?\s+by\s+([A-Z][A-Za-z.\'-\s]{1,80}?)\b',
-        r'credited by\s+([A-Z][A-Za-z.\'-\s]{1,80}?)\b',
-        r'by\s+([A-Z][A-Za-z.\'-\s]{1,80}?)\s*.',
-        r'BY FROM\s+([A-Z][A-Za-z.\'-\s]{1,80}?)\b',
-        r'BY\s+([A-Z][A-Za-z.\'-\s]{1,80}?)\b',
-        r'\bto\s+(.+?)\s+account number\b',
-        r'\bfrom\s+(.+?)\s+account\b',
-    ]
-    
-    for pat in patterns:
-        m = re.search(pat, body, re.IGNORECASE)
-        if m:
-            name = m.group(1).strip()
-            name = re.sub(r'[\s,.]+$', '', name)
-            if name.isupper():
-                name = name.title()
-            return name
-    
-    return ''
-
-
-def detect_tags(body: str) -> str:
+    """Extract counterparty name from SMS body.
+
+    Runs in linear time: one scan for the anchor keywords, then a bounded
+    capture after each anchor. 'to' names beat 'from' names, which beat
+    'by' names.
+    """
+    name = ''
+    best_rank = len(_COUNTERPARTY_RANK)
+    for m in _COUNTERPARTY_ANCHOR_RE.finditer(body):
+        anchor = m.group(1).lower()
+        rank = _COUNTERPARTY_RANK[anchor]
+        if rank >= best_rank:
+            continue
+        candidate = _capture_counterparty(body, m.end(), anchor)
+        if candidate:
+            name, best_rank = candidate, rank
+            if rank == 0:
+                break
+    
+    if name.isupper():
+        name = name.title()
+    return name
+
+
+def detect_tags(body: str, ctx: Optional[ParseContext] = None) -> str:
     """Detect transaction tags (ATM, PACKAGE)"""
+    ctx = ctx or ParseContext(body)
     tags = []
-    b = body.lower()
-    if 'atm' in b or 'withdraw' in b or 'withdrawal' in b:
+    if ctx.has('atm') or ctx.has('withdraw'):
         tags.append('ATM')
-    if 'package' in b:
+    if ctx.has('package'):
         tags.append('PACKAGE')
     return '|'.join(tags)
 
 
-def parse_email_transaction(email_data: Dict) -> Optional[ParsedTransaction]:
-    """Parse a single email into a transaction"""
+def parse_email_transaction(email_data: Dict, template: Optional[Dict] = None) -> Optional[ParsedTransaction]:
+    """Parse a single email into a transaction.
+
+    Pass ``template`` when the caller has already matched the message
+    against the current template set; matching and its counters are then
+    skipped.
+    """
     sender = email_data.get('sender', '')
     body = email_data.get('body', '').strip()
     date = email_data.get('date', datetime.now(timezone.utc))
     
+    # One template set for the whole message, even if a reload lands midway
+    compiled = get_compiled_templates()
+    
     # Match template
-    template = match_template(sender, body)
-    if not template:
-        return None
+    if template is None:
+        stage_start = perf_counter()
+        template = match_template(sender, body, compiled)
+        _STAGE_MATCH_TEMPLATE.observe(perf_counter() - stage_start)
+        if not template:
+            TEMPLATE_MISSES.inc()
+            return None
+        TEMPLATE_HITS.inc(template.get('name', ''))
+    template_name = template.get('name', '')
     
     # Extract fields
-    fields = extract_fields(template, body)
+    stage_start = perf_counter()
+    fields = extract_fields(template, body, compiled)
+    stage_end = perf_counter()
+    _STAGE_EXTRACT_FIELDS.observe(stage_end - stage_start)
+    for field in template.get('fields', {}):
+        if field not in fields:
+            TEMPLATE_FIELD_MISSES.inc(template_name, field)
+    
+    # Everything below reads the body through one shared context
+    ctx = ParseContext(body)
     
     # Determine bank name
     account_name = template.get('account_bank_tag', '')
     s_low = sender.lower()
-    b_low = body.lower()
+    b_low = ctx.lower
     
     if '127' in s_low or 'telebirr' in s_low:
         account_name = 'Telebirr'
@@ -435,43 +1439,43 @@ def parse_email_transaction(email_data: Dict) -> Optional[ParsedTransaction]:
     account_num = fields.get('account', '')
     
     # Extract amount
+    stage_start = perf_counter()
     amount = 0.0
     if 'amount' in fields and fields.get('amount'):
         amount = safe_float(fields.get('amount'))
     else:
-        m_primary = re.search(
-            r'(?:You have transfer(?:ed|red)|has been debited with|has been credited with|'
-            r'was debited with|was credited with|debited with ETB|credited with ETB|transferred ETB)\s*'
-            r'(?:ETB\s*)?([0-9,]+(?:\.\d+)?)',
-            body, re.IGNORECASE
-        )
+        m_primary = None
+        if ctx.may_contain('transfer') or ctx.may_contain('debited with') or ctx.may_contain('credited with'):
+            m_primary = _PRIMARY_AMOUNT_RE.search(body)
         if m_primary:
             amount = safe_float(m_primary.group(1))
         else:
-            matches = re.findall(r'ETB\s*([0-9,]+(?:\.\d+)?)', body, re.IGNORECASE)
+            matches = [value for _, value in ctx.amounts]
             if matches:
                 for mval in matches:
-                    idx = body.lower().find(mval)
+                    # First occurrence of the digits, which may precede the ETB match
+                    idx = ctx.lower.find(mval)
                     if idx != -1:
-                        context = body[max(0, idx-40):idx+len(mval)+40].lower()
-                        if 'balance' in context:
+                        if 'balance' in ctx.window(idx - 40, idx + len(mval) + 40):
                             continue
                         amount = safe_float(mval)
                         break
                 if amount == 0.0:
                     amount = safe_float(matches[0])
     
+    _STAGE_EXTRACT_AMOUNT.observe(perf_counter() - stage_start)
+    
     # Skip zero amounts
     if amount == 0.0:
+        ZERO_AMOUNT_DROPS.inc(template_name)
         return None
     
     # Determine transaction type
     tx_type = ''
-    low = body.lower()
-    if re.search(r'\bcredit(?:ed|s)?\b', low) or 'received' in low or 'credited with' in low:
+    if ctx.has_word(_CREDIT_WORD_RE, 'credit') or ctx.has('received') or ctx.has('credited with'):
         tx_type = 'credit'
-    if re.search(r'\bdebit(?:ed|s)?\b', low) or 'withdraw' in low or 'debited with' in low or \
-       'has been debited' in low or 'your account has been debited' in low:
+    if ctx.has_word(_DEBIT_WORD_RE, 'debit') or ctx.has('withdraw') or ctx.has('debited with') or \
+       ctx.has('has been debited'):
         tx_type = 'debit'
     
     # Apply sign for debit
@@ -479,17 +1483,25 @@ def parse_email_transaction(email_data: Dict) -> Optional[ParsedTransaction]:
         amount = -abs(amount)
     
     # Extract VAT and service fees
-    vat, service_fee, total = extract_vat_and_service(body, principal_amount=amount if amount != 0 else None)
+    stage_start = perf_counter()
+    vat, service_fee, total = extract_vat_and_service(body, principal_amount=amount if amount != 0 else None, ctx=ctx)
+    stage_end = perf_counter()
+    _STAGE_EXTRACT_VAT_AND_SERVICE.observe(stage_end - stage_start)
     
     # Extract counterparty
+    stage_start = stage_end
     title = extract_counterparty(body) or ''
     title = title.strip()
+    stage_end = perf_counter()
+    _STAGE_EXTRACT_COUNTERPARTY.observe(stage_end - stage_start)
     
     # Extract links
-    links = re.findall(r'https?://\S+', body)
+    links = ctx.links
     
     # Detect tags
-    tags = detect_tags(body)
+    stage_start = perf_counter()
+    tags = detect_tags(body, ctx)
+    _STAGE_DETECT_TAGS.observe(perf_counter() - stage_start)
     
     # Calculate confidence (simple heuristic)
     confidence = 0.0
@@ -507,6 +1519,7 @@ def parse_email_transaction(email_data: Dict) -> Optional[ParsedTransaction]:
     # Transaction ID
     transaction_id = fields.get('transaction_id', '')
     
+    TRANSACTIONS_PARSED.inc(template_name)
     return ParsedTransaction(
         amount=amount,
         account_name=account_name,
@@ -529,27 +1542,134 @@ def parse_email_transaction(email_data: Dict) -> Optional[ParsedTransaction]:
     )
 
 
-def parse_emails(imap_server: str, email_address: str, app_password: str) -> List[Dict]:
-    """Main function to fetch and parse emails"""
-    parser = EmailParser(imap_server, email_address, app_password)
+def parse_emails(imap_server: str, email_address: str, app_password: str,
+                 batch_size: Optional[int] = None, checkpoints=None, pool=None,
+                 folder: str = 'INBOX', cache=None, prefilter: Optional[str] = None,
+                 fetch_mode: str = 'full', keep_raw: bool = True, progress: Optional[Dict] = None) -> List[Dict]:
+    """Main function to fetch and parse emails.
+
+    Passing a ``checkpoints`` store switches from the UNSEEN search to an
+    incremental sync of messages newer than the stored UID high-watermark.
+    With a ``pool`` the IMAP session is borrowed from it instead of opened
+    and logged out for this call alone, and a parse ``cache`` skips messages
+    already parsed under the current templates. ``prefilter`` ('search' or
+    'headers') only downloads mail from known bank senders; messages that
+    would match on body patterns alone are then skipped. ``fetch_mode='text'``
+    downloads only headers and the text/plain part, and ``keep_raw=False``
+    leaves ``raw_email`` empty. A ``progress`` dict is filled in as by
+    iter_sync_mailbox. Raises LoginFailed if the login fails.
+    """
+    return list(iter_parse_emails(imap_server, email_address, app_password, batch_size=batch_size,
+                                  checkpoints=checkpoints, pool=pool, folder=folder, cache=cache,
+                                  prefilter=prefilter, fetch_mode=fetch_mode, keep_raw=keep_raw,
+                                  progress=progress))
+
+
+def iter_parse_emails(imap_server: str, email_address: str, app_password: str,
+                      batch_size: Optional[int] = None, checkpoints=None, pool=None,
+                      folder: str = 'INBOX', cache=None, prefilter: Optional[str] = None,
+                      fetch_mode: str = 'full', keep_raw: bool = True,
+                      progress: Optional[Dict] = None) -> Iterator[Dict]:
+    """Generator form of parse_emails, yielding transactions as they are parsed.
+
+    Fetch, MIME decoding and parsing run lazily, so with ``batch_size`` set
+    only one FETCH batch is held in memory at a time. Raises LoginFailed
+    if the login fails.
+    """
+    with mailbox_session(imap_server, email_address, app_password, pool) as parser:
+        if parser is None:
+            raise LoginFailed(f"IMAP login to {imap_server} failed")
+        yield from iter_sync_mailbox(parser, folder, batch_size, checkpoints, cache, progress,
+                                     prefilter=prefilter, fetch_mode=fetch_mode, keep_raw=keep_raw)
+
+
+@contextmanager
+def mailbox_session(imap_server: str, email_address: str, app_password: str,
+                    pool=None) -> Iterator[Optional[EmailParser]]:
+    """Connected parser for one mailbox, or None if login failed.
+
+    The session is borrowed from ``pool`` when given, otherwise it is opened
+    here and logged out on exit.
+    """
+    if pool is not None:
+        with pool.session(imap_server, email_address, app_password) as parser:
+            yield parser
+        return
     
+    parser = EmailParser(imap_server, email_address, app_password)
     if not parser.connect():
-        return []
+        yield None
+        return
+    
+    try:
+        yield parser
+    finally:
+        parser.disconnect()
+
+
+def iter_sync_mailbox(parser: EmailParser, folder: str = 'INBOX', batch_size: Optional[int] = None,
+                      checkpoints=None, cache=None, progress: Optional[Dict] = None,
+                      prefilter: Optional[str] = None, fetch_mode: str = 'full',
+                      keep_raw: bool = True) -> Iterator[Dict]:
+    """Fetch and parse one folder over an already connected parser.
+
+    With a parse ``cache``, messages seen before are served from it instead
+    of being parsed again. A ``progress`` dict gets its ``fetched`` and
+    ``parsed`` counters bumped as messages go through, ``throttled``
+    counts the commands the provider throttled, and ``unmarked`` lists the
+    ``email_id`` of yielded transactions whose message could not be flagged
+    as read, so it will come back on the next unread sync. ``prefilter``,
+    ``fetch_mode`` and ``keep_raw`` are passed on to the fetch methods; see
+    PREFILTER_MODES and FETCH_MODES.
+    """
+    parse = cache.parse if cache is not None else parse_email_transaction
+    if prefilter is not None and prefilter not in PREFILTER_MODES:
+        raise ValueError(f"Unknown prefilter {prefilter!r}, expected one of {PREFILTER_MODES}")
+    if fetch_mode not in FETCH_MODES:
+        raise ValueError(f"Unknown fetch mode {fetch_mode!r}, expected one of {FETCH_MODES}")
+    if checkpoints is not None:
+        emails = parser.iter_new_emails(checkpoints, folder, batch_size=batch_size or FETCH_BATCH_SIZE,
+                                        prefilter=prefilter, fetch_mode=fetch_mode, keep_raw=keep_raw)
+    elif batch_size or prefilter or fetch_mode != 'full' or not keep_raw:
+        emails = parser.iter_unread_emails(folder, batch_size=batch_size or FETCH_BATCH_SIZE, prefilter=prefilter,
+                                           fetch_mode=fetch_mode, keep_raw=keep_raw)
+    else:
+        emails = parser.fetch_unread_emails(folder)
+    # IDs of parsed emails (to their email_id), flagged as read in one STORE per batch
+    pending = {}
+    use_uid = False
+    flush_every = batch_size or FETCH_BATCH_SIZE
+    
+    def mark_pending():
+        failed = parser.mark_many_as_read(pending, use_uid=use_uid)
+        if failed and progress is not None:
+            progress.setdefault('unmarked', []).extend(pending[i] for i in failed if i in pending)
+        pending.clear()
     
     try:
-        emails = parser.fetch_unread_emails()
-        transactions = []
-        
         for email_data in emails:
-            transaction = parse_email_transaction(email_data)
+            transaction = parse(email_data)
+            if progress is not None:
+                progress['fetched'] = progress.get('fetched', 0) + 1
+                if transaction:
+                    progress['parsed'] = progress.get('parsed', 0) + 1
             if transaction:
-                transactions.append(asdict(transaction))
-                # Mark as read after successful parsing
-                parser.mark_as_read(email_data['id'])
+                start = perf_counter()
+                data = transaction.to_dict()
+                _STAGE_SERIALIZE.observe(perf_counter() - start)
+                yield data
+                use_uid = bool(email_data.get('uid'))
+                pending[str(int(email_data['uid'] if use_uid else email_data['id']))] = data['email_id']
+                if len(pending) >= flush_every:
+                    mark_pending()
         
-        return transactions
+        if pending:
+            mark_pending()
     finally:
-        parser.disconnect()
+        if progress is not None:
+            progress['throttled'] = progress.get('throttled', 0) + len(parser.throttle_events)
+        # Reported once; a pooled session keeps its list across syncs
+        del parser.throttle_events[:]
 
 
 if __name__ == '__main__':
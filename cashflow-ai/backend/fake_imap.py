@@ -0,0 +1,735 @@
+#!/usr/bin/env python3
+"""
+Stand-in IMAP4rev1 server for CashFlow AI
+Serves a generated per-bank mailbox to every account that logs in, with
+configurable size and per-command latency and optional TLS, so the sync
+path can be load-tested without a real mail account
+"""
+
+import argparse
+import bisect
+import email
+import email.utils
+import logging
+import random
+import re
+import select
+import socketserver
+import ssl
+import sys
+import threading
+import time
+import zlib
+from datetime import datetime, timedelta, timezone
+from email.message import Message
+from typing import Callable, List, Optional, Tuple
+
+from synthetic_corpus import generate_messages, to_rfc822
+
+logger = logging.getLogger(__name__)
+
+CAPABILITIES = 'IMAP4rev1 IDLE'
+SYSTEM_FLAGS = '\\Seen \\Answered \\Flagged \\Deleted \\Draft'
+
+_TOKEN_RE = re.compile(rb'\(|\)|"(?:[^"\\]|\\.)*"|[^\s()"]+')
+_FETCH_ITEM_RE = re.compile(r'(BODY(?:\.PEEK)?)\[([^\]]*)\](?:<(\d+)(?:\.(\d+))?>)?|[^\s()]+', re.IGNORECASE)
+_SECTION_RE = re.compile(r'^((?:\d+\.)*\d+)?\.?(.*)$')
+_LINE_END_RE = re.compile(rb'\r?\n')
+
+
+class CommandError(ValueError):
+    """Raised for a malformed or unsupported command, answered with BAD"""
+
+
+def _crlf(data: bytes) -> bytes:
+    return _LINE_END_RE.sub(b'\r\n', data)
+
+
+def _quote(value) -> str:
+    if value is None:
+        return 'NIL'
+    text = str(value).replace('\r', ' ').replace('\n', ' ')
+    return '"' + text.replace('\\', '\\\\').replace('"', '\\"') + '"'
+
+
+def _split_message(raw: bytes) -> Tuple[bytes, bytes]:
+    """(header block including the blank line, body) of a CRLF message"""
+    end = raw.find(b'\r\n\r\n')
+    if end < 0:
+        return raw, b''
+    return raw[:end + 4], raw[end + 4:]
+
+
+def _header_fields(header: bytes, names: List[str], exclude: bool = False) -> bytes:
+    """Header lines (with continuations) whose name is or, with ``exclude``, is not in ``names``"""
+    wanted = {name.upper() for name in names}
+    kept, keep = [], False
+    for line in header.split(b'\r\n'):
+        if not line:
+            continue
+        if line[:1] not in (b' ', b'\t'):
+            name = line.split(b':', 1)[0].strip().decode('ascii', errors='ignore').upper()
+            keep = (name in wanted) != exclude
+        if keep:
+            kept.append(line)
+    return b'\r\n'.join(kept) + b'\r\n\r\n' if kept else b'\r\n'
+
+
+def _addresses(value: Optional[str]) -> str:
+    pairs = email.utils.getaddresses([value]) if value else []
+    if not pairs:
+        return 'NIL'
+    rendered = []
+    for name, address in pairs:
+        mailbox, _, host = address.partition('@')
+        rendered.append(f"({_quote(name or None)} NIL {_quote(mailbox or None)} {_quote(host or None)})")
+    return '(' + ''.join(rendered) + ')'
+
+
+def envelope(message: Message) -> str:
+    """The ENVELOPE of a parsed message"""
+    sender = message.get('Sender') or message.get('From')
+    reply_to = message.get('Reply-To') or message.get('From')
+    return (f"({_quote(message.get('Date'))} {_quote(message.get('Subject'))} {_addresses(message.get('From'))} "
+            f"{_addresses(sender)} {_addresses(reply_to)} {_addresses(message.get('To'))} "
+            f"{_addresses(message.get('Cc'))} {_addresses(message.get('Bcc'))} "
+            f"{_quote(message.get('In-Reply-To'))} {_quote(message.get('Message-ID'))})")
+
+
+def body_structure(part: Message) -> str:
+    """The BODYSTRUCTURE of a parsed message or body part"""
+    if part.is_multipart():
+        children = ''.join(body_structure(child) for child in part.get_payload())
+        return f"({children} {_quote(part.get_content_subtype().upper())})"
+    maintype, subtype = part.get_content_maintype().upper(), part.get_content_subtype().upper()
+    params = part.get_params() or []
+    params = ' '.join(f"{_quote(k.upper())} {_quote(v)}" for k, v in params[1:])
+    params = f"({params})" if params else 'NIL'
+    encoding = _quote((part.get('Content-Transfer-Encoding') or '7BIT').upper())
+    disposition = part.get('Content-Disposition')
+    disposition = f"({_quote(disposition.split(';')[0].strip().upper())} NIL)" if disposition else 'NIL'
+    fields = f"{_quote(maintype)} {_quote(subtype)} {params} {_quote(part.get('Content-ID'))} " \
+             f"{_quote(part.get('Content-Description'))} {encoding}"
+    if maintype == 'MESSAGE' and subtype == 'RFC822' and isinstance(part.get_payload(), list):
+        inner = part.get_payload()[0]
+        body = _crlf(inner.as_bytes())
+        lines = body.count(b'\n')
+        return f"({fields} {len(body)} {envelope(inner)} {body_structure(inner)} {lines} NIL {disposition} NIL)"
+    body = _part_body(part)
+    if maintype == 'TEXT':
+        lines = body.count(b'\n')
+        return f"({fields} {len(body)} {lines} NIL {disposition} NIL)"
+    return f"({fields} {len(body)} NIL {disposition} NIL)"
+
+
+def _part_body(part: Message) -> bytes:
+    """Encoded body octets of a non-multipart part"""
+    return _split_message(_crlf(part.as_bytes()))[1]
+
+
+class FakeMessage:
+    """One stored message; the parsed form and BODYSTRUCTURE are built on first use"""
+
+    __slots__ = ('uid', 'raw', 'flags', '_parsed', '_structure')
+
+    def __init__(self, uid: int, raw: bytes):
+        self.uid = uid
+        self.raw = _crlf(raw)
+        self.flags = set()
+        self._parsed = None
+        self._structure = None
+
+    @property
+    def parsed(self) -> Message:
+        if self._parsed is None:
+            self._parsed = email.message_from_bytes(self.raw)
+        return self._parsed
+
+    @property
+    def structure(self) -> str:
+        if self._structure is None:
+            self._structure = body_structure(self.parsed)
+        return self._structure
+
+    def section(self, spec: str) -> bytes:
+        """Contents of BODY[spec]: '', HEADER, TEXT, HEADER.FIELDS (...), 1, 1.2, 2.HEADER, 1.MIME"""
+        path, text = _SECTION_RE.match(spec.strip()).groups()
+        text = text.strip().upper()
+        if not path:
+            header, body = _split_message(self.raw)
+            return self._text_section(header, body, text, self.raw)
+        part = self.parsed
+        for number in map(int, path.split('.')):
+            if part.get_content_type() == 'message/rfc822' and isinstance(part.get_payload(), list):
+                part = part.get_payload()[0]
+            if part.is_multipart():
+                children = part.get_payload()
+                if number > len(children):
+                    return b''
+                part = children[number - 1]
+            elif number != 1:
+                return b''
+        if text == 'MIME':
+            return _split_message(_crlf(part.as_bytes()))[0]
+        if text and part.get_content_type() == 'message/rfc822' and isinstance(part.get_payload(), list):
+            inner = _crlf(part.get_payload()[0].as_bytes())
+            header, body = _split_message(inner)
+            return self._text_section(header, body, text, inner)
+        if part.is_multipart():
+            return _split_message(_crlf(part.as_bytes()))[1]
+        return _part_body(part)
+
+    @staticmethod
+    def _text_section(header: bytes, body: bytes, text: str, whole: bytes) -> bytes:
+        if not text:
+            return whole
+        if text == 'HEADER':
+            return header
+        if text == 'TEXT':
+            return body
+        if text.startswith('HEADER.FIELDS'):
+            names = text[text.find('(') + 1:text.rfind(')')].split()
+            return _header_fields(header, names, exclude=text.startswith('HEADER.FIELDS.NOT'))
+        raise CommandError(f"Unsupported section {text}")
+
+
+class Mailbox:
+    """One account's INBOX.
+
+    Messages only ever get appended, so sequence numbers stay stable;
+    ``changed`` is notified on every delivery for IDLE sessions.
+    """
+
+    def __init__(self, raws: List[bytes], uidvalidity: int = 1):
+        self.uidvalidity = uidvalidity
+        self.messages = [FakeMessage(uid, raw) for uid, raw in enumerate(raws, 1)]
+        self.uids = [m.uid for m in self.messages]
+        self.changed = threading.Condition()
+
+    @property
+    def uidnext(self) -> int:
+        return self.uids[-1] + 1 if self.uids else 1
+
+    def deliver(self, raw: bytes) -> int:
+        with self.changed:
+            message = FakeMessage(self.uidnext, raw)
+            self.messages.append(message)
+            self.uids.append(message.uid)
+            self.changed.notify_all()
+        return message.uid
+
+    def resolve(self, id_set: str, by_uid: bool, count: Optional[int] = None) -> List[int]:
+        """Indexes of the messages in a sequence or UID set, e.g. ``1:5,9,20:*``"""
+        count = len(self.messages) if count is None else count
+        keys = self.uids[:count] if by_uid else None
+        largest = (keys[-1] if keys else 0) if by_uid else count
+        indexes = set()
+        for element in id_set.split(','):
+            lo, _, hi = element.partition(':')
+            try:
+                lo = largest if lo == '*' else int(lo)
+                hi = lo if not hi else largest if hi == '*' else int(hi)
+            except ValueError:
+                raise CommandError(f"Bad sequence set {id_set}")
+            lo, hi = min(lo, hi), max(lo, hi)
+            if by_uid:
+                indexes.update(range(bisect.bisect_left(keys, lo), bisect.bisect_right(keys, hi)))
+            else:
+                indexes.update(range(max(lo, 1) - 1, min(hi, count)))
+        return sorted(indexes)
+
+
+def _tokens(data: bytes) -> List:
+    """Atoms and quoted strings as str, parenthesized groups as nested lists"""
+    stack = [[]]
+    for match in _TOKEN_RE.finditer(data):
+        token = match.group()
+        if token == b'(':
+            stack.append([])
+        elif token == b')':
+            if len(stack) == 1:
+                raise CommandError('Unbalanced parentheses')
+            group = stack.pop()
+            stack[-1].append(group)
+        elif token.startswith(b'"'):
+            stack[-1].append(re.sub(rb'\\(.)', rb'\1', token[1:-1]).decode('utf-8', errors='replace'))
+        else:
+            stack[-1].append(token.decode('utf-8', errors='replace'))
+    if len(stack) != 1:
+        raise CommandError('Unbalanced parentheses')
+    return stack[0]
+
+
+class _Search:
+    """Compiles SEARCH keys into a predicate over (index, message)"""
+
+    def __init__(self, mailbox: Mailbox, count: int):
+        self.mailbox = mailbox
+        self.count = count
+
+    def compile(self, tokens: List) -> Callable[[int, FakeMessage], bool]:
+        tests = []
+        tokens = list(tokens)
+        while tokens:
+            tests.append(self._key(tokens))
+        return lambda i, m: all(test(i, m) for test in tests)
+
+    def _key(self, tokens: List) -> Callable[[int, FakeMessage], bool]:
+        token = tokens.pop(0)
+        if isinstance(token, list):
+            return self.compile(token)
+        key = token.upper()
+        if key == 'ALL':
+            return lambda i, m: True
+        if key in ('SEEN', 'UNSEEN', 'DELETED', 'UNDELETED', 'FLAGGED', 'UNFLAGGED', 'ANSWERED', 'UNANSWERED'):
+            flag = '\\' + key.replace('UN', '', 1).capitalize() if key.startswith('UN') else '\\' + key.capitalize()
+            negate = key.startswith('UN')
+            return lambda i, m: (flag in m.flags) != negate
+        if key in ('FROM', 'TO', 'SUBJECT', 'CC'):
+            needle = self._argument(tokens).lower()
+            return lambda i, m: needle in str(m.parsed.get(key) or '').lower()
+        if key in ('BODY', 'TEXT'):
+            needle = self._argument(tokens).lower().encode()
+            return lambda i, m: needle in m.raw.lower()
+        if key == 'UID':
+            wanted = set(self.mailbox.resolve(self._argument(tokens), True, self.count))
+            return lambda i, m: i in wanted
+        if key == 'NOT':
+            test = self._key(tokens)
+            return lambda i, m: not test(i, m)
+        if key == 'OR':
+            first, second = self._key(tokens), self._key(tokens)
+            return lambda i, m: first(i, m) or second(i, m)
+        if key[:1].isdigit() or key[:1] == '*':
+            wanted = set(self.mailbox.resolve(key, False, self.count))
+            return lambda i, m: i in wanted
+        raise CommandError(f"Unsupported search key {token}")
+
+    @staticmethod
+    def _argument(tokens: List) -> str:
+        if not tokens or isinstance(tokens[0], list):
+            raise CommandError('Missing search argument')
+        return tokens.pop(0)
+
+
+class _Session(socketserver.StreamRequestHandler):
+    """One client connection"""
+
+    def setup(self):
+        if isinstance(self.request, ssl.SSLSocket):
+            self.request.do_handshake()
+        super().setup()
+        self.account = None
+        self.mailbox = None
+        self.readonly = False
+        self.known = 0
+
+    def handle(self):
+        server = self.server
+        server.count('connections')
+        self._write(f"* OK [CAPABILITY {CAPABILITIES}] CashFlow fake IMAP ready\r\n".encode())
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            parts = line.rstrip(b'\r\n').split(b' ', 2)
+            if len(parts) < 2:
+                self._write(b'* BAD Missing command\r\n')
+                continue
+            tag, command = parts[0].decode(errors='replace'), parts[1].decode(errors='replace').upper()
+            args = parts[2] if len(parts) > 2 else b''
+            server.count(command)
+            if server.latency:
+                time.sleep(server.latency)
+            try:
+                done = self._dispatch(tag, command, args)
+            except (ValueError, IndexError) as e:
+                self._write(f"{tag} BAD {e}\r\n".encode())
+                continue
+            except (OSError, ssl.SSLError):
+                return
+            if done:
+                return
+
+    def _dispatch(self, tag: str, command: str, args: bytes) -> bool:
+        if command == 'CAPABILITY':
+            self._ok(tag, f"* CAPABILITY {CAPABILITIES}\r\n")
+        elif command == 'NOOP' or command == 'CHECK':
+            self._ok(tag, self._new_mail())
+        elif command == 'LOGOUT':
+            self._write(f"* BYE Logging out\r\n{tag} OK LOGOUT completed\r\n".encode())
+            return True
+        elif command == 'LOGIN':
+            self._login(tag, args)
+        elif self.account is None:
+            self._write(f"{tag} NO Not logged in\r\n".encode())
+        elif not self.server.allow(self.account):
+            self.server.count('throttled')
+            self._write(f"{tag} NO [THROTTLED] Account exceeded command or bandwidth limits\r\n".encode())
+        elif command in ('SELECT', 'EXAMINE'):
+            self._select(tag, args, readonly=command == 'EXAMINE')
+        elif command == 'STATUS':
+            self._status(tag, args)
+        elif command == 'CLOSE' or command == 'UNSELECT':
+            self.mailbox = None
+            self._ok(tag)
+        elif self.mailbox is None:
+            raise CommandError('No mailbox selected')
+        elif command == 'UID':
+            subcommand, _, rest = args.partition(b' ')
+            self._message_command(tag, subcommand.decode(errors='replace').upper(), rest, by_uid=True)
+        elif command in ('SEARCH', 'FETCH', 'STORE'):
+            self._message_command(tag, command, args, by_uid=False)
+        elif command == 'IDLE':
+            self._idle(tag)
+        else:
+            raise CommandError(f"Unsupported command {command}")
+        return False
+
+    def _login(self, tag: str, args: bytes):
+        tokens = _tokens(args)
+        if len(tokens) != 2 or any(isinstance(t, list) for t in tokens):
+            raise CommandError('LOGIN needs a user name and password')
+        user, password = tokens
+        if self.server.password is not None and password != self.server.password:
+            self._write(f"{tag} NO [AUTHENTICATIONFAILED] Invalid credentials\r\n".encode())
+            return
+        self.account = user
+        self.server.count('logins')
+        self._ok(tag, f"* CAPABILITY {CAPABILITIES}\r\n")
+
+    def _select(self, tag: str, args: bytes, readonly: bool):
+        tokens = _tokens(args)
+        if not tokens or str(tokens[0]).upper() != 'INBOX':
+            self.mailbox = None
+            self._write(f"{tag} NO [NONEXISTENT] Only INBOX exists\r\n".encode())
+            return
+        mailbox = self.server.mailbox(self.account)
+        count = len(mailbox.messages)
+        unseen = next((i + 1 for i, m in enumerate(mailbox.messages[:count]) if '\\Seen' not in m.flags), None)
+        self.mailbox, self.readonly, self.known = mailbox, readonly, count
+        lines = (f"* FLAGS ({SYSTEM_FLAGS})\r\n* {count} EXISTS\r\n* 0 RECENT\r\n"
+                 + (f"* OK [UNSEEN {unseen}] First unseen\r\n" if unseen else '')
+                 + f"* OK [UIDVALIDITY {mailbox.uidvalidity}] UIDs valid\r\n"
+                 f"* OK [UIDNEXT {mailbox.uidnext}] Predicted next UID\r\n")
+        mode = 'READ-ONLY' if readonly else 'READ-WRITE'
+        self._write(f"{lines}{tag} OK [{mode}] {'EXAMINE' if readonly else 'SELECT'} completed\r\n".encode())
+
+    def _status(self, tag: str, args: bytes):
+        tokens = _tokens(args)
+        if len(tokens) != 2 or not isinstance(tokens[1], list) or str(tokens[0]).upper() != 'INBOX':
+            self._write(f"{tag} NO [NONEXISTENT] Only INBOX exists\r\n".encode())
+            return
+        mailbox = self.server.mailbox(self.account)
+        count = len(mailbox.messages)
+        values = {
+            'MESSAGES': count,
+            'RECENT': 0,
+            'UIDNEXT': mailbox.uidnext,
+            'UIDVALIDITY': mailbox.uidvalidity,
+            'UNSEEN': sum(1 for m in mailbox.messages[:count] if '\\Seen' not in m.flags),
+        }
+        items = ' '.join(f"{item.upper()} {values[item.upper()]}" for item in tokens[1] if item.upper() in values)
+        self._ok(tag, f"* STATUS INBOX ({items})\r\n")
+
+    def _message_command(self, tag: str, command: str, args: bytes, by_uid: bool):
+        if command == 'SEARCH':
+            self._search(tag, args, by_uid)
+        elif command == 'FETCH':
+            self._fetch(tag, args, by_uid)
+        elif command == 'STORE':
+            self._store(tag, args, by_uid)
+        else:
+            raise CommandError(f"Unsupported UID command {command}")
+
+    def _search(self, tag: str, args: bytes, by_uid: bool):
+        tokens = _tokens(args)
+        if len(tokens) >= 2 and str(tokens[0]).upper() == 'CHARSET':
+            tokens = tokens[2:]
+        mailbox = self.mailbox
+        count = len(mailbox.messages)
+        test = _Search(mailbox, count).compile(tokens or ['ALL'])
+        found = [str(m.uid if by_uid else i + 1) for i, m in enumerate(mailbox.messages[:count]) if test(i, m)]
+        self._ok(tag, f"* SEARCH {' '.join(found)}\r\n".replace(' \r\n', '\r\n'))
+
+    def _fetch(self, tag: str, args: bytes, by_uid: bool):
+        id_set, _, items = args.decode('utf-8', errors='replace').partition(' ')
+        items = items.strip()
+        if items.startswith('(') and items.endswith(')'):
+            items = items[1:-1]
+        macros = {'ALL': 'FLAGS INTERNALDATE RFC822.SIZE ENVELOPE', 'FAST': 'FLAGS INTERNALDATE RFC822.SIZE',
+                  'FULL': 'FLAGS INTERNALDATE RFC822.SIZE ENVELOPE BODY'}
+        items = macros.get(items.upper(), items)
+        wanted = list(_FETCH_ITEM_RE.finditer(items))
+        if not wanted:
+            raise CommandError('Nothing to fetch')
+        mailbox = self.mailbox
+        out = bytearray()
+        for index in mailbox.resolve(id_set, by_uid):
+            message = mailbox.messages[index]
+            out += f"* {index + 1} FETCH (".encode()
+            out += self._fetch_items(message, wanted, by_uid)
+            out += b')\r\n'
+        out += f"{tag} OK FETCH completed\r\n".encode()
+        self._write(bytes(out))
+        self.server.count('fetched_bytes', len(out))
+
+    def _fetch_items(self, message: FakeMessage, wanted: List, by_uid: bool) -> bytes:
+        parts = []
+        names = {m.group(0).upper() for m in wanted}
+        if by_uid and 'UID' not in names:
+            parts.append(f"UID {message.uid}".encode())
+        seen = False
+        for match in wanted:
+            item = match.group(0).upper()
+            if match.group(1):
+                section, start, length = match.group(2), match.group(3), match.group(4)
+                data = message.section(section)
+                if start is not None:
+                    data = data[int(start):int(start) + int(length)] if length else data[int(start):]
+                origin = f"<{start}>" if start is not None else ''
+                parts.append(f"BODY[{section.upper()}]{origin} {{{len(data)}}}\r\n".encode() + data)
+                seen |= match.group(1).upper() == 'BODY'
+            elif item == 'UID':
+                parts.append(f"UID {message.uid}".encode())
+            elif item == 'FLAGS':
+                parts.append(f"FLAGS ({' '.join(sorted(message.flags))})".encode())
+            elif item == 'INTERNALDATE':
+                parts.append(f'INTERNALDATE "{self.server.internal_date(message)}"'.encode())
+            elif item == 'RFC822.SIZE':
+                parts.append(f"RFC822.SIZE {len(message.raw)}".encode())
+            elif item in ('RFC822', 'RFC822.HEADER', 'RFC822.TEXT'):
+                data = message.section({'RFC822': '', 'RFC822.HEADER': 'HEADER', 'RFC822.TEXT': 'TEXT'}[item])
+                parts.append(f"{item} {{{len(data)}}}\r\n".encode() + data)
+                seen |= item != 'RFC822.HEADER'
+            elif item == 'ENVELOPE':
+                parts.append(f"ENVELOPE {envelope(message.parsed)}".encode())
+            elif item in ('BODYSTRUCTURE', 'BODY'):
+                parts.append(f"{item} {message.structure}".encode())
+            else:
+                raise CommandError(f"Unsupported fetch item {match.group(0)}")
+        if seen and not self.readonly and '\\Seen' not in message.flags:
+            self.server.set_flags(message, {'\\Seen'}, '+')
+            if 'FLAGS' not in names:
+                parts.append(f"FLAGS ({' '.join(sorted(message.flags))})".encode())
+        return b' '.join(parts)
+
+    def _store(self, tag: str, args: bytes, by_uid: bool):
+        tokens = _tokens(args)
+        if len(tokens) < 3:
+            raise CommandError('STORE needs a sequence set, an action and flags')
+        id_set, action = str(tokens[0]), str(tokens[1]).upper()
+        flags = tokens[2] if isinstance(tokens[2], list) else tokens[2:]
+        mode = '+' if action.startswith('+') else '-' if action.startswith('-') else ''
+        if action.lstrip('+-') not in ('FLAGS', 'FLAGS.SILENT'):
+            raise CommandError(f"Unsupported STORE action {action}")
+        if self.readonly:
+            self._write(f"{tag} NO Mailbox is read-only\r\n".encode())
+            return
+        mailbox = self.mailbox
+        out = []
+        for index in mailbox.resolve(id_set, by_uid):
+            message = mailbox.messages[index]
+            self.server.set_flags(message, set(flags), mode)
+            if not action.endswith('.SILENT'):
+                uid = f"UID {message.uid} " if by_uid else ''
+                out.append(f"* {index + 1} FETCH ({uid}FLAGS ({' '.join(sorted(message.flags))}))\r\n")
+        self._ok(tag, ''.join(out))
+
+    def _idle(self, tag: str):
+        """Report new mail as it is delivered until the client sends DONE"""
+        self._write(b'+ idling\r\n')
+        mailbox, sock = self.mailbox, self.request
+        while True:
+            new_mail = self._new_mail()
+            if new_mail:
+                self._write(new_mail.encode())
+            pending = sock.pending() if isinstance(sock, ssl.SSLSocket) else 0
+            if pending or select.select([sock], [], [], 0)[0]:
+                line = self.rfile.readline()
+                if not line:
+                    return
+                if line.strip().upper() == b'DONE':
+                    break
+                raise CommandError('Expected DONE')
+            with mailbox.changed:
+                if len(mailbox.messages) == self.known:
+                    mailbox.changed.wait(0.05)
+        self._ok(tag)
+
+    def _new_mail(self) -> str:
+        if self.mailbox is None or len(self.mailbox.messages) == self.known:
+            return ''
+        self.known = len(self.mailbox.messages)
+        return f"* {self.known} EXISTS\r\n"
+
+    def _ok(self, tag: str, untagged: str = ''):
+        self._write(f"{untagged}{tag} OK completed\r\n".encode())
+
+    def _write(self, data: bytes):
+        self.wfile.write(data)
+        self.wfile.flush()
+
+
+class FakeIMAPServer(socketserver.ThreadingTCPServer):
+    """Threaded fake IMAP server.
+
+    Every account gets its own INBOX of ``messages`` generated messages on
+    first login, seeded from the account name so each mailbox is distinct
+    but reproducible. Any password is accepted unless ``password`` is set.
+    ``latency`` seconds are added to every command. With ``keep_unseen``
+    the \\Seen flag is never stored, so repeated syncs see the whole
+    mailbox again. With ``throttle_rate`` set, an account's commands beyond
+    that many per second (bursts up to ``throttle_burst``) are refused with
+    ``NO [THROTTLED]`` as Gmail does. Pass ``certfile``/``keyfile`` to serve
+    IMAPS.
+    """
+
+    allow_reuse_address = True
+    daemon_threads = True
+
+    def __init__(self, host: str = '127.0.0.1', port: int = 0, messages: int = 500, noise_ratio: float = 0.3,
+                 seed: int = 0, latency: float = 0.0, password: Optional[str] = None, keep_unseen: bool = False,
+                 certfile: Optional[str] = None, keyfile: Optional[str] = None, throttle_rate: float = 0.0,
+                 throttle_burst: float = 10.0):
+        super().__init__((host, port), _Session)
+        self.messages = messages
+        self.noise_ratio = noise_ratio
+        self.seed = seed
+        self.latency = latency
+        self.password = password
+        self.keep_unseen = keep_unseen
+        self.throttle_rate = throttle_rate
+        self.throttle_burst = throttle_burst
+        self.stats = {}
+        self._allowance = {}  # account -> (tokens, updated)
+        self._context = None
+        if certfile:
+            self._context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+            self._context.load_cert_chain(certfile, keyfile)
+        self._mailboxes = {}
+        self._mailbox_lock = threading.Lock()
+        self._lock = threading.Lock()
+        self._thread = None
+
+    @property
+    def address(self) -> str:
+        """imap_server value that reaches this server"""
+        host, port = self.server_address[:2]
+        return f"{'imaps' if self._context else 'imap'}://{host}:{port}"
+
+    def get_request(self):
+        sock, address = super().get_request()
+        if self._context is not None:
+            # The handshake runs in the session thread, not the accept loop
+            sock = self._context.wrap_socket(sock, server_side=True, do_handshake_on_connect=False)
+        return sock, address
+
+    def start(self) -> 'FakeIMAPServer':
+        self._thread = threading.Thread(target=self.serve_forever, daemon=True, name='fake-imap')
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+    def mailbox(self, account: str) -> Mailbox:
+        with self._mailbox_lock:
+            mailbox = self._mailboxes.get(account.lower())
+            if mailbox is None:
+                seed = self.seed ^ zlib.crc32(account.lower().encode())
+                raws = [to_rfc822(m) for m in generate_messages(self.messages, seed=seed,
+                                                                noise_ratio=self.noise_ratio)]
+                mailbox = self._mailboxes[account.lower()] = Mailbox(raws, uidvalidity=1 + seed % 100000)
+            return mailbox
+
+    def deliver(self, account: Optional[str] = None, raw: Optional[bytes] = None) -> int:
+        """Add one generated (or the given) message to an account's mailbox, or to every
+        mailbox created so far; returns how many were delivered
+        """
+        with self._mailbox_lock:
+            mailboxes = [self._mailboxes[account.lower()]] if account else list(self._mailboxes.values())
+        for mailbox in mailboxes:
+            if raw is None:
+                generated = generate_messages(1, seed=random.randrange(1 << 30), noise_ratio=self.noise_ratio)[0]
+                generated['date'] = datetime.now(timezone.utc)
+                generated['id'] = str(mailbox.uidnext)
+                mailbox.deliver(to_rfc822(generated))
+            else:
+                mailbox.deliver(raw)
+        return len(mailboxes)
+
+    def set_flags(self, message: FakeMessage, flags: set, mode: str):
+        if self.keep_unseen:
+            flags = flags - {'\\Seen'}
+        if mode == '+':
+            message.flags |= flags
+        elif mode == '-':
+            message.flags -= flags
+        else:
+            message.flags = flags
+
+    def internal_date(self, message: FakeMessage) -> str:
+        try:
+            when = email.utils.parsedate_to_datetime(message.parsed.get('Date'))
+        except (TypeError, ValueError):
+            when = datetime(2024, 1, 1, tzinfo=timezone.utc) + timedelta(minutes=message.uid)
+        return when.strftime('%d-%b-%Y %H:%M:%S %z')
+
+    def allow(self, account: str) -> bool:
+        """Take one command from the account's allowance, False if it is used up"""
+        if not self.throttle_rate:
+            return True
+        with self._lock:
+            now = time.monotonic()
+            tokens, updated = self._allowance.get(account.lower(), (self.throttle_burst, now))
+            tokens = min(self.throttle_burst, tokens + (now - updated) * self.throttle_rate)
+            allowed = tokens >= 1
+            self._allowance[account.lower()] = (tokens - 1 if allowed else tokens, now)
+            return allowed
+
+    def count(self, name: str, amount: int = 1):
+        with self._lock:
+            self.stats[name] = self.stats.get(name, 0) + amount
+
+
+def main(argv: List[str] = None) -> int:
+    parser = argparse.ArgumentParser(description='Serve generated bank-alert mailboxes over IMAP')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=1143)
+    parser.add_argument('-n', '--messages', type=int, default=500, help='messages per mailbox')
+    parser.add_argument('--noise', type=float, default=0.3, help='fraction of non-bank messages')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds added to every command')
+    parser.add_argument('--password', help='only accept this password (default: any)')
+    parser.add_argument('--keep-unseen', action='store_true', help='never store \\Seen, so every sync sees everything')
+    parser.add_argument('--arrive-every', type=float, default=0.0,
+                        help='deliver a new message to every mailbox this often (seconds)')
+    parser.add_argument('--throttle-rate', type=float, default=0.0,
+                        help='refuse commands beyond this many per second per account with NO [THROTTLED]')
+    parser.add_argument('--throttle-burst', type=float, default=10.0)
+    parser.add_argument('--certfile', help='PEM certificate; serves IMAPS when given')
+    parser.add_argument('--keyfile', help='PEM private key, if not in the certificate file')
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO)
+    server = FakeIMAPServer(args.host, args.port, args.messages, args.noise, args.seed, args.latency,
+                            args.password, args.keep_unseen, args.certfile, args.keyfile,
+                            args.throttle_rate, args.throttle_burst).start()
+    logger.info(f"Serving {args.messages} messages per mailbox at {server.address}")
+    try:
+        while True:
+            time.sleep(args.arrive_every or 3600)
+            if args.arrive_every:
+                server.deliver()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.stop()
+        logger.info(f"Stats: {server.stats}")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,305 @@
+#!/usr/bin/env python3
+"""
+Push sync for CashFlow AI
+Keeps an IMAP IDLE session open per watched mailbox, parses new arrivals as
+they land and publishes them to server-sent event subscribers
+"""
+
+import logging
+import queue
+import random
+import re
+import threading
+from collections import defaultdict
+from datetime import datetime, timezone
+from typing import Dict, List, Optional, Tuple
+
+from email_parser import EmailParser, LoginFailed, iter_sync_mailbox
+
+logger = logging.getLogger(__name__)
+
+# RFC 2177: clients should re-issue IDLE at least every 29 minutes
+IDLE_RENEW_SECONDS = 25 * 60
+
+
+class TooManyWatchers(Exception):
+    """Raised when no more mailboxes can be watched"""
+
+
+class EventBroker:
+    """Fan-out of per-account events to subscriber queues.
+
+    Each subscriber gets a bounded queue. A subscriber that falls behind
+    has its backlog replaced by a single ``resync`` event, telling it to
+    catch up from its last cursor via /api/transactions.
+    """
+
+    def __init__(self, queue_size: int = 100):
+        self.queue_size = queue_size
+        self._subscribers = defaultdict(list)  # account -> [Queue]
+        self._lock = threading.Lock()
+
+    def subscribe(self, account: str) -> queue.Queue:
+        q = queue.Queue(maxsize=self.queue_size)
+        with self._lock:
+            self._subscribers[account.lower()].append(q)
+        return q
+
+    def unsubscribe(self, account: str, q: queue.Queue):
+        with self._lock:
+            subscribers = self._subscribers.get(account.lower(), [])
+            if q in subscribers:
+                subscribers.remove(q)
+            if not subscribers:
+                self._subscribers.pop(account.lower(), None)
+
+    def publish(self, account: str, event: str, data: Dict):
+        with self._lock:
+            subscribers = list(self._subscribers.get(account.lower(), []))
+        for q in subscribers:
+            try:
+                q.put_nowait((event, data))
+            except queue.Full:
+                logger.warning(f"Event subscriber for {account} fell behind, asking it to resync")
+                _drain(q)
+                q.put_nowait(('resync', {'reason': 'subscriber fell behind'}))
+
+    def count(self) -> int:
+        with self._lock:
+            return sum(len(subscribers) for subscribers in self._subscribers.values())
+
+
+def _drain(q: queue.Queue):
+    try:
+        while True:
+            q.get_nowait()
+    except queue.Empty:
+        pass
+
+
+class _Position:
+    """In-memory checkpoint for one watcher, in the CheckpointStore interface.
+
+    Kept apart from the shared checkpoint store so pushed messages do not
+    move the position clients use for their own incremental syncs.
+    """
+
+    def __init__(self):
+        self.value = None
+
+    def get(self, server: str, account: str, folder: str) -> Optional[Tuple[int, int]]:
+        return self.value
+
+    def save(self, server: str, account: str, folder: str, uidvalidity: int, last_uid: int):
+        self.value = (uidvalidity, last_uid)
+
+
+class IdleWatcher:
+    """One thread holding an IDLE session on one folder of one mailbox.
+
+    Starts from the newest message present when first connected, so only
+    new arrivals are pushed. After a dropped connection it reconnects with
+    jittered exponential backoff and catches up on anything that arrived in
+    between. Servers without IDLE are polled every ``poll_seconds``. A
+    refused login is not retried: the watcher fails and publishes an
+    ``error`` event.
+    """
+
+    def __init__(self, imap_server: str, email_address: str, app_password: str, folder: str = 'INBOX',
+                 broker: Optional[EventBroker] = None, cache=None, store=None,
+                 idle_seconds: float = IDLE_RENEW_SECONDS, poll_seconds: float = 60.0,
+                 min_backoff: float = 1.0, max_backoff: float = 300.0):
+        self.imap_server = imap_server
+        self.email_address = email_address
+        self.app_password = app_password
+        self.folder = folder
+        self.broker = broker
+        self.cache = cache
+        self.store = store
+        self.idle_seconds = idle_seconds
+        self.poll_seconds = poll_seconds
+        self.min_backoff = min_backoff
+        self.max_backoff = max_backoff
+        self.state = 'starting'  # starting, idle, polling, syncing, backoff, failed or stopped
+        self.error = ''
+        self.pushed = 0
+        self.connected_at = ''
+        self._position = _Position()
+        self._backoff = min_backoff
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True,
+                                        name=f"idle-{email_address}-{folder}")
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def join(self, timeout: Optional[float] = None):
+        self._thread.join(timeout)
+
+    def to_dict(self) -> Dict:
+        return {
+            'email_address': self.email_address,
+            'imap_server': self.imap_server,
+            'folder': self.folder,
+            'state': self.state,
+            'error': self.error,
+            'pushed': self.pushed,
+            'connected_at': self.connected_at,
+        }
+
+    def _run(self):
+        while not self._stop.is_set():
+            parser = EmailParser(self.imap_server, self.email_address, self.app_password)
+            try:
+                if not parser.connect():
+                    if parser.login_refused:
+                        raise LoginFailed(f"IMAP login to {self.imap_server} was refused")
+                    raise ConnectionError('Connection failed')
+                self.connected_at = datetime.now(timezone.utc).isoformat()
+                self._watch(parser)
+            except LoginFailed as e:
+                # Retrying a wrong password only risks locking the account
+                logger.error(f"IDLE watcher for {self.email_address}/{self.folder} stopped: {e}")
+                self.error = str(e)
+                self.connected_at = ''
+                self.state = 'failed'
+                if self.broker is not None:
+                    self.broker.publish(self.email_address, 'error', {'folder': self.folder, 'error': self.error})
+                return
+            except Exception as e:
+                if self._stop.is_set():
+                    break
+                logger.error(f"IDLE watcher for {self.email_address}/{self.folder} failed: {e}")
+                self.error = str(e)
+                self.connected_at = ''
+            finally:
+                parser.disconnect()
+            if self._stop.is_set():
+                break
+            self.state = 'backoff'
+            delay = random.uniform(self._backoff / 2, self._backoff)
+            logger.info(f"Reconnecting IDLE watcher for {self.email_address}/{self.folder} in {delay:.1f}s")
+            self._stop.wait(delay)
+            self._backoff = min(self._backoff * 2, self.max_backoff)
+        self.state = 'stopped'
+
+    def _watch(self, parser: EmailParser):
+        """Catch up, then alternate between waiting for mail and fetching it"""
+        if self._position.value is None:
+            self._position.value = self._current_position(parser)
+        self._catch_up(parser)
+        # Only a session that got this far resets the backoff
+        self._backoff = self.min_backoff
+        self.error = ''
+        use_idle = parser.supports_idle()
+        if not use_idle:
+            logger.info(f"{self.imap_server} has no IDLE, polling every {self.poll_seconds:.0f}s")
+        while not self._stop.is_set():
+            if use_idle:
+                self.state = 'idle'
+                arrived = parser.idle(self.idle_seconds, self._stop)
+            else:
+                self.state = 'polling'
+                self._stop.wait(self.poll_seconds)
+                arrived = not self._stop.is_set()
+            if arrived:
+                self._catch_up(parser)
+
+    def _current_position(self, parser: EmailParser) -> Tuple[int, int]:
+        """(UIDVALIDITY, highest UID) of the folder right now"""
+        status, data = parser.imap.status(self.folder, '(UIDVALIDITY UIDNEXT)')
+        text = data[0] if status == 'OK' and data and data[0] else b''
+        uidvalidity = re.search(rb'UIDVALIDITY (\d+)', text)
+        uidnext = re.search(rb'UIDNEXT (\d+)', text)
+        if not uidvalidity or not uidnext:
+            raise ConnectionError(f"STATUS gave no UIDNEXT for {self.folder}")
+        return int(uidvalidity.group(1)), int(uidnext.group(1)) - 1
+
+    def _catch_up(self, parser: EmailParser):
+        """Parse everything past the position and push it"""
+        self.state = 'syncing'
+        transactions = list(iter_sync_mailbox(parser, self.folder, checkpoints=self._position, cache=self.cache))
+        if not transactions:
+            return
+        cursor = 0
+        if self.store is not None:
+            self.store.add(self.email_address, transactions)
+            cursor = self.store.latest_cursor(self.email_address)
+        self.pushed += len(transactions)
+        logger.info(f"Pushing {len(transactions)} new transactions for {self.email_address}")
+        if self.broker is not None:
+            self.broker.publish(self.email_address, 'transactions',
+                                {'transactions': transactions, 'count': len(transactions), 'cursor': cursor})
+
+
+class IdleWatchers:
+    """Registry of IDLE watchers, at most one per (server, account, folder)"""
+
+    def __init__(self, broker: EventBroker, max_watchers: int = 100, cache=None, store=None,
+                 idle_seconds: float = IDLE_RENEW_SECONDS, poll_seconds: float = 60.0,
+                 max_backoff: float = 300.0):
+        self.broker = broker
+        self.max_watchers = max_watchers
+        self.cache = cache
+        self.store = store
+        self.idle_seconds = idle_seconds
+        self.poll_seconds = poll_seconds
+        self.max_backoff = max_backoff
+        self._watchers = {}  # (imap_server, account, folder) -> IdleWatcher
+        self._lock = threading.Lock()
+
+    def watch(self, imap_server: str, email_address: str, app_password: str,
+              folders: Optional[List[str]] = None) -> List[IdleWatcher]:
+        """Start watching ``folders``; already watched folders keep their watcher"""
+        folders = folders or ['INBOX']
+        watchers = []
+        with self._lock:
+            keys = [(imap_server, email_address.lower(), folder) for folder in folders]
+            new = [key for key in keys if key not in self._watchers]
+            if len(self._watchers) + len(new) > self.max_watchers:
+                raise TooManyWatchers(f"{len(self._watchers)} mailboxes already watched")
+            for key in keys:
+                watcher = self._watchers.get(key)
+                if watcher is not None and (watcher.app_password != app_password or watcher.state == 'failed'):
+                    # New credentials, or a retry after a refused login: restart
+                    watcher.stop()
+                    watcher = None
+                if watcher is None:
+                    watcher = IdleWatcher(imap_server, email_address, app_password, key[2],
+                                          broker=self.broker, cache=self.cache, store=self.store,
+                                          idle_seconds=self.idle_seconds, poll_seconds=self.poll_seconds,
+                                          max_backoff=self.max_backoff)
+                    self._watchers[key] = watcher
+                    watcher.start()
+                watchers.append(watcher)
+        return watchers
+
+    def unwatch(self, imap_server: str, email_address: str) -> int:
+        """Stop every watcher of an account; returns how many were stopped"""
+        with self._lock:
+            keys = [key for key in self._watchers if key[:2] == (imap_server, email_address.lower())]
+            for key in keys:
+                self._watchers.pop(key).stop()
+        return len(keys)
+
+    def status(self, email_address: str) -> List[Dict]:
+        """Watchers of an account on any server"""
+        with self._lock:
+            return [w.to_dict() for key, w in self._watchers.items() if key[1] == email_address.lower()]
+
+    def stats(self) -> Dict:
+        with self._lock:
+            counts = {}
+            for watcher in self._watchers.values():
+                counts[watcher.state] = counts.get(watcher.state, 0) + 1
+            return counts
+
+    def stop_all(self):
+        with self._lock:
+            watchers = list(self._watchers.values())
+            self._watchers.clear()
+        for watcher in watchers:
+            watcher.stop()
@@ -0,0 +1,283 @@
+#!/usr/bin/env python3
+"""
+Per-account IMAP rate governor for CashFlow AI
+Paces commands with a token bucket per (server, account), sizes FETCH
+batches from observed latency and response bytes, and backs off with
+jitter when the provider throttles
+"""
+
+import logging
+import os
+import random
+import threading
+import time
+from collections import OrderedDict, deque, namedtuple
+from typing import Callable, Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+# Steady commands per second per account (0: unpaced until the provider
+# throttles) and the burst allowed on top of it
+IMAP_RATE = float(os.getenv('IMAP_RATE', 0))
+IMAP_BURST = float(os.getenv('IMAP_BURST', 20))
+# Retries of a throttled command and the backoff base and cap, in seconds
+THROTTLE_RETRIES = int(os.getenv('IMAP_THROTTLE_RETRIES', 4))
+BACKOFF_BASE = float(os.getenv('IMAP_BACKOFF_BASE', 1.0))
+BACKOFF_MAX = float(os.getenv('IMAP_BACKOFF_MAX', 60))
+# Seconds for a throttled account's pace to climb back to where it was
+RECOVER_SECONDS = float(os.getenv('IMAP_RECOVER_SECONDS', 60))
+# Adaptive FETCH batches aim to take about this long and carry about this much
+FETCH_TARGET_SECONDS = float(os.getenv('FETCH_TARGET_SECONDS', 2.0))
+FETCH_TARGET_BYTES = int(os.getenv('FETCH_TARGET_BYTES', 4 * 1024 * 1024))
+MIN_BATCH_SIZE = 10
+# Slowest pace a throttled account is held to, in commands per second
+MIN_RATE = 0.2
+
+# Response text providers send when throttling (Gmail, Outlook, Yahoo and
+# the RFC 5530 LIMIT code)
+THROTTLE_MARKERS = ('[throttled]', '[limit]', 'too many simultaneous connections',
+                    'exceeded command or bandwidth limits', 'rate limit', 'too many requests')
+
+# attempt counts from 1; delay is the backoff before the retry, 0 when gave_up
+ThrottleEvent = namedtuple('ThrottleEvent', 'command attempt delay detail gave_up at')
+
+
+def _text(detail) -> str:
+    if isinstance(detail, (list, tuple)):
+        detail = b' '.join(d for d in detail if isinstance(d, bytes))
+    if isinstance(detail, bytes):
+        return detail.decode('utf-8', errors='replace')
+    return str(detail)
+
+
+def is_throttled(detail) -> bool:
+    """Whether an IMAP error or NO response data says the account is throttled"""
+    text = _text(detail).lower()
+    return any(marker in text for marker in THROTTLE_MARKERS)
+
+
+def backoff_delay(attempt: int, base: float = BACKOFF_BASE, cap: float = BACKOFF_MAX) -> float:
+    """Exponential backoff before retry ``attempt`` (0-based), with equal jitter"""
+    delay = min(cap, base * 2 ** attempt)
+    return delay / 2 + random.uniform(0, delay / 2)
+
+
+class TokenBucket:
+    """``rate`` tokens per second up to ``burst``; a rate of 0 never waits.
+
+    reserve() takes a token at once and returns how long the caller must
+    wait before using it, so sleeping happens outside the lock and waiting
+    callers are served in arrival order.
+    """
+
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.burst = max(burst, 1.0)
+        self._tokens = self.burst
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def reserve(self, tokens: float = 1.0) -> float:
+        if self.rate <= 0:
+            return 0.0
+        with self._lock:
+            self._refill_locked()
+            self._tokens -= tokens
+            return -self._tokens / self.rate if self._tokens < 0 else 0.0
+
+    def set_rate(self, rate: float, drain: bool = False):
+        """Change the rate from now on; ``drain`` also drops the saved-up burst"""
+        with self._lock:
+            self._refill_locked()
+            self.rate = rate
+            if drain:
+                self._tokens = min(self._tokens, 0.0)
+
+    def _refill_locked(self):
+        now = time.monotonic()
+        if self.rate > 0:
+            self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+
+class AdaptiveBatch:
+    """FETCH batch size learned from the latency and bytes of earlier batches.
+
+    Keeps moving averages of seconds and bytes per message and sizes the
+    next batch to take about ``target_seconds`` and carry about
+    ``target_bytes``. A batch at most doubles from the previous one, and
+    throttling halves it.
+    """
+
+    def __init__(self, target_seconds: float = FETCH_TARGET_SECONDS, target_bytes: int = FETCH_TARGET_BYTES,
+                 minimum: int = MIN_BATCH_SIZE, smoothing: float = 0.3):
+        self.target_seconds = target_seconds
+        self.target_bytes = target_bytes
+        self.minimum = minimum
+        self.smoothing = smoothing
+        self.size = None  # learned size, None until the first batch is observed
+        self.seconds_per_message = None
+        self.bytes_per_message = None
+        self._last = None
+        self._lock = threading.Lock()
+
+    def next_size(self, limit: int) -> int:
+        """Messages to request in the next FETCH, never more than ``limit``"""
+        with self._lock:
+            size = limit if self.size is None else max(min(self.size, limit), min(self.minimum, limit))
+            self._last = size
+            return size
+
+    def observe(self, messages: int, seconds: float, nbytes: int):
+        if messages <= 0:
+            return
+        with self._lock:
+            self.seconds_per_message = self._average(self.seconds_per_message, seconds / messages)
+            self.bytes_per_message = self._average(self.bytes_per_message, nbytes / messages)
+            ideal = min(self.target_seconds / max(self.seconds_per_message, 1e-6),
+                        self.target_bytes / max(self.bytes_per_message, 1.0))
+            self.size = int(max(self.minimum, min(ideal, (self._last or messages) * 2)))
+
+    def shrink(self):
+        with self._lock:
+            current = self.size or self._last
+            if current:
+                self.size = max(self.minimum, current // 2)
+
+    def _average(self, average: Optional[float], value: float) -> float:
+        return value if average is None else average + self.smoothing * (value - average)
+
+
+class RateGovernor:
+    """Pacing, batch sizing and throttle backoff shared by one account's sessions.
+
+    Commands are paced at ``rate`` per second (unpaced when 0). When the
+    provider throttles, every session of the account pauses for the
+    backoff, and the pace drops to half the rate commands were going out
+    at, then climbs back linearly over ``recover_seconds``.
+    """
+
+    def __init__(self, rate: float = IMAP_RATE, burst: float = IMAP_BURST, retries: int = THROTTLE_RETRIES,
+                 backoff_base: float = BACKOFF_BASE, backoff_max: float = BACKOFF_MAX,
+                 recover_seconds: float = RECOVER_SECONDS):
+        self.rate = rate
+        self.retries = retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.recover_seconds = recover_seconds
+        self.bucket = TokenBucket(rate, burst)
+        self.batch = AdaptiveBatch()
+        self.events = deque(maxlen=50)
+        self.stats = {'commands': 0, 'paced': 0, 'paced_seconds': 0.0, 'throttled': 0, 'retries': 0, 'gave_up': 0}
+        self._recent = deque(maxlen=32)  # send times, to estimate the rate that got throttled
+        self._resume_at = 0.0
+        self._ceiling = None  # pace to recover to after a throttle
+        self._adjusted = 0.0
+        self._lock = threading.Lock()
+
+    def wait(self):
+        """Block until the next command may be sent"""
+        with self._lock:
+            now = time.monotonic()
+            self._recover_locked(now)
+            self._recent.append(now)
+            self.stats['commands'] += 1
+            resume = self._resume_at - now
+        delay = max(self.bucket.reserve(), resume)
+        if delay > 0:
+            with self._lock:
+                self.stats['paced'] += 1
+                self.stats['paced_seconds'] += delay
+            time.sleep(delay)
+
+    def throttled(self, command: str, attempt: int, detail, retry: bool = True) -> ThrottleEvent:
+        """Record a throttle response to ``attempt`` (0-based) and slow the account down.
+
+        The returned event has the backoff wait() will apply before the
+        next command, or ``gave_up`` set once retries are exhausted or
+        ``retry`` is False.
+        """
+        gave_up = not retry or attempt >= self.retries
+        delay = 0.0 if gave_up else backoff_delay(attempt, self.backoff_base, self.backoff_max)
+        with self._lock:
+            now = time.monotonic()
+            self.stats['throttled'] += 1
+            self.stats['gave_up' if gave_up else 'retries'] += 1
+            self._resume_at = max(self._resume_at, now + delay)
+            current = self.bucket.rate if self.bucket.rate > 0 else self._observed_rate_locked()
+            if self._ceiling is None:
+                self._ceiling = current
+            self.bucket.set_rate(max(MIN_RATE, current / 2), drain=True)
+            self._adjusted = now + delay
+        self.batch.shrink()
+        event = ThrottleEvent(command, attempt + 1, round(delay, 3), _text(detail)[:200], gave_up, time.time())
+        self.events.append(event)
+        return event
+
+    def _observed_rate_locked(self) -> float:
+        if len(self._recent) < 2:
+            return 1.0
+        return (len(self._recent) - 1) / max(self._recent[-1] - self._recent[0], 1e-3)
+
+    def _recover_locked(self, now: float):
+        if self._ceiling is None or now < self._resume_at:
+            return
+        rate = self.bucket.rate + self._ceiling * (now - self._adjusted) / self.recover_seconds
+        self._adjusted = now
+        if rate >= self._ceiling:
+            # Back to the configured pace, or unpaced
+            self._ceiling = None
+            rate = self.rate
+        self.bucket.set_rate(rate)
+
+
+class GovernorRegistry:
+    """One RateGovernor per (imap_server, email_address).
+
+    Governors outlive IMAP sessions so pacing and learned batch sizes carry
+    over between syncs; the least recently used are dropped past
+    ``max_accounts``.
+    """
+
+    def __init__(self, max_accounts: int = 1000, **options):
+        self.max_accounts = max_accounts
+        self.options = options
+        self._governors = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, imap_server: str, email_address: str) -> RateGovernor:
+        key = (imap_server, (email_address or '').lower())
+        with self._lock:
+            governor = self._governors.get(key)
+            if governor is None:
+                governor = self._governors[key] = RateGovernor(**self.options)
+                while len(self._governors) > self.max_accounts:
+                    self._governors.popitem(last=False)
+            else:
+                self._governors.move_to_end(key)
+            return governor
+
+    def stats(self) -> Dict:
+        """Counters summed over every governor"""
+        with self._lock:
+            governors = list(self._governors.values())
+        totals = {'accounts': len(governors)}
+        for governor in governors:
+            for name, value in governor.stats.items():
+                totals[name] = totals.get(name, 0) + value
+        return totals
+
+    def recent_events(self, account_label: Callable[[str], str], limit: int = 50) -> List[Dict]:
+        """Latest throttle events across accounts, newest first.
+
+        Accounts appear only as ``account_label(email_address)``, such as a hash.
+        """
+        with self._lock:
+            items = list(self._governors.items())
+        events = [dict(event._asdict(), imap_server=server, account=account_label(account))
+                  for (server, account), governor in items for event in list(governor.events)]
+        events.sort(key=lambda event: event['at'], reverse=True)
+        return events[:limit]
+
+
+GOVERNORS = GovernorRegistry(max_accounts=int(os.getenv('IMAP_GOVERNOR_ACCOUNTS', 1000)))
@@ -0,0 +1,137 @@
+#!/usr/bin/env python3
+"""
+Authenticated IMAP session pool for CashFlow AI
+Reuses logged-in EmailParser sessions across API requests
+"""
+
+import logging
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from typing import Iterator, Optional, Tuple
+
+from email_parser import EmailParser
+from storage import secret_digest
+
+logger = logging.getLogger(__name__)
+
+
+class IMAPConnectionPool:
+    """Pool of logged-in IMAP sessions keyed by (imap_server, email_address).
+
+    Idle sessions older than ``idle_timeout`` seconds are dropped, at most
+    ``max_size`` idle sessions are kept (least recently used evicted first),
+    and every borrowed session is checked with NOOP before it is handed out.
+    """
+
+    def __init__(self, max_size: int = 16, idle_timeout: float = 300.0):
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+        self._idle = OrderedDict()  # id(parser) -> (key, digest, parser, released_at)
+        self._lock = threading.Lock()
+        self.stats = {'created': 0, 'reused': 0, 'evicted': 0, 'failed_checks': 0}
+
+    @contextmanager
+    def session(self, imap_server: str, email_address: str, app_password: str) -> Iterator[Optional[EmailParser]]:
+        """Borrow a logged-in parser, or None if login failed.
+
+        The session goes back to the pool when the block exits normally and
+        is discarded if the block raises, since the connection may be
+        mid-command.
+        """
+        parser = self.acquire(imap_server, email_address, app_password)
+        if parser is None:
+            yield None
+            return
+        try:
+            yield parser
+        except BaseException:
+            # Includes GeneratorExit when a streaming caller stops early
+            self._close(parser)
+            raise
+        self.release(parser, app_password)
+
+    def acquire(self, imap_server: str, email_address: str, app_password: str) -> Optional[EmailParser]:
+        """Take a healthy idle session for the account or log in a new one"""
+        key = (imap_server, email_address.lower())
+        digest = secret_digest(app_password)
+        while True:
+            parser = self._take_idle(key, digest)
+            if parser is None:
+                break
+            alive = self._is_alive(parser)
+            with self._lock:
+                self.stats['reused' if alive else 'failed_checks'] += 1
+            if alive:
+                return parser
+            self._close(parser)
+
+        parser = EmailParser(imap_server, email_address, app_password)
+        if not parser.connect():
+            return None
+        with self._lock:
+            self.stats['created'] += 1
+        return parser
+
+    def release(self, parser: EmailParser, app_password: str):
+        """Return a session to the pool, evicting the least recently used if full"""
+        if parser.imap is None:
+            return
+        key = (parser.imap_server, parser.email_address.lower())
+        evicted = []
+        with self._lock:
+            self._idle[id(parser)] = (key, secret_digest(app_password), parser, time.monotonic())
+            evicted.extend(self._expire_locked())
+            while len(self._idle) > self.max_size:
+                evicted.append(self._idle.popitem(last=False)[1][2])
+            self.stats['evicted'] += len(evicted)
+        for old in evicted:
+            self._close(old)
+
+    def close_all(self):
+        """Log out every idle session"""
+        with self._lock:
+            parsers = [entry[2] for entry in self._idle.values()]
+            self._idle.clear()
+        for parser in parsers:
+            self._close(parser)
+
+    def __len__(self) -> int:
+        return len(self._idle)
+
+    def _take_idle(self, key: Tuple[str, str], digest: str) -> Optional[EmailParser]:
+        evicted = []
+        found = None
+        with self._lock:
+            evicted.extend(self._expire_locked())
+            # Most recently released first: it is the least likely to have timed out
+            for pid in reversed(self._idle):
+                entry_key, entry_digest, parser, _ = self._idle[pid]
+                if entry_key == key and entry_digest == digest:
+                    del self._idle[pid]
+                    found = parser
+                    break
+            self.stats['evicted'] += len(evicted)
+        for old in evicted:
+            self._close(old)
+        return found
+
+    def _expire_locked(self):
+        cutoff = time.monotonic() - self.idle_timeout
+        expired = [pid for pid, entry in self._idle.items() if entry[3] < cutoff]
+        return [self._idle.pop(pid)[2] for pid in expired]
+
+    @staticmethod
+    def _is_alive(parser: EmailParser) -> bool:
+        try:
+            status, _ = parser.imap.noop()
+            return status == 'OK'
+        except Exception as e:
+            logger.info(f"Pooled IMAP session for {parser.email_address} is stale: {e}")
+            return False
+
+    @staticmethod
+    def _close(parser: EmailParser):
+        parser.disconnect()
+        parser.imap = None
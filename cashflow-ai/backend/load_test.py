@@ -0,0 +1,272 @@
+#!/usr/bin/env python3
+"""
+Sync load test for CashFlow AI
+Runs concurrent /api/sync clients against api_server.app, each syncing its
+own mailbox on a local fake IMAP server, and reports throughput, tail
+latency and memory
+"""
+
+import argparse
+import gzip
+import json
+import logging
+import os
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from typing import Dict, List, Optional, Tuple
+
+from bench_parser import _percentile
+from fake_imap import FakeIMAPServer
+
+try:
+    import resource
+except ImportError:  # not on Windows
+    resource = None
+
+logger = logging.getLogger(__name__)
+
+# Counters of the fake server that are not IMAP commands
+_SERVER_TOTALS = ('connections', 'logins', 'fetched_bytes', 'throttled')
+
+
+def _rss_bytes() -> Optional[int]:
+    """Current resident set size, where /proc is available"""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, AttributeError):
+        return None
+
+
+def _peak_rss_bytes() -> Optional[int]:
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in KiB on Linux and in bytes on macOS
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+class _MemorySampler:
+    """Samples RSS in the background to find the peak during the run"""
+
+    def __init__(self, interval: float = 0.05):
+        self.interval = interval
+        self.start_bytes = _rss_bytes()
+        self.peak_bytes = self.start_bytes
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True, name='rss-sampler')
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            rss = _rss_bytes()
+            if rss is not None:
+                self.peak_bytes = max(self.peak_bytes or 0, rss)
+
+
+def _count(response, data: bytes, stream: bool) -> Tuple[int, int]:
+    """Transactions and throttled commands reported by one /api/sync response"""
+    if response.headers.get('Content-Encoding') == 'gzip':
+        data = gzip.decompress(data)
+    if stream:
+        lines = data.splitlines()
+        summary = json.loads(lines[-1]) if lines else {}
+    else:
+        summary = json.loads(data)
+    return summary.get('count', 0), summary.get('throttled', 0)
+
+
+def _mb(value: Optional[int]) -> Optional[float]:
+    return round(value / (1024 * 1024), 1) if value is not None else None
+
+
+def run_load_test(clients: int = 8, requests: int = 4, messages: int = 500, noise_ratio: float = 0.3,
+                  seed: int = 0, latency: float = 0.0, options: Optional[Dict] = None,
+                  accept_encoding: str = '', certfile: Optional[str] = None, keyfile: Optional[str] = None,
+                  trace_memory: bool = False, throttle_rate: float = 0.0) -> Dict:
+    """Run ``clients`` threads each posting ``requests`` syncs and summarize them.
+
+    Every client logs in as its own account, so each syncs a distinct
+    mailbox. The fake server keeps messages unseen, so every request
+    fetches and parses the whole mailbox unless ``options`` asks for an
+    incremental sync. ``options`` is merged into each /api/sync body, and
+    ``throttle_rate`` makes the server throttle each account like Gmail.
+    """
+    options = options or {}
+    server = FakeIMAPServer(messages=messages, noise_ratio=noise_ratio, seed=seed, latency=latency,
+                            keep_unseen=True, certfile=certfile, keyfile=keyfile,
+                            throttle_rate=throttle_rate).start()
+    accounts = [f"load{i}@cashflow.test" for i in range(clients)]
+    # Generate the mailboxes up front so the timed run measures syncing only
+    for account in accounts:
+        server.mailbox(account)
+
+    import api_server
+    import email_parser
+    email_parser.IMAP_ALLOW_PLAINTEXT = True
+    logging.getLogger().setLevel(logging.WARNING)
+
+    headers = {'Accept-Encoding': accept_encoding} if accept_encoding else {}
+    samples = [[] for _ in accounts]
+    barrier = threading.Barrier(clients + 1)
+
+    def client(index: int):
+        http = api_server.app.test_client()
+        body = dict(options, imap_server=server.address, email_address=accounts[index], app_password='load-test')
+        barrier.wait()
+        for _ in range(requests):
+            start = time.perf_counter()
+            try:
+                response = http.post('/api/sync', json=body, headers=headers)
+                data = response.get_data()
+                status = response.status_code
+                count, throttled = _count(response, data, bool(options.get('stream'))) if status == 200 else (0, 0)
+            except Exception as e:
+                logger.error(f"Request for {accounts[index]} failed: {e}")
+                status, count, throttled, data = 0, 0, 0, b''
+            samples[index].append((time.perf_counter() - start, status, count, len(data), throttled))
+
+    threads = [threading.Thread(target=client, args=(i,), name=f"load-client-{i}") for i in range(clients)]
+    for thread in threads:
+        thread.start()
+    if trace_memory:
+        tracemalloc.start()
+    with _MemorySampler() as memory:
+        barrier.wait()
+        started = time.perf_counter()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - started
+    traced_peak = None
+    if trace_memory:
+        traced_peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    server.stop()
+    api_server.imap_pool.close_all()
+
+    results = [sample for client_samples in samples for sample in client_samples]
+    latencies = sorted(sample[0] * 1000 for sample in results)
+    ok = [sample for sample in results if sample[1] == 200]
+    transactions = sum(sample[2] for sample in ok)
+    stats = dict(server.stats)
+    return {
+        'clients': clients,
+        'requests': len(results),
+        'ok': len(ok),
+        'errors': len(results) - len(ok),
+        'messages_per_mailbox': messages,
+        'latency_ms_per_command': round(latency * 1000, 1),
+        'options': options,
+        'seconds': round(elapsed, 3),
+        'requests_per_sec': round(len(results) / elapsed, 2) if elapsed else 0.0,
+        'transactions': transactions,
+        'transactions_per_sec': round(transactions / elapsed, 1) if elapsed else 0.0,
+        'throttled': sum(sample[4] for sample in ok),
+        'p50_ms': round(_percentile(latencies, 50), 1),
+        'p90_ms': round(_percentile(latencies, 90), 1),
+        'p99_ms': round(_percentile(latencies, 99), 1),
+        'max_ms': round(latencies[-1], 1) if latencies else 0.0,
+        'response_kb_avg': round(sum(s[3] for s in ok) / len(ok) / 1024, 1) if ok else 0.0,
+        'rss_start_mb': _mb(memory.start_bytes),
+        'rss_peak_mb': _mb(memory.peak_bytes),
+        'max_rss_mb': _mb(_peak_rss_bytes()),
+        'traced_peak_mb': _mb(traced_peak),
+        'imap': {
+            'connections': stats.get('connections', 0),
+            'logins': stats.get('logins', 0),
+            'commands': sum(v for k, v in stats.items() if k not in _SERVER_TOTALS),
+            'fetched_mb': _mb(stats.get('fetched_bytes', 0)),
+            'throttled': stats.get('throttled', 0),
+        },
+        'parse_cache': dict(api_server.parse_cache.stats),
+    }
+
+
+def _print_summary(result: Dict):
+    imap = result['imap']
+    print(f"{result['clients']} clients x {result['requests'] // max(result['clients'], 1)} syncs, "
+          f"{result['messages_per_mailbox']} messages per mailbox, "
+          f"{result['latency_ms_per_command']} ms per IMAP command, options {json.dumps(result['options'])}")
+    print(f"{'requests':<22}{result['requests']} ({result['ok']} ok, {result['errors']} failed) "
+          f"in {result['seconds']}s")
+    print(f"{'throughput':<22}{result['requests_per_sec']} req/s, {result['transactions_per_sec']} transactions/s")
+    if imap['throttled']:
+        print(f"{'throttled':<22}{imap['throttled']} commands refused, {result['throttled']} reported to clients")
+    print(f"{'latency ms':<22}p50 {result['p50_ms']}  p90 {result['p90_ms']}  "
+          f"p99 {result['p99_ms']}  max {result['max_ms']}")
+    print(f"{'response':<22}{result['response_kb_avg']} KiB average")
+    memory = f"RSS {result['rss_start_mb']} -> peak {result['rss_peak_mb']} MiB"
+    if result['traced_peak_mb'] is not None:
+        memory += f", traced Python peak {result['traced_peak_mb']} MiB"
+    print(f"{'memory':<22}{memory}")
+    print(f"{'imap':<22}{imap['connections']} connections, {imap['logins']} logins, "
+          f"{imap['commands']} commands, {imap['fetched_mb']} MiB fetched")
+    print(f"{'parse cache':<22}{result['parse_cache']}")
+
+
+def main(argv: List[str] = None) -> int:
+    parser = argparse.ArgumentParser(description='Load-test /api/sync against a local fake IMAP server')
+    parser.add_argument('-c', '--clients', type=int, default=8, help='concurrent clients, one mailbox each')
+    parser.add_argument('-r', '--requests', type=int, default=4, help='syncs per client')
+    parser.add_argument('-n', '--messages', type=int, default=500, help='messages per mailbox')
+    parser.add_argument('--noise', type=float, default=0.3, help='fraction of non-bank messages')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds the server adds to every command')
+    parser.add_argument('--batch-size', type=int, default=200)
+    parser.add_argument('--fetch-mode', choices=['full', 'text'], default='full')
+    parser.add_argument('--prefilter', choices=['search', 'headers'])
+    parser.add_argument('--fields', help="fields= projection, e.g. 'default,notes'")
+    parser.add_argument('--stream', action='store_true', help='use the NDJSON streaming response')
+    parser.add_argument('--incremental', action='store_true', help='only the first sync per client fetches mail')
+    parser.add_argument('--accept-encoding', default='', help="e.g. 'gzip'")
+    parser.add_argument('--throttle-rate', type=float, default=0.0,
+                        help='server refuses commands beyond this many per second per account')
+    parser.add_argument('--certfile', help='serve IMAPS with this PEM certificate')
+    parser.add_argument('--keyfile', help='PEM private key, if not in the certificate file')
+    parser.add_argument('--tracemalloc', action='store_true', help='also trace Python allocations (slower)')
+    parser.add_argument('--save', help='write results as JSON')
+    parser.add_argument('--json', action='store_true', help='print results as JSON')
+    args = parser.parse_args(argv)
+
+    # api_server reads its settings at import; keep this run's state out of the real databases
+    state_dir = tempfile.mkdtemp(prefix='cashflow-load-')
+    os.environ.setdefault('SYNC_STATE_DB', os.path.join(state_dir, 'sync_state.db'))
+    os.environ.setdefault('PARSE_CACHE_DISK', '0')
+    os.environ.setdefault('PARSE_WORKERS', '0')
+    os.environ.setdefault('TEMPLATES_POLL_SECONDS', '0')
+
+    options = {'batch_size': args.batch_size, 'fetch_mode': args.fetch_mode}
+    for name in ('prefilter', 'fields'):
+        if getattr(args, name):
+            options[name] = getattr(args, name)
+    if args.stream:
+        options['stream'] = True
+    if args.incremental:
+        options['incremental'] = True
+
+    result = run_load_test(args.clients, args.requests, args.messages, args.noise, args.seed, args.latency,
+                           options, args.accept_encoding, args.certfile, args.keyfile, args.tracemalloc,
+                           args.throttle_rate)
+    if args.json:
+        print(json.dumps(result, indent=2))
+    else:
+        _print_summary(result)
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(result, f, indent=2)
+    return 1 if result['errors'] else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,303 @@
+#!/usr/bin/env python3
+"""
+In-process metrics for the CashFlow AI sync pipeline
+Counters and histograms rendered in the Prometheus text exposition format
+"""
+
+import threading
+from bisect import bisect_left
+from typing import Callable, Dict, List, Sequence, Tuple
+
+# Upper bounds in seconds, from regex-sized work up to slow IMAP round trips
+LATENCY_BUCKETS = (0.00001, 0.00005, 0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05,
+                   0.1, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+def _escape(value: str) -> str:
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _label_text(names: Sequence[str], values: Tuple, extra: str = '') -> str:
+    parts = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        parts.append(extra)
+    return '{' + ','.join(parts) + '}' if parts else ''
+
+
+def _number(value: float) -> str:
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _CounterChild:
+    __slots__ = ('value', '_lock')
+
+    def __init__(self):
+        self.value = 0
+        self._lock = threading.Lock()
+
+    def inc(self, amount: float = 1):
+        with self._lock:
+            self.value += amount
+
+
+class Counter:
+    """Monotonic counter with optional labels.
+
+    Hot paths should bind their labels once with ``labels()`` and call
+    ``inc()`` on the result, which skips the per-call series lookup.
+    """
+
+    kind = 'counter'
+
+    def __init__(self, name: str, documentation: str, labels: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labels_names = tuple(labels)
+        self._children = {}
+        self._lock = threading.Lock()
+
+    def labels(self, *label_values) -> _CounterChild:
+        child = self._children.get(label_values)
+        if child is None:
+            with self._lock:
+                child = self._children.setdefault(label_values, _CounterChild())
+        return child
+
+    def inc(self, *label_values, amount: float = 1):
+        self.labels(*label_values).inc(amount)
+
+    def value(self, *label_values) -> float:
+        child = self._children.get(label_values)
+        return child.value if child else 0
+
+    def take(self) -> Dict[Tuple, float]:
+        """Non-zero values by label values, resetting them to zero"""
+        with self._lock:
+            children = list(self._children.items())
+        taken = {}
+        for values, child in children:
+            with child._lock:
+                if child.value:
+                    taken[values], child.value = child.value, 0
+        return taken
+
+    def merge(self, taken: Dict[Tuple, float]):
+        for values, amount in taken.items():
+            self.labels(*values).inc(amount)
+
+    def samples(self) -> List[str]:
+        with self._lock:
+            items = sorted((values, child.value) for values, child in self._children.items())
+        if not items and not self.labels_names:
+            items = [((), 0)]
+        return [f"{self.name}{_label_text(self.labels_names, values)} {_number(v)}" for values, v in items]
+
+
+class _HistogramChild:
+    __slots__ = ('buckets', 'series', '_lock')
+
+    def __init__(self, buckets: Tuple[float, ...]):
+        self.buckets = buckets
+        # One slot per bucket, then +Inf overflow, sum and count
+        self.series = [0] * (len(buckets) + 3)
+        self._lock = threading.Lock()
+
+    def observe(self, value: float):
+        index = bisect_left(self.buckets, value)
+        series = self.series
+        with self._lock:
+            series[index] += 1
+            series[-2] += value
+            series[-1] += 1
+
+
+class Histogram:
+    """Cumulative-bucket histogram with optional labels, bound with ``labels()`` like Counter"""
+
+    kind = 'histogram'
+
+    def __init__(self, name: str, documentation: str, labels: Sequence[str] = (),
+                 buckets: Sequence[float] = LATENCY_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labels_names = tuple(labels)
+        self.buckets = tuple(sorted(buckets))
+        self._children = {}
+        self._lock = threading.Lock()
+
+    def labels(self, *label_values) -> _HistogramChild:
+        child = self._children.get(label_values)
+        if child is None:
+            with self._lock:
+                child = self._children.setdefault(label_values, _HistogramChild(self.buckets))
+        return child
+
+    def observe(self, value: float, *label_values):
+        self.labels(*label_values).observe(value)
+
+    def count(self, *label_values) -> int:
+        child = self._children.get(label_values)
+        return child.series[-1] if child else 0
+
+    def take(self) -> Dict[Tuple, List[float]]:
+        """Series of every observed child by label values, resetting them to zero"""
+        with self._lock:
+            children = list(self._children.items())
+        taken = {}
+        for values, child in children:
+            with child._lock:
+                if child.series[-1]:
+                    taken[values] = list(child.series)
+                    child.series[:] = [0] * len(child.series)
+        return taken
+
+    def merge(self, taken: Dict[Tuple, List[float]]):
+        for values, series in taken.items():
+            child = self.labels(*values)
+            with child._lock:
+                for index, value in enumerate(series):
+                    child.series[index] += value
+
+    def samples(self) -> List[str]:
+        with self._lock:
+            children = sorted(self._children.items())
+        lines = []
+        for values, child in children:
+            with child._lock:
+                series = list(child.series)
+            cumulative = 0
+            for bound, hits in zip(self.buckets + (float('inf'),), series):
+                cumulative += hits
+                le = f'le="{_number(bound)}"'
+                lines.append(f"{self.name}_bucket{_label_text(self.labels_names, values, le)} {cumulative}")
+            lines.append(f"{self.name}_sum{_label_text(self.labels_names, values)} {_number(series[-2])}")
+            lines.append(f"{self.name}_count{_label_text(self.labels_names, values)} {series[-1]}")
+        return lines
+
+
+class CallbackMetric:
+    """Counter or gauge read from a callable at render time.
+
+    The callable returns one value, or a {label value: value} dict.
+    """
+
+    def __init__(self, name: str, documentation: str, func: Callable, label: str = '', kind: str = 'gauge'):
+        self.name = name
+        self.documentation = documentation
+        self.func = func
+        self.label = label
+        self.kind = kind
+
+    def samples(self) -> List[str]:
+        try:
+            value = self.func()
+        except Exception:
+            return []
+        if isinstance(value, dict):
+            return [f"{self.name}{_label_text((self.label,), (key,))} {_number(v)}"
+                    for key, v in sorted(value.items())]
+        return [f"{self.name} {_number(value)}"]
+
+
+class Registry:
+    """Named collection of metrics, rendered together"""
+
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def counter(self, name: str, documentation: str, labels: Sequence[str] = ()) -> Counter:
+        return self._register(Counter(name, documentation, labels))
+
+    def histogram(self, name: str, documentation: str, labels: Sequence[str] = (),
+                  buckets: Sequence[float] = LATENCY_BUCKETS) -> Histogram:
+        return self._register(Histogram(name, documentation, labels, buckets))
+
+    def callback(self, name: str, documentation: str, func: Callable, label: str = '',
+                 kind: str = 'gauge') -> CallbackMetric:
+        return self._register(CallbackMetric(name, documentation, func, label, kind))
+
+    def take(self) -> Dict[str, Dict]:
+        """Counter and histogram values recorded since the last take(), by metric name.
+
+        Values are reset as they are taken, so a worker process can send
+        what it recorded per task to the parent, which merge()s it.
+        """
+        with self._lock:
+            metrics = list(self._metrics.values())
+        taken = {}
+        for metric in metrics:
+            if isinstance(metric, (Counter, Histogram)):
+                values = metric.take()
+                if values:
+                    taken[metric.name] = values
+        return taken
+
+    def merge(self, taken: Dict[str, Dict]):
+        """Add values taken from another process's registry; unknown names are ignored"""
+        with self._lock:
+            metrics = {name: self._metrics.get(name) for name in taken}
+        for name, values in taken.items():
+            if isinstance(metrics[name], (Counter, Histogram)):
+                metrics[name].merge(values)
+
+    def render(self) -> str:
+        """All metrics in the Prometheus text format (version 0.0.4)"""
+        lines = []
+        with self._lock:
+            metrics = list(self._metrics.values())
+        for metric in metrics:
+            lines.append(f"# HELP {metric.name} {metric.documentation}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            lines.extend(metric.samples())
+        return '\n'.join(lines) + '\n'
+
+    def _register(self, metric):
+        with self._lock:
+            existing = self._metrics.get(metric.name)
+            if existing is not None:
+                return existing
+            self._metrics[metric.name] = metric
+            return metric
+
+
+REGISTRY = Registry()
+
+IMAP_LOGIN_SECONDS = REGISTRY.histogram(
+    'cashflow_imap_login_seconds', 'IMAP connect and login latency', ['outcome'])
+IMAP_COMMAND_SECONDS = REGISTRY.histogram(
+    'cashflow_imap_command_seconds', 'IMAP command round-trip latency', ['command'])
+IMAP_COMMAND_ERRORS = REGISTRY.counter(
+    'cashflow_imap_command_errors_total', 'IMAP commands that failed or returned non-OK', ['command'])
+IMAP_THROTTLES = REGISTRY.counter(
+    'cashflow_imap_throttles_total', 'IMAP commands the provider throttled, by outcome', ['command', 'outcome'])
+IMAP_FETCH_BYTES = REGISTRY.counter(
+    'cashflow_imap_fetch_bytes_total', 'Raw message bytes received from FETCH')
+IMAP_FETCH_MESSAGES = REGISTRY.counter(
+    'cashflow_imap_fetch_messages_total', 'Messages received from FETCH')
+PREFILTER_SKIPPED = REGISTRY.counter(
+    'cashflow_prefilter_skipped_total', 'Messages whose body was not downloaded because no template sender matched')
+PARSE_STAGE_SECONDS = REGISTRY.histogram(
+    'cashflow_parse_stage_seconds', 'Time spent per message in each parsing stage', ['stage'])
+TEMPLATE_HITS = REGISTRY.counter(
+    'cashflow_template_hits_total', 'Messages matched by each bank template', ['template'])
+TEMPLATE_MISSES = REGISTRY.counter(
+    'cashflow_template_misses_total', 'Messages no bank template matched')
+TEMPLATE_FIELD_MISSES = REGISTRY.counter(
+    'cashflow_template_field_misses_total', 'Template fields none of whose patterns matched',
+    ['template', 'field'])
+ZERO_AMOUNT_DROPS = REGISTRY.counter(
+    'cashflow_zero_amount_drops_total', 'Matched messages dropped because no amount was found',
+    ['template'])
+TRANSACTIONS_PARSED = REGISTRY.counter(
+    'cashflow_transactions_parsed_total', 'Transactions produced by the parser', ['template'])
+BATCH_PARSE_SECONDS = REGISTRY.histogram(
+    'cashflow_batch_parse_seconds', 'Time to parse one /api/parse batch, inline or on the worker pool', ['mode'])
+BATCH_PARSE_RECORDS = REGISTRY.counter(
+    'cashflow_batch_parse_records_total', 'Records received by /api/parse, by outcome', ['outcome'])
+
+
+def render() -> str:
+    return REGISTRY.render()
@@ -0,0 +1,111 @@
+#!/usr/bin/env python3
+"""
+Concurrent multi-account sync for CashFlow AI
+Runs several mailboxes in parallel and merges their transactions
+"""
+
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional
+
+from email_parser import iter_sync_mailbox, mailbox_session
+
+logger = logging.getLogger(__name__)
+
+
+class MultiAccountSync:
+    """Bounded thread pool that syncs many mailboxes at once.
+
+    At most ``max_workers`` mailboxes are synced in total and at most
+    ``per_server_limit`` of them against the same IMAP server, so one
+    provider is never hit with more sessions than it tolerates.
+    """
+
+    def __init__(self, max_workers: int = 8, per_server_limit: int = 4, pool=None, cache=None, store=None):
+        self.per_server_limit = per_server_limit
+        self.pool = pool
+        self.cache = cache
+        self.store = store
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='mailbox-sync')
+        self._server_slots = {}
+        self._lock = threading.Lock()
+
+    def sync(self, accounts: List[Dict], batch_size: Optional[int] = None, checkpoints=None,
+             prefilter: Optional[str] = None, fetch_mode: str = 'full', keep_raw: bool = True) -> Dict:
+        """Sync every account and merge the results.
+
+        Each account is a dict with ``email_address``, ``app_password`` and
+        optional ``imap_server``, ``folders``, ``prefilter`` and
+        ``fetch_mode`` (defaulting to the ones given here). Returns the merged transactions in date
+        order plus a per-account summary.
+        """
+        futures = []
+        seen = set()
+        for account in accounts:
+            key = (account.get('imap_server', 'imap.gmail.com'), (account.get('email_address') or '').lower())
+            if key in seen:
+                continue
+            seen.add(key)
+            futures.append(self._executor.submit(self._sync_account, account, batch_size, checkpoints,
+                                                 account.get('prefilter', prefilter) or None,
+                                                 account.get('fetch_mode') or fetch_mode, keep_raw))
+
+        results = [f.result() for f in futures]
+        transactions = [tx for result in results for tx in result.pop('transactions')]
+        transactions.sort(key=lambda tx: (tx['date'], tx['time']))
+        return {'transactions': transactions, 'accounts': results}
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False)
+
+    def _slot(self, imap_server: str) -> threading.BoundedSemaphore:
+        with self._lock:
+            slot = self._server_slots.get(imap_server)
+            if slot is None:
+                slot = self._server_slots[imap_server] = threading.BoundedSemaphore(self.per_server_limit)
+            return slot
+
+    def _sync_account(self, account: Dict, batch_size: Optional[int], checkpoints,
+                      prefilter: Optional[str], fetch_mode: str = 'full', keep_raw: bool = True) -> Dict:
+        imap_server = account.get('imap_server', 'imap.gmail.com')
+        email_address = account.get('email_address')
+        app_password = account.get('app_password')
+        folders = account.get('folders') or ['INBOX']
+        result = {'email_address': email_address, 'imap_server': imap_server,
+                  'count': 0, 'throttled': 0, 'unmarked': [], 'error': '', 'transactions': []}
+        progress = {}
+        registered = False
+
+        if not email_address or not app_password:
+            result['error'] = 'Missing email credentials'
+            return result
+
+        try:
+            with self._slot(imap_server):
+                with mailbox_session(imap_server, email_address, app_password, self.pool) as parser:
+                    if parser is None:
+                        result['error'] = 'Connection failed'
+                        return result
+                    if self.store is not None:
+                        self.store.register(email_address, imap_server, app_password)
+                        registered = True
+                    # One IMAP session can only select one folder at a time
+                    for folder in folders:
+                        transactions = iter_sync_mailbox(parser, folder, batch_size, checkpoints, self.cache,
+                                                         progress, prefilter=prefilter, fetch_mode=fetch_mode,
+                                                         keep_raw=keep_raw)
+                        result['transactions'].extend(transactions)
+        except Exception as e:
+            logger.error(f"Sync error for {email_address}: {e}")
+            result['error'] = str(e)
+
+        result['count'] = len(result['transactions'])
+        result['throttled'] = progress.get('throttled', 0)
+        result['unmarked'] = progress.get('unmarked', [])
+        if registered and result['transactions']:
+            try:
+                self.store.add(email_address, result['transactions'])
+            except Exception as e:
+                logger.error(f"Could not store transactions for {email_address}: {e}")
+        return result
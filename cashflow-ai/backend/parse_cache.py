@@ -0,0 +1,225 @@
+#!/usr/bin/env python3
+"""
+Content-addressed parse-result cache for CashFlow AI
+Skips re-parsing messages that were already parsed under the same templates
+"""
+
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import threading
+from collections import OrderedDict
+from dataclasses import fields
+from datetime import datetime, timezone
+from time import perf_counter
+from typing import Dict, Optional, Tuple
+
+from email_parser import ParsedTransaction, get_compiled_templates, parse_email_transaction
+from metrics import PARSE_STAGE_SECONDS, TEMPLATE_HITS, TEMPLATE_MISSES, TRANSACTIONS_PARSED
+
+logger = logging.getLogger(__name__)
+
+_STAGE_MATCH_TEMPLATE = PARSE_STAGE_SECONDS.labels('match_template')
+
+DEFAULT_CACHE_PATH = os.getenv('PARSE_CACHE_DB', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'parse_cache.db'))
+
+# Stored for messages no template matched, so they are not re-parsed either
+_NO_TRANSACTION = 'null'
+# Entry key holding the name of the template that matched, so hits can be
+# counted per template; an entry with only this key is a matched message
+# that produced no transaction
+_TEMPLATE_KEY = '_template'
+# Layout of stored entries, kept in the stored template version so entries
+# written by an older layout are purged like a template change
+_ENTRY_FORMAT = '2'
+# Per-delivery fields, refreshed from the message on every cache hit
+_DELIVERY_FIELDS = ('email_id', 'raw_email')
+# All fields are flat scalars, so a shallow copy replaces asdict()'s deepcopy
+_STORED_FIELDS = [f.name for f in fields(ParsedTransaction) if f.name not in _DELIVERY_FIELDS]
+
+
+def cache_key(email_data: Dict, template_version: str) -> str:
+    """Hash of the message identity, content and template set it was parsed with"""
+    date = email_data.get('date')
+    parts = [
+        email_data.get('message_id', ''),
+        email_data.get('sender', ''),
+        email_data.get('body', ''),
+        date.isoformat() if isinstance(date, datetime) else str(date or ''),
+        template_version,
+    ]
+    digest = hashlib.sha256()
+    for part in parts:
+        digest.update(part.encode('utf-8', errors='ignore'))
+        digest.update(b'\x00')
+    return digest.hexdigest()
+
+
+class ParseCache:
+    """Two-tier cache of parse_email_transaction results.
+
+    A byte-bounded in-memory LRU sits in front of an optional SQLite table.
+    Keys include the compiled template version, and both tiers are purged
+    as soon as a different template set is seen.
+    """
+
+    def __init__(self, max_bytes: int = 32 * 1024 * 1024, path: Optional[str] = None,
+                 write_batch: int = 256):
+        self.max_bytes = max_bytes
+        self.path = path
+        self.write_batch = write_batch
+        self._pending = {}  # key -> row not yet written to SQLite
+        self._memory = OrderedDict()  # key -> serialized transaction
+        self._memory_bytes = 0
+        self._lock = threading.Lock()
+        self._version = None
+        self._conn = None
+        self.stats = {'memory_hits': 0, 'disk_hits': 0, 'misses': 0, 'evictions': 0}
+        if path:
+            self._conn = sqlite3.connect(path, check_same_thread=False)
+            self._conn.execute('PRAGMA journal_mode=WAL')
+            self._conn.execute('PRAGMA synchronous=NORMAL')
+            self._conn.execute('''
+                CREATE TABLE IF NOT EXISTS parse_cache (
+                    key TEXT PRIMARY KEY,
+                    template_version TEXT NOT NULL,
+                    value TEXT NOT NULL,
+                    created_at TEXT NOT NULL
+                )
+            ''')
+            self._conn.commit()
+
+    def parse(self, email_data: Dict) -> Optional[ParsedTransaction]:
+        """Cached drop-in for parse_email_transaction.
+
+        Template hit and miss and parsed-transaction counters are recorded
+        on cache hits too, so they count every message; field-miss and
+        zero-amount counters only see cold parses.
+        """
+        compiled = get_compiled_templates()
+        version = f"{compiled.version}.{_ENTRY_FORMAT}"
+        key = cache_key(email_data, version)
+        hit, value = self.get(key, version)
+        if not hit:
+            stage_start = perf_counter()
+            template = compiled.match(email_data.get('sender', ''), email_data.get('body', '').strip())
+            _STAGE_MATCH_TEMPLATE.observe(perf_counter() - stage_start)
+            if template is None:
+                TEMPLATE_MISSES.inc()
+                self.put(key, version, None)
+                return None
+            template_name = template.get('name', '')
+            TEMPLATE_HITS.inc(template_name)
+            transaction = parse_email_transaction(email_data, template)
+            self.put(key, version, transaction, template_name)
+            return transaction
+        if value is None:
+            TEMPLATE_MISSES.inc()
+            return None
+        template_name = value.pop(_TEMPLATE_KEY, '')
+        TEMPLATE_HITS.inc(template_name)
+        if not value:
+            return None
+        TRANSACTIONS_PARSED.inc(template_name)
+        value.update({'email_id': email_data.get('id', ''), 'raw_email': email_data.get('raw', '')})
+        return ParsedTransaction(**value)
+
+    def get(self, key: str, version: str) -> Tuple[bool, Optional[Dict]]:
+        """Return (hit, transaction dict or None for a cached non-match)"""
+        with self._lock:
+            self._check_version(version)
+            serialized = self._memory.get(key)
+            if serialized is not None:
+                self._memory.move_to_end(key)
+                self.stats['memory_hits'] += 1
+                return True, json.loads(serialized)
+            pending = self._pending.get(key)
+            if pending is not None:
+                self.stats['memory_hits'] += 1
+                return True, json.loads(pending[2])
+            if self._conn is not None:
+                row = self._conn.execute('SELECT value FROM parse_cache WHERE key = ?', (key,)).fetchone()
+                if row:
+                    self.stats['disk_hits'] += 1
+                    self._remember(key, row[0])
+                    return True, json.loads(row[0])
+            self.stats['misses'] += 1
+            return False, None
+
+    def put(self, key: str, version: str, transaction: Optional[ParsedTransaction],
+            template_name: Optional[str] = None):
+        """Store a parse result in both tiers; ``template_name`` is None when no template matched"""
+        if template_name is None:
+            serialized = _NO_TRANSACTION
+        else:
+            entry = {name: getattr(transaction, name) for name in _STORED_FIELDS} if transaction else {}
+            entry[_TEMPLATE_KEY] = template_name
+            serialized = json.dumps(entry)
+        with self._lock:
+            self._check_version(version)
+            self._remember(key, serialized)
+            if self._conn is not None:
+                self._pending[key] = (key, version, serialized, datetime.now(timezone.utc).isoformat())
+                if len(self._pending) >= self.write_batch:
+                    self._flush_locked()
+
+    def flush(self):
+        """Write buffered entries to the SQLite tier"""
+        with self._lock:
+            self._flush_locked()
+
+    def clear(self):
+        with self._lock:
+            self._memory.clear()
+            self._memory_bytes = 0
+            self._pending = {}
+            if self._conn is not None:
+                self._conn.execute('DELETE FROM parse_cache')
+                self._conn.commit()
+
+    def close(self):
+        with self._lock:
+            if self._conn is not None:
+                self._flush_locked()
+                self._conn.close()
+                self._conn = None
+
+    def __len__(self) -> int:
+        return len(self._memory)
+
+    def _flush_locked(self):
+        if not self._pending or self._conn is None:
+            return
+        rows, self._pending = list(self._pending.values()), {}
+        try:
+            with self._conn:
+                self._conn.executemany('INSERT OR REPLACE INTO parse_cache VALUES (?, ?, ?, ?)', rows)
+        except sqlite3.Error as e:
+            logger.error(f"Parse cache write failed: {e}")
+
+    def _remember(self, key: str, serialized: str):
+        previous = self._memory.pop(key, None)
+        if previous is not None:
+            self._memory_bytes -= len(previous)
+        self._memory[key] = serialized
+        self._memory_bytes += len(serialized)
+        while self._memory_bytes > self.max_bytes and len(self._memory) > 1:
+            _, evicted = self._memory.popitem(last=False)
+            self._memory_bytes -= len(evicted)
+            self.stats['evictions'] += 1
+
+    def _check_version(self, version: str):
+        """Drop everything cached under a different template set"""
+        if version == self._version:
+            return
+        if self._version is not None:
+            logger.info(f"Templates changed ({self._version} -> {version}), purging parse cache")
+        self._version = version
+        self._memory.clear()
+        self._memory_bytes = 0
+        self._pending = {key: row for key, row in self._pending.items() if row[1] == version}
+        if self._conn is not None:
+            self._conn.execute('DELETE FROM parse_cache WHERE template_version != ?', (version,))
+            self._conn.commit()
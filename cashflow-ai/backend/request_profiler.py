@@ -0,0 +1,149 @@
+#!/usr/bin/env python3
+"""
+Opt-in request profiling for the CashFlow AI API
+Profiles sampled or header-triggered requests with cProfile and keeps a
+log of recent slow requests
+"""
+
+import cProfile
+import hashlib
+import logging
+import os
+import random
+import re
+import threading
+import time
+from collections import deque
+from datetime import datetime, timezone
+from typing import Dict, List, Optional
+
+from flask import Flask, g, request
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_PROFILE_DIR = os.getenv('PROFILE_DIR', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'profiles'))
+
+_UNSAFE_CHARS_RE = re.compile(r'[^A-Za-z0-9_.-]+')
+
+
+def account_hash(email_address: str) -> str:
+    """Short, non-reversible tag for an account, safe to put in file names and logs"""
+    if not email_address:
+        return 'anonymous'
+    return hashlib.sha256(email_address.strip().lower().encode('utf-8')).hexdigest()[:12]
+
+
+class RequestProfiler:
+    """Per-request cProfile hook with a rotating dump directory.
+
+    A request is profiled when it carries ``X-Profile: <token>`` matching
+    ``header_token``, or at random with probability ``sample_rate``. Both
+    are off by default. Each profile is written as a pstats dump named
+    after the time, endpoint and account hash; only the newest ``keep``
+    dumps are kept. Every request slower than ``slow_ms`` is recorded,
+    profiled or not.
+    """
+
+    def __init__(self, directory: str = DEFAULT_PROFILE_DIR, sample_rate: float = 0.0,
+                 header_token: str = '', slow_ms: float = 1000.0, keep: int = 50, slow_log_size: int = 100):
+        self.directory = directory
+        self.sample_rate = sample_rate
+        self.header_token = header_token
+        self.slow_ms = slow_ms
+        self.keep = keep
+        self._slow = deque(maxlen=slow_log_size)
+        self._lock = threading.Lock()
+
+    def init_app(self, app: Flask):
+        app.before_request(self._before)
+        app.after_request(self._after)
+
+    def slow_requests(self, limit: Optional[int] = None) -> List[Dict]:
+        """Recent slow requests, newest first"""
+        with self._lock:
+            entries = list(reversed(self._slow))
+        return entries[:limit] if limit else entries
+
+    def _wants_profile(self) -> bool:
+        if self.header_token and request.headers.get('X-Profile') == self.header_token:
+            return True
+        return self.sample_rate > 0 and random.random() < self.sample_rate
+
+    def _before(self):
+        g.profile_started = time.perf_counter()
+        g.profiler = None
+        if self._wants_profile():
+            profiler = cProfile.Profile()
+            try:
+                profiler.enable()
+            except ValueError as e:
+                # Another profiler is already active on this thread
+                logger.error(f"Could not start request profiler: {e}")
+            else:
+                g.profiler = profiler
+
+    def _after(self, response):
+        started = g.pop('profile_started', None)
+        if started is None:
+            return response
+        profiler = g.pop('profiler', None)
+        details = {
+            'method': request.method,
+            'path': request.path,
+            'endpoint': request.endpoint or 'unknown',
+            'account': account_hash(self._account()),
+            'status': response.status_code,
+        }
+        # Streamed bodies are produced after this hook; finish once the
+        # server has sent the last chunk so the profile covers the sync.
+        if response.is_streamed:
+            response.call_on_close(lambda: self._finish(started, profiler, details))
+        else:
+            self._finish(started, profiler, details)
+        return response
+
+    def _account(self) -> str:
+        account = request.headers.get('X-Email-Address', '')
+        if not account and request.is_json:
+            data = request.get_json(silent=True)
+            if isinstance(data, dict):
+                account = data.get('email_address') or ''
+        return account
+
+    def _finish(self, started: float, profiler: Optional[cProfile.Profile], details: Dict):
+        duration_ms = (time.perf_counter() - started) * 1000
+        path = ''
+        if profiler is not None:
+            profiler.disable()
+            path = self._dump(profiler, details)
+        if duration_ms >= self.slow_ms or path:
+            entry = dict(details, duration_ms=round(duration_ms, 1), profile=os.path.basename(path),
+                         at=datetime.now(timezone.utc).isoformat())
+            with self._lock:
+                self._slow.append(entry)
+            if duration_ms >= self.slow_ms:
+                logger.info(f"Slow request {details['method']} {details['path']} "
+                            f"({details['account']}): {duration_ms:.0f} ms")
+
+    def _dump(self, profiler: cProfile.Profile, details: Dict) -> str:
+        stamp = datetime.now(timezone.utc).strftime('%Y%m%dT%H%M%S%f')
+        name = _UNSAFE_CHARS_RE.sub('_', f"{stamp}-{details['endpoint']}-{details['account']}") + '.prof'
+        path = os.path.join(self.directory, name)
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            profiler.dump_stats(path)
+            self._rotate()
+        except OSError as e:
+            logger.error(f"Could not write profile {path}: {e}")
+            return ''
+        return path
+
+    def _rotate(self):
+        """Delete the oldest dumps beyond ``keep``"""
+        with self._lock:
+            dumps = sorted(f for f in os.listdir(self.directory) if f.endswith('.prof'))
+            for name in dumps[:max(0, len(dumps) - self.keep)]:
+                try:
+                    os.remove(os.path.join(self.directory, name))
+                except OSError:
+                    pass
@@ -0,0 +1,212 @@
+#!/usr/bin/env python3
+"""
+SQLite-backed persistence for the CashFlow AI backend
+Keeps per-mailbox sync checkpoints and parsed transactions between requests
+"""
+
+import hashlib
+import os
+import sqlite3
+import threading
+from dataclasses import fields
+from datetime import datetime, timezone
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from email_parser import ParsedTransaction
+
+DEFAULT_DB_PATH = os.getenv('SYNC_STATE_DB', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'sync_state.db'))
+
+
+class CheckpointStore:
+    """Last processed UID per (server, account, folder), tagged with UIDVALIDITY"""
+    
+    def __init__(self, path: str = DEFAULT_DB_PATH):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('''
+            CREATE TABLE IF NOT EXISTS sync_checkpoints (
+                server TEXT NOT NULL,
+                account TEXT NOT NULL,
+                folder TEXT NOT NULL,
+                uidvalidity INTEGER NOT NULL,
+                last_uid INTEGER NOT NULL,
+                updated_at TEXT NOT NULL,
+                PRIMARY KEY (server, account, folder)
+            )
+        ''')
+        self._conn.commit()
+    
+    def get(self, server: str, account: str, folder: str) -> Optional[Tuple[int, int]]:
+        """Return (uidvalidity, last_uid) for a folder, or None if never synced"""
+        with self._lock:
+            row = self._conn.execute(
+                'SELECT uidvalidity, last_uid FROM sync_checkpoints '
+                'WHERE server = ? AND account = ? AND folder = ?',
+                (server, account.lower(), folder)
+            ).fetchone()
+        return (row[0], row[1]) if row else None
+    
+    def save(self, server: str, account: str, folder: str, uidvalidity: int, last_uid: int):
+        """Record the highest UID fully processed for a folder"""
+        with self._lock:
+            self._conn.execute(
+                'INSERT OR REPLACE INTO sync_checkpoints VALUES (?, ?, ?, ?, ?, ?)',
+                (server, account.lower(), folder, uidvalidity, last_uid,
+                 datetime.now(timezone.utc).isoformat())
+            )
+            self._conn.commit()
+    
+    def reset(self, server: str, account: str, folder: Optional[str] = None):
+        """Forget checkpoints so the next sync rescans the mailbox"""
+        with self._lock:
+            if folder is None:
+                self._conn.execute('DELETE FROM sync_checkpoints WHERE server = ? AND account = ?',
+                                   (server, account.lower()))
+            else:
+                self._conn.execute('DELETE FROM sync_checkpoints WHERE server = ? AND account = ? AND folder = ?',
+                                   (server, account.lower(), folder))
+            self._conn.commit()
+    
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+class AccountConflict(Exception):
+    """The account is already registered with a different IMAP server"""
+
+
+def secret_digest(secret: str) -> str:
+    """SHA-256 of a credential, so it can be compared without being stored"""
+    return hashlib.sha256((secret or '').encode('utf-8')).hexdigest()
+
+
+def content_key(tx: Dict) -> str:
+    """Stable fingerprint of one bank alert, independent of how it was fetched"""
+    payload = '\x00'.join(str(tx.get(name, '')) for name in ('date', 'time', 'notes'))
+    return hashlib.sha256(payload.encode('utf-8', errors='ignore')).hexdigest()
+
+
+class TransactionStore:
+    """Parsed transactions per account with idempotent inserts and keyset deltas.
+
+    ``seq`` is an ever-increasing row id used as the delta cursor. Replays
+    are dropped by unique indexes on (account, transaction_id) and on
+    (account, content key); ``email_id`` is kept but not unique, because
+    IMAP sequence numbers are reused after messages are expunged.
+
+    An account belongs to the IMAP server it was first registered with: a
+    login to any other server cannot replace its credential, so nobody can
+    claim an address by pointing a sync at a server that accepts anything.
+    """
+    
+    # raw_email is debugging data; it is not persisted
+    COLUMNS = [f.name for f in fields(ParsedTransaction) if f.name != 'raw_email']
+    
+    def __init__(self, path: str = DEFAULT_DB_PATH):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.row_factory = sqlite3.Row
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('PRAGMA synchronous=NORMAL')
+        self._conn.executescript(f'''
+            CREATE TABLE IF NOT EXISTS accounts (
+                account TEXT PRIMARY KEY,
+                secret_digest TEXT NOT NULL,
+                server TEXT NOT NULL DEFAULT ''
+            );
+            CREATE TABLE IF NOT EXISTS transactions (
+                seq INTEGER PRIMARY KEY AUTOINCREMENT,
+                account TEXT NOT NULL,
+                content_key TEXT NOT NULL,
+                {', '.join(self.COLUMNS)},
+                stored_at TEXT NOT NULL
+            );
+            CREATE UNIQUE INDEX IF NOT EXISTS ux_transactions_tx_id
+                ON transactions (account, transaction_id) WHERE transaction_id != '';
+            CREATE UNIQUE INDEX IF NOT EXISTS ux_transactions_content
+                ON transactions (account, content_key);
+            CREATE INDEX IF NOT EXISTS ix_transactions_email_id
+                ON transactions (account, email_id);
+            CREATE INDEX IF NOT EXISTS ix_transactions_cursor
+                ON transactions (account, seq);
+        ''')
+        if 'server' not in {row['name'] for row in self._conn.execute('PRAGMA table_info(accounts)')}:
+            # Stores created before accounts were tied to a server
+            self._conn.execute("ALTER TABLE accounts ADD COLUMN server TEXT NOT NULL DEFAULT ''")
+        self._conn.commit()
+        self._insert = (
+            f"INSERT OR IGNORE INTO transactions (account, content_key, {', '.join(self.COLUMNS)}, stored_at) "
+            f"VALUES (?, ?, {', '.join('?' for _ in self.COLUMNS)}, ?)"
+        )
+    
+    def register(self, account: str, server: str, secret: str):
+        """Record the credential ``server`` has just accepted for ``account``.
+
+        Only call this after a successful IMAP login. Raises AccountConflict
+        if the account belongs to another server, or if it was registered
+        before servers were recorded and ``secret`` does not match.
+        """
+        account = account.lower()
+        server = (server or '').strip().lower()
+        digest = secret_digest(secret)
+        with self._lock, self._conn:
+            row = self._conn.execute('SELECT secret_digest, server FROM accounts WHERE account = ?',
+                                     (account,)).fetchone()
+            if row is not None and row['server'] != server and (row['server'] or row['secret_digest'] != digest):
+                raise AccountConflict(f"{account} is registered with another IMAP server")
+            self._conn.execute('INSERT OR REPLACE INTO accounts VALUES (?, ?, ?)', (account, digest, server))
+
+    def add(self, account: str, transactions: Iterable[Dict]) -> int:
+        """Insert transactions, skipping ones already stored. Returns the number inserted.
+
+        Register the account first; stored transactions are only readable
+        with its registered credential.
+        """
+        account = account.lower()
+        now = datetime.now(timezone.utc).isoformat()
+        rows = [[account, content_key(tx)] + [tx.get(c, '') for c in self.COLUMNS] + [now]
+                for tx in transactions]
+        with self._lock, self._conn:
+            before = self._conn.total_changes
+            self._conn.executemany(self._insert, rows)
+            return self._conn.total_changes - before
+    
+    def verify(self, account: str, secret: str) -> bool:
+        """Check a credential against the one recorded at the last sync"""
+        with self._lock:
+            row = self._conn.execute('SELECT secret_digest FROM accounts WHERE account = ?',
+                                     (account.lower(),)).fetchone()
+        return bool(row) and row[0] == secret_digest(secret)
+    
+    def delta(self, account: str, since: int = 0, limit: int = 500,
+              columns: Optional[List[str]] = None) -> Tuple[List[Dict], int, bool]:
+        """Transactions stored after cursor ``since``, optionally only ``columns``.
+
+        Returns (transactions, next cursor, has_more); pass the cursor back
+        as ``since`` to continue.
+        """
+        columns = [c for c in columns if c in self.COLUMNS] if columns else self.COLUMNS
+        with self._lock:
+            rows = self._conn.execute(
+                f"SELECT seq, {', '.join(columns)} FROM transactions "
+                'WHERE account = ? AND seq > ? ORDER BY seq LIMIT ?',
+                (account.lower(), since, limit + 1)
+            ).fetchall()
+        has_more = len(rows) > limit
+        rows = rows[:limit]
+        cursor = rows[-1]['seq'] if rows else since
+        return [{c: row[c] for c in columns} for row in rows], cursor, has_more
+    
+    def latest_cursor(self, account: str) -> int:
+        with self._lock:
+            row = self._conn.execute('SELECT MAX(seq) FROM transactions WHERE account = ?',
+                                     (account.lower(),)).fetchone()
+        return row[0] or 0
+    
+    def close(self):
+        with self._lock:
+            self._conn.close()
@@ -0,0 +1,146 @@
+#!/usr/bin/env python3
+"""
+Fuzz and stress harness for extract_counterparty
+Feeds adversarial and random bodies of growing size and fails if runtime
+grows faster than linearly or exceeds a per-KB budget
+"""
+
+import argparse
+import random
+import re
+import sys
+import time
+from typing import Callable, Dict, List
+
+from email_parser import extract_counterparty
+
+# The pattern cascade extract_counterparty used before the single-scan
+# rewrite, kept only to show the difference with --legacy
+LEGACY_PATTERNS = [re.compile(p, re.IGNORECASE) for p in [
+    r'\bto\s+([A-Z][A-Za-z.\'\s-]{1,80}?)\s+on\s+\d{2}/\d{2}/\d{4}',
+    r'\bto\s+([A-Z][A-Za-z.\'\s-]{1,80}?)\s+at\s+\d{2}:\d{2}:\d{2}',
+    r'\bto\s+([A-Z][A-Za-z.\'\s-]{1,80}?)\b,',
+    r'\bto\s+([A-Z][A-Za-z.\'\s-]{1,80}?)\s+on\b',
+    r'\bfrom\s+([A-Z][A-Za-z.\'\s-]{1,80}?)\s+on\b',
+    r'\bfrom\s+([A-Z][A-Za-z.\'\s-]{1,80}?)\b[,.]',
+    r'credited with ETB\s*[0-9,]+(?:\.\d+)?\s+by\s+([A-Z][A-Za-z.\'\s-]{1,80}?)\b',
+    r'credited by\s+([A-Z][A-Za-z.\'\s-]{1,80}?)\b',
+    r'by\s+([A-Z][A-Za-z.\'\s-]{1,80}?)\s*.',
+    r'BY FROM\s+([A-Z][A-Za-z.\'\s-]{1,80}?)\b',
+    r'BY\s+([A-Z][A-Za-z.\'\s-]{1,80}?)\b',
+    r'\bto\s+(.+?)\s+account number\b',
+    r'\bfrom\s+(.+?)\s+account\b',
+]]
+
+
+def legacy_extract_counterparty(body: str) -> str:
+    for pat in LEGACY_PATTERNS:
+        m = pat.search(body)
+        if m:
+            return m.group(1).strip()
+    return ''
+
+
+ADVERSARIAL: Dict[str, Callable[[int], str]] = {
+    # Many anchors, none followed by a confirming terminator
+    'to-chain': lambda size: ('to abc ' * (size // 7 + 1))[:size],
+    'from-chain': lambda size: ('from Abc ' * (size // 9 + 1))[:size],
+    'by-chain': lambda size: ('by ' * (size // 3 + 1))[:size],
+    # One anchor followed by an endless name run
+    'long-name': lambda size: 'to ' + ('Abebe ' * (size // 6 + 1))[:size],
+    'whitespace': lambda size: 'to' + ' ' * size + 'x',
+    'name-chars': lambda size: 'to A' + ("'.-" * (size // 3 + 1))[:size],
+}
+
+_TOKENS = ['to', 'from', 'by', 'BY FROM', 'credited by', 'on', 'at', 'account', 'number', ',', '.',
+           '(', 'ETB', '1,000.00', '12/03/2024', 'Abebe', 'KEBEDE', "O'Neil", '-', '\n', '  ']
+
+
+def random_body(rng: random.Random, size: int) -> str:
+    parts = []
+    length = 0
+    while length < size:
+        token = rng.choice(_TOKENS)
+        parts.append(token)
+        length += len(token) + 1
+    return ' '.join(parts)[:size]
+
+
+def _time_call(func: Callable[[str], str], body: str, repeat: int) -> float:
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func(body)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def run_stress(sizes: List[int], repeat: int, func: Callable[[str], str]) -> Dict[str, List[float]]:
+    """Best-of-``repeat`` seconds per adversarial family and body size"""
+    return {name: [_time_call(func, make(size), repeat) for size in sizes]
+            for name, make in ADVERSARIAL.items()}
+
+
+def run_fuzz(count: int, max_size: int, seed: int) -> Dict:
+    """Random token soup: must never raise and must return a short string"""
+    rng = random.Random(seed)
+    worst = 0.0
+    for _ in range(count):
+        body = random_body(rng, rng.randint(0, max_size))
+        start = time.perf_counter()
+        name = extract_counterparty(body)
+        worst = max(worst, time.perf_counter() - start)
+        assert isinstance(name, str) and len(name) <= 200, repr(name)
+    return {'bodies': count, 'worst_ms': round(worst * 1000, 3)}
+
+
+def main(argv: List[str] = None) -> int:
+    parser = argparse.ArgumentParser(description='Stress extract_counterparty for super-linear runtime')
+    parser.add_argument('--sizes', default='1000,4000,16000,64000,256000',
+                        help='comma-separated body sizes in characters')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--fuzz', type=int, default=2000, help='random bodies to fuzz')
+    parser.add_argument('--fuzz-max-size', type=int, default=4000, help='largest random body')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--slack', type=float, default=4.0,
+                        help='allowed factor over linear growth between smallest and largest size')
+    parser.add_argument('--budget-us-per-kb', type=float, default=2000.0,
+                        help='fail if any body takes longer than this per KB')
+    parser.add_argument('--legacy', action='store_true',
+                        help='also time the old pattern cascade on the smaller sizes')
+    parser.add_argument('--legacy-max-size', type=int, default=1000,
+                        help='largest body fed to the old cascade, which is cubic on whitespace runs')
+    args = parser.parse_args(argv)
+
+    sizes = [int(s) for s in args.sizes.split(',')]
+    failures = []
+
+    results = run_stress(sizes, args.repeat, extract_counterparty)
+    print(f"{'family':<14}" + ''.join(f"{size:>12}" for size in sizes) + '   (ms)')
+    for name, timings in results.items():
+        print(f"{name:<14}" + ''.join(f"{t * 1000:>12.3f}" for t in timings))
+        growth = timings[-1] / max(timings[0], 1e-7)
+        allowed = sizes[-1] / sizes[0] * args.slack
+        if growth > allowed:
+            failures.append(f"{name}: grew {growth:.0f}x for {sizes[-1] / sizes[0]:.0f}x input")
+        for size, t in zip(sizes, timings):
+            if t * 1e6 / (size / 1000) > args.budget_us_per_kb:
+                failures.append(f"{name}: {t * 1000:.1f} ms for {size} chars is over budget")
+
+    if args.legacy:
+        print('legacy cascade:')
+        legacy_sizes = [size for size in sizes if size <= args.legacy_max_size] or sizes[:1]
+        legacy = run_stress(legacy_sizes, 1, legacy_extract_counterparty)
+        for name, timings in legacy.items():
+            print(f"{name:<14}" + ''.join(f"{t * 1000:>12.3f}" for t in timings))
+
+    fuzz = run_fuzz(args.fuzz, args.fuzz_max_size, args.seed)
+    print(f"fuzz: {fuzz['bodies']} random bodies, worst {fuzz['worst_ms']} ms")
+
+    for line in failures:
+        print(f"FAIL {line}")
+    return 1 if failures else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,187 @@
+#!/usr/bin/env python3
+"""
+Background sync jobs for CashFlow AI
+Runs mailbox syncs on a bounded worker pool so HTTP requests return at once
+"""
+
+import logging
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from datetime import datetime, timezone
+from typing import Callable, Dict, List, Optional, Tuple
+
+from email_parser import FETCH_BATCH_SIZE, iter_sync_mailbox, mailbox_session
+from storage import secret_digest
+
+logger = logging.getLogger(__name__)
+
+
+class QueueFull(Exception):
+    """Raised when no more sync jobs can be accepted"""
+
+
+def _now() -> str:
+    return datetime.now(timezone.utc).isoformat()
+
+
+@dataclass
+class SyncJob:
+    """State of one queued or running mailbox sync"""
+    job_id: str
+    email_address: str
+    imap_server: str
+    folders: List[str]
+    status: str = 'queued'  # queued, running, done or failed
+    progress: Dict = field(default_factory=lambda: {'fetched': 0, 'parsed': 0})
+    error: str = ''
+    cursor: int = 0
+    created_at: str = field(default_factory=_now)
+    started_at: str = ''
+    finished_at: str = ''
+    transactions: List[Dict] = field(default_factory=list)
+    finished: float = 0.0  # monotonic, for expiry
+    secret_digest: str = ''  # of the submitter's password, never serialized
+
+    def owned_by(self, email_address: str, app_password: str) -> bool:
+        """Whether these are the credentials the job was submitted with"""
+        return (email_address or '').lower() == self.email_address.lower() and \
+            secret_digest(app_password or '') == self.secret_digest
+
+    def to_dict(self, include_transactions: bool = True) -> Dict:
+        data = {
+            'job_id': self.job_id,
+            'status': self.status,
+            'email_address': self.email_address,
+            'imap_server': self.imap_server,
+            'folders': self.folders,
+            'fetched': self.progress.get('fetched', 0),
+            'parsed': self.progress.get('parsed', 0),
+            'throttled': self.progress.get('throttled', 0),
+            'unmarked': list(self.progress.get('unmarked', [])),
+            'error': self.error,
+            'created_at': self.created_at,
+            'started_at': self.started_at,
+            'finished_at': self.finished_at,
+        }
+        if self.status == 'done':
+            data['count'] = len(self.transactions)
+            data['cursor'] = self.cursor
+            if include_transactions:
+                data['transactions'] = self.transactions
+        return data
+
+
+class SyncJobQueue:
+    """Bounded pool of sync workers with per-mailbox de-duplication.
+
+    At most ``max_workers`` syncs run at once and at most ``max_pending``
+    jobs wait or run in total. Submitting a mailbox that already has a job
+    in flight with the same password returns that job instead of starting
+    another one. Finished
+    jobs are kept for ``keep_seconds`` so clients can collect the results.
+    """
+
+    def __init__(self, max_workers: int = 4, max_pending: int = 64, keep_seconds: float = 3600.0,
+                 pool=None, cache=None, store=None, checkpoints: Optional[Callable] = None):
+        self.max_pending = max_pending
+        self.keep_seconds = keep_seconds
+        self.pool = pool
+        self.cache = cache
+        self.store = store
+        # Called lazily, so the checkpoint store is only opened when needed
+        self.checkpoints = checkpoints
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='sync-job')
+        self._jobs = OrderedDict()  # job_id -> SyncJob, oldest first
+        self._inflight = {}  # (imap_server, account) -> job_id
+        self._lock = threading.Lock()
+
+    def submit(self, imap_server: str, email_address: str, app_password: str,
+               folders: Optional[List[str]] = None, batch_size: Optional[int] = None,
+               incremental: bool = False, prefilter: Optional[str] = None, fetch_mode: str = 'full',
+               keep_raw: bool = True) -> Tuple[SyncJob, bool]:
+        """Queue a sync. Returns (job, created); created is False for a de-duplicated submit"""
+        digest = secret_digest(app_password)
+        # The password is part of the key, so a wrong one never gets another caller's job
+        key = (imap_server, email_address.lower(), digest)
+        with self._lock:
+            self._expire_locked()
+            existing = self._inflight.get(key)
+            if existing is not None:
+                return self._jobs[existing], False
+            if len(self._inflight) >= self.max_pending:
+                raise QueueFull(f"{len(self._inflight)} sync jobs already pending")
+            job = SyncJob(job_id=uuid.uuid4().hex, email_address=email_address,
+                          imap_server=imap_server, folders=folders or ['INBOX'], secret_digest=digest)
+            self._jobs[job.job_id] = job
+            self._inflight[key] = job.job_id
+        self._executor.submit(self._run, job, key, app_password, batch_size, incremental, prefilter,
+                              fetch_mode, keep_raw)
+        return job, True
+
+    def get(self, job_id: str) -> Optional[SyncJob]:
+        with self._lock:
+            self._expire_locked()
+            return self._jobs.get(job_id)
+
+    def stats(self) -> Dict:
+        with self._lock:
+            counts = {'queued': 0, 'running': 0, 'done': 0, 'failed': 0}
+            for job in self._jobs.values():
+                counts[job.status] += 1
+            return counts
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False)
+
+    def _run(self, job: SyncJob, key: Tuple[str, str, str], app_password: str,
+             batch_size: Optional[int], incremental: bool, prefilter: Optional[str],
+             fetch_mode: str = 'full', keep_raw: bool = True):
+        job.status = 'running'
+        job.started_at = _now()
+        checkpoints = self.checkpoints() if incremental and self.checkpoints else None
+        flush_every = batch_size or FETCH_BATCH_SIZE
+        unsaved = 0
+        try:
+            with mailbox_session(job.imap_server, job.email_address, app_password, self.pool) as parser:
+                if parser is None:
+                    raise ConnectionError('Connection failed')
+                if self.store is not None:
+                    self.store.register(job.email_address, job.imap_server, app_password)
+                for folder in job.folders:
+                    for tx in iter_sync_mailbox(parser, folder, batch_size, checkpoints, self.cache,
+                                                job.progress, prefilter, fetch_mode, keep_raw):
+                        job.transactions.append(tx)
+                        unsaved += 1
+                        if self.store is not None and unsaved >= flush_every:
+                            self.store.add(job.email_address, job.transactions[-unsaved:])
+                            unsaved = 0
+            job.status = 'done'
+        except Exception as e:
+            logger.error(f"Sync job {job.job_id} for {job.email_address} failed: {e}")
+            job.error = str(e)
+            job.status = 'failed'
+        finally:
+            try:
+                if self.store is not None:
+                    if unsaved:
+                        self.store.add(job.email_address, job.transactions[-unsaved:])
+                    job.cursor = self.store.latest_cursor(job.email_address)
+            except Exception as e:
+                logger.error(f"Could not store transactions for job {job.job_id}: {e}")
+            job.finished_at = _now()
+            job.finished = time.monotonic()
+            with self._lock:
+                self._inflight.pop(key, None)
+        logger.info(f"Sync job {job.job_id} {job.status}: "
+                    f"{job.progress.get('parsed', 0)}/{job.progress.get('fetched', 0)} messages parsed")
+
+    def _expire_locked(self):
+        """Forget finished jobs older than keep_seconds"""
+        cutoff = time.monotonic() - self.keep_seconds
+        expired = [job_id for job_id, job in self._jobs.items() if job.finished and job.finished < cutoff]
+        for job_id in expired:
+            del self._jobs[job_id]
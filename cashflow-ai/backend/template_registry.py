@@ -0,0 +1,260 @@
+#!/usr/bin/env python3
+"""
+External bank template registry for CashFlow AI
+Loads templates from JSON/YAML files, validates them and hot-swaps the
+compiled set without a restart
+"""
+
+import argparse
+import copy
+import json
+import logging
+import os
+import re
+import sys
+import threading
+from typing import Dict, List, Optional, Tuple
+
+import email_parser
+from email_parser import CompiledTemplates, reload_templates
+
+try:
+    import yaml
+except ImportError:  # YAML files are optional, JSON always works
+    yaml = None
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_TEMPLATES_DIR = os.getenv('TEMPLATES_DIR', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'templates'))
+
+TEMPLATE_EXTENSIONS = ('.json', '.yaml', '.yml')
+
+_KNOWN_KEYS = {'name', 'senders', 'body_patterns', 'account_bank_tag', 'fields', 'enabled'}
+
+# Snapshot of the templates shipped in email_parser, before any reload
+BUILTIN_TEMPLATES = copy.deepcopy(email_parser.TEMPLATES)
+
+
+class TemplateValidationError(ValueError):
+    """Raised when template files do not match the schema; ``errors`` lists every problem"""
+
+    def __init__(self, errors: List[str]):
+        super().__init__('; '.join(errors))
+        self.errors = errors
+
+
+def _check_patterns(where: str, patterns, errors: List[str]):
+    if not isinstance(patterns, list) or not all(isinstance(p, str) for p in patterns):
+        errors.append(f"{where}: must be a list of strings")
+        return
+    for pattern in patterns:
+        try:
+            re.compile(pattern, re.IGNORECASE)
+        except re.error as e:
+            errors.append(f"{where}: invalid pattern {pattern!r}: {e}")
+
+
+def _check_senders(where: str, senders, errors: List[str]):
+    """Senders are plain substrings of the From header, not regexes"""
+    if not isinstance(senders, list) or not all(isinstance(s, str) and s.strip() for s in senders):
+        errors.append(f"{where}: must be a list of non-empty strings")
+
+
+def validate_template(template, where: str) -> List[str]:
+    """Schema check for one template dict; returns a list of problems"""
+    if not isinstance(template, dict):
+        return [f"{where}: template must be a mapping"]
+    errors = []
+    name = template.get('name')
+    if not isinstance(name, str) or not name.strip():
+        errors.append(f"{where}: 'name' is required")
+    else:
+        where = f"{where} ({name})"
+    unknown = set(template) - _KNOWN_KEYS
+    if unknown:
+        errors.append(f"{where}: unknown keys {sorted(unknown)}")
+    if 'enabled' in template and not isinstance(template['enabled'], bool):
+        errors.append(f"{where}: 'enabled' must be true or false")
+    if template.get('enabled') is False:
+        return errors
+    _check_senders(f"{where} senders", template.get('senders', []), errors)
+    _check_patterns(f"{where} body_patterns", template.get('body_patterns', []), errors)
+    if not template.get('senders') and not template.get('body_patterns'):
+        errors.append(f"{where}: needs at least one sender or body pattern")
+    if not isinstance(template.get('account_bank_tag', ''), str):
+        errors.append(f"{where}: 'account_bank_tag' must be a string")
+    fields = template.get('fields', {})
+    if not isinstance(fields, dict):
+        errors.append(f"{where}: 'fields' must map field names to pattern lists")
+    else:
+        for field, patterns in fields.items():
+            _check_patterns(f"{where} fields.{field}", patterns, errors)
+    return errors
+
+
+def load_template_file(path: str) -> List[Dict]:
+    """Read one file holding a template, a list of them, or {"templates": [...]}"""
+    with open(path, encoding='utf-8') as f:
+        if path.endswith('.json'):
+            data = json.load(f)
+        elif yaml is None:
+            raise TemplateValidationError([f"{path}: PyYAML is not installed, use JSON or pip install pyyaml"])
+        else:
+            data = yaml.safe_load(f)
+    if isinstance(data, dict) and 'templates' in data:
+        data = data['templates']
+    if isinstance(data, dict):
+        data = [data]
+    if not isinstance(data, list):
+        raise TemplateValidationError([f"{path}: expected a template or a list of templates"])
+    return data
+
+
+def load_templates(directory: str, builtin: Optional[List[Dict]] = None) -> List[Dict]:
+    """Merge template files in ``directory`` over the built-in set.
+
+    A file template replaces the built-in one with the same name, keeping
+    its position; new names are appended in file-name order, and
+    ``enabled: false`` removes a template. Raises TemplateValidationError
+    listing every problem found, leaving nothing half-loaded.
+    """
+    merged = {t['name']: t for t in copy.deepcopy(builtin if builtin is not None else BUILTIN_TEMPLATES)}
+    errors = []
+    seen = {}
+    for name in sorted(os.listdir(directory)) if os.path.isdir(directory) else []:
+        if not name.endswith(TEMPLATE_EXTENSIONS):
+            continue
+        path = os.path.join(directory, name)
+        try:
+            templates = load_template_file(path)
+        except TemplateValidationError as e:
+            errors.extend(e.errors)
+            continue
+        except Exception as e:  # OSError, JSON and YAML syntax errors
+            errors.append(f"{path}: {e}")
+            continue
+        for i, template in enumerate(templates):
+            problems = validate_template(template, f"{name}[{i}]")
+            if problems:
+                errors.extend(problems)
+                continue
+            if template['name'] in seen:
+                errors.append(f"{name}[{i}]: template {template['name']!r} is also defined in {seen[template['name']]}")
+                continue
+            seen[template['name']] = name
+            if template.get('enabled') is False:
+                merged.pop(template['name'], None)
+            else:
+                merged[template['name']] = {k: v for k, v in template.items() if k != 'enabled'}
+    if errors:
+        raise TemplateValidationError(errors)
+    return list(merged.values())
+
+
+class TemplateRegistry:
+    """Loads templates from a directory and publishes them to email_parser.
+
+    ``reload()`` validates every file first and only then swaps the compiled
+    set in, so a bad edit keeps the previous templates running. ``watch()``
+    polls file modification times and reloads on change.
+    """
+
+    def __init__(self, directory: str = DEFAULT_TEMPLATES_DIR, poll_interval: float = 5.0):
+        self.directory = directory
+        self.poll_interval = poll_interval
+        self.last_error: List[str] = []
+        self._signature = None
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def reload(self, force: bool = False) -> Tuple[Optional[CompiledTemplates], List[str]]:
+        """Reload if files changed (or always with ``force``).
+
+        Returns (compiled set or None if nothing was swapped, errors).
+        """
+        with self._lock:
+            signature = self._files_signature()
+            if not force and signature == self._signature:
+                return None, []
+            try:
+                templates = load_templates(self.directory)
+            except TemplateValidationError as e:
+                self._signature = signature
+                self.last_error = e.errors
+                logger.error(f"Template reload rejected, keeping version "
+                             f"{email_parser.get_compiled_templates().version}: {e}")
+                return None, e.errors
+            self._signature = signature
+            self.last_error = []
+            compiled = reload_templates(templates)
+            logger.info(f"Loaded {len(templates)} templates, version {compiled.version} "
+                        f"(revision {compiled.revision})")
+            return compiled, []
+
+    def watch(self):
+        """Start a daemon thread that reloads when template files change"""
+        if self._thread is not None:
+            return
+        self._thread = threading.Thread(target=self._watch_loop, name='template-watch', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def status(self) -> Dict:
+        compiled = email_parser.get_compiled_templates()
+        return {
+            'version': compiled.version,
+            'revision': compiled.revision,
+            'directory': self.directory,
+            'templates': [t['name'] for t in compiled.templates],
+            'errors': self.last_error,
+        }
+
+    def _watch_loop(self):
+        while not self._stop.wait(self.poll_interval):
+            try:
+                self.reload()
+            except Exception as e:
+                logger.error(f"Template watch error: {e}")
+
+    def _files_signature(self) -> Tuple:
+        if not os.path.isdir(self.directory):
+            return ()
+        signature = []
+        for name in sorted(os.listdir(self.directory)):
+            if name.endswith(TEMPLATE_EXTENSIONS):
+                stat = os.stat(os.path.join(self.directory, name))
+                signature.append((name, stat.st_mtime_ns, stat.st_size))
+        return tuple(signature)
+
+
+def main(argv: List[str] = None) -> int:
+    parser = argparse.ArgumentParser(description='Validate or export bank template files')
+    parser.add_argument('directory', nargs='?', default=DEFAULT_TEMPLATES_DIR)
+    parser.add_argument('--export', action='store_true',
+                        help='write the built-in templates into the directory as JSON files to edit')
+    args = parser.parse_args(argv)
+
+    if args.export:
+        os.makedirs(args.directory, exist_ok=True)
+        for template in BUILTIN_TEMPLATES:
+            path = os.path.join(args.directory, f"{template['name'].lower()}.json")
+            with open(path, 'w', encoding='utf-8') as f:
+                json.dump(template, f, indent=2)
+            print(f"wrote {path}")
+        return 0
+
+    try:
+        templates = load_templates(args.directory)
+    except TemplateValidationError as e:
+        for error in e.errors:
+            print(f"ERROR {error}")
+        return 1
+    print(f"{len(templates)} templates OK, version {CompiledTemplates(templates).version}")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
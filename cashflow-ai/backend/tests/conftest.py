@@ -0,0 +1,29 @@
+"""
+Shared setup: the backend modules on sys.path and api_server settings that
+keep test runs off the real databases and the network
+"""
+
+import os
+import sys
+import tempfile
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# api_server reads its settings at import
+_STATE_DIR = tempfile.mkdtemp(prefix='cashflow-test-')
+os.environ['SYNC_STATE_DB'] = os.path.join(_STATE_DIR, 'sync_state.db')
+os.environ['PARSE_CACHE_DISK'] = '0'
+os.environ['PARSE_WORKERS'] = '0'
+os.environ['TEMPLATES_POLL_SECONDS'] = '0'
+os.environ['IMAP_ALLOW_PLAINTEXT'] = '1'
+
+
+@pytest.fixture(scope='session')
+def client():
+    import api_server
+    import email_parser
+    email_parser.IMAP_ALLOW_PLAINTEXT = True
+    yield api_server.app.test_client()
+    api_server.imap_pool.close_all()
@@ -0,0 +1,83 @@
+"""
+Account ownership: a login to another IMAP server must not take over an
+address's stored transactions
+"""
+
+import pytest
+
+from fake_imap import FakeIMAPServer
+from storage import AccountConflict, TransactionStore
+
+VICTIM = 'victim@cashflow.test'
+
+
+@pytest.fixture(scope='module')
+def servers():
+    real = FakeIMAPServer(messages=40, password='good', keep_unseen=True).start()
+    rogue = FakeIMAPServer(messages=5, seed=1).start()  # accepts any password
+    yield real, rogue
+    real.stop()
+    rogue.stop()
+
+
+def _transactions(client, password):
+    return client.get('/api/transactions', headers={'X-Email-Address': VICTIM, 'X-App-Password': password})
+
+
+@pytest.mark.parametrize('stream', [False, True])
+def test_sync_against_another_server_cannot_take_over(servers, client, stream):
+    real, rogue = servers
+    owner = client.post('/api/sync', json={'imap_server': real.address, 'email_address': VICTIM,
+                                           'app_password': 'good'})
+    assert owner.status_code == 200
+    stored = _transactions(client, 'good').get_json()['count']
+    assert stored == owner.get_json()['count'] > 0
+
+    attack = client.post('/api/sync', json={'imap_server': rogue.address, 'email_address': VICTIM,
+                                            'app_password': 'evil', 'stream': stream})
+    assert attack.status_code == 409
+    assert _transactions(client, 'evil').status_code == 401
+    assert _transactions(client, 'good').get_json()['count'] == stored
+
+
+def test_watch_against_another_server_cannot_take_over(servers, client):
+    real, rogue = servers
+    assert client.post('/api/sync', json={'imap_server': real.address, 'email_address': VICTIM,
+                                          'app_password': 'good'}).status_code == 200
+    attack = client.post('/api/watch', json={'imap_server': rogue.address, 'email_address': VICTIM,
+                                             'app_password': 'evil'})
+    assert attack.status_code == 409
+    assert client.get('/api/events', headers={'X-Email-Address': VICTIM,
+                                              'X-App-Password': 'evil'}).status_code == 401
+
+
+def test_streamed_sync_without_transactions_registers(servers, client):
+    real, _ = servers
+    account = 'empty@cashflow.test'
+    mailbox = real.mailbox(account)
+    mailbox.messages, mailbox.uids = [], []
+    response = client.post('/api/sync', json={'imap_server': real.address, 'email_address': account,
+                                              'app_password': 'good', 'stream': True})
+    assert response.status_code == 200
+    assert response.get_data().splitlines()[-1].startswith(b'{"success": true, "count": 0')
+    assert client.get('/api/transactions', headers={'X-Email-Address': account,
+                                                    'X-App-Password': 'good'}).status_code == 200
+
+
+def test_streamed_sync_login_failure_is_401(servers, client):
+    real, _ = servers
+    response = client.post('/api/sync', json={'imap_server': real.address, 'email_address': VICTIM,
+                                              'app_password': 'wrong', 'stream': True})
+    assert response.status_code == 401
+
+
+def test_register_keeps_the_first_server(tmp_path):
+    store = TransactionStore(str(tmp_path / 'store.db'))
+    store.register(VICTIM, 'imap.example.com', 'one')
+    # The same server may rotate the credential
+    store.register(VICTIM.upper(), 'IMAP.example.com', 'two')
+    assert store.verify(VICTIM, 'two')
+    with pytest.raises(AccountConflict):
+        store.register(VICTIM, 'imap.rogue.test', 'evil')
+    assert store.verify(VICTIM, 'two') and not store.verify(VICTIM, 'evil')
+    store.close()
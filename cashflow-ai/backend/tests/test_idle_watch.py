@@ -0,0 +1,26 @@
+"""
+IDLE watchers stop on a refused login instead of retrying it
+"""
+
+import email_parser
+from fake_imap import FakeIMAPServer
+from idle_watch import EventBroker, IdleWatcher
+
+
+def test_refused_login_fails_and_publishes_error(monkeypatch):
+    monkeypatch.setattr(email_parser, 'IMAP_ALLOW_PLAINTEXT', True)
+    server = FakeIMAPServer(messages=5, password='good').start()
+    broker = EventBroker()
+    subscription = broker.subscribe('idle@cashflow.test')
+    watcher = IdleWatcher(server.address, 'idle@cashflow.test', 'wrong', broker=broker)
+    try:
+        watcher.start()
+        watcher.join(timeout=10)
+        assert not watcher._thread.is_alive()
+        assert watcher.state == 'failed'
+        event, data = subscription.get(timeout=1)
+        assert event == 'error' and data['folder'] == 'INBOX' and data['error'] == watcher.error
+        assert server.stats.get('logins', 0) == 0
+    finally:
+        watcher.stop()
+        server.stop()
@@ -0,0 +1,54 @@
+"""
+/api/sync reports the transactions whose messages could not be flagged as read
+"""
+
+import json
+
+import pytest
+
+import email_parser
+from fake_imap import FakeIMAPServer
+
+
+@pytest.fixture
+def server():
+    server = FakeIMAPServer(messages=30, password='good').start()
+    yield server
+    server.stop()
+
+
+@pytest.fixture
+def refuse_store(monkeypatch):
+    """Make STORE fail for every range that includes one of the given IDs"""
+    refused = set()
+    store_seen = email_parser.EmailParser._store_seen
+
+    def _store_seen(self, id_set, use_uid):
+        ids = {i for id_range in id_set.split(',') for i in email_parser._expand_id_range(id_range)}
+        return not (ids & refused) and store_seen(self, id_set, use_uid)
+
+    monkeypatch.setattr(email_parser.EmailParser, '_store_seen', _store_seen)
+    return refused
+
+
+@pytest.mark.parametrize('stream', [False, True])
+def test_sync_reports_unmarked_messages(server, client, refuse_store, stream):
+    account = f"unmarked-{int(stream)}@cashflow.test"  # each fake server is a different IMAP server
+    refuse_store.update({'3', '4', '5'})
+    response = client.post('/api/sync', json={'imap_server': server.address, 'email_address': account,
+                                              'app_password': 'good', 'batch_size': 10, 'stream': stream})
+    assert response.status_code == 200
+    if stream:
+        lines = [json.loads(line) for line in response.get_data().splitlines()]
+        transactions, summary = lines[:-1], lines[-1]
+    else:
+        summary = response.get_json()
+        transactions = summary['transactions']
+    email_ids = {tx['email_id'] for tx in transactions}
+    # A refused STORE range leaves every message in it unread
+    assert email_ids & refuse_store <= set(summary['unmarked']) <= email_ids
+
+    # Only the unmarked messages are still unread
+    again = client.post('/api/sync', json={'imap_server': server.address, 'email_address': account,
+                                           'app_password': 'good'}).get_json()
+    assert sorted(tx['email_id'] for tx in again['transactions']) == sorted(summary['unmarked'])
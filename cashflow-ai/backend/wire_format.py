@@ -0,0 +1,201 @@
+#!/usr/bin/env python3
+"""
+Response encoding for CashFlow AI
+Trims transaction lists to the requested fields and encodes them as JSON,
+columnar JSON or MessagePack, compressed with gzip or brotli when the
+client accepts it
+"""
+
+import gzip
+import json
+import zlib
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+
+from email_parser import TRANSACTION_FIELDS
+
+try:
+    import msgpack
+except ImportError:  # optional dependency
+    msgpack = None
+
+try:
+    import brotli
+except ImportError:  # optional dependency
+    brotli = None
+
+# Debug fields: the full SMS body and the full decoded email source
+DEBUG_FIELDS = ('notes', 'raw_email')
+DEFAULT_FIELDS = tuple(name for name in TRANSACTION_FIELDS if name not in DEBUG_FIELDS)
+FIELD_GROUPS = {'all': TRANSACTION_FIELDS, 'default': DEFAULT_FIELDS}
+
+FORMATS = ('json', 'columnar', 'msgpack')
+MSGPACK_TYPES = ('application/msgpack', 'application/x-msgpack')
+
+# Bodies smaller than this are sent uncompressed
+MIN_COMPRESS_BYTES = 1024
+GZIP_LEVEL = 6
+BROTLI_QUALITY = 5
+
+
+def parse_fields(spec) -> Tuple[str, ...]:
+    """Fields named by ``spec``: a comma list or list of field names and the
+    groups ``default`` and ``all``, e.g. ``default,notes``. Empty means
+    ``default``; unknown names raise ValueError.
+    """
+    if spec is None or spec == '':
+        return DEFAULT_FIELDS
+    names = spec if isinstance(spec, (list, tuple)) else str(spec).split(',')
+    chosen = set()
+    for name in names:
+        name = str(name).strip()
+        if not name:
+            continue
+        group = FIELD_GROUPS.get(name, (name,))
+        unknown = [f for f in group if f not in TRANSACTION_FIELDS]
+        if unknown:
+            raise ValueError(f"Unknown field {unknown[0]!r}, expected names from "
+                             f"{', '.join(TRANSACTION_FIELDS)} or the groups default, all")
+        chosen.update(group)
+    if not chosen:
+        return DEFAULT_FIELDS
+    return tuple(name for name in TRANSACTION_FIELDS if name in chosen)
+
+
+def project(transactions: Iterable[Optional[Dict]], names: Tuple[str, ...]) -> List[Optional[Dict]]:
+    """Copies of ``transactions`` holding only ``names``; None entries stay None"""
+    return [None if tx is None else {name: tx.get(name) for name in names} for tx in transactions]
+
+
+def columnar(transactions: List[Optional[Dict]], names: Tuple[str, ...]) -> Dict:
+    """One array per field; a None entry is null in every column"""
+    return {
+        'fields': list(names),
+        'columns': {name: [None if tx is None else tx.get(name) for tx in transactions] for name in names},
+    }
+
+
+def _accepted(header: Optional[str]) -> Dict[str, float]:
+    """{token: q} from an Accept or Accept-Encoding header"""
+    accepted = {}
+    for item in (header or '').split(','):
+        token, *params = item.split(';')
+        token = token.strip().lower()
+        if not token:
+            continue
+        q = 1.0
+        for param in params:
+            name, _, value = param.partition('=')
+            if name.strip().lower() == 'q':
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        accepted[token] = q
+    return accepted
+
+
+def negotiate_format(requested: Optional[str], accept: Optional[str]) -> str:
+    """``requested`` if given (ValueError if unknown or unavailable), else
+    MessagePack when the Accept header asks for it and msgpack is installed
+    """
+    if requested:
+        if requested not in FORMATS:
+            raise ValueError(f"format must be one of {', '.join(FORMATS)}")
+        if requested == 'msgpack' and msgpack is None:
+            raise ValueError('MessagePack is not available on this server')
+        return requested
+    accepted = _accepted(accept)
+    if msgpack is not None and any(accepted.get(t, 0) > 0 for t in MSGPACK_TYPES):
+        return 'msgpack'
+    return 'json'
+
+
+def negotiate_encoding(accept_encoding: Optional[str]) -> Optional[str]:
+    """'br' or 'gzip' per the Accept-Encoding header, preferring brotli when installed"""
+    accepted = _accepted(accept_encoding)
+    candidates = (['br'] if brotli is not None else []) + ['gzip']
+    ranked = [(accepted.get(c, accepted.get('*', 0)), -i, c) for i, c in enumerate(candidates)]
+    q, _, best = max(ranked)
+    return best if q > 0 else None
+
+
+def compress(body: bytes, encoding: Optional[str]) -> bytes:
+    if encoding == 'br':
+        return brotli.compress(body, quality=BROTLI_QUALITY)
+    if encoding == 'gzip':
+        return gzip.compress(body, compresslevel=GZIP_LEVEL)
+    return body
+
+
+class StreamCompressor:
+    """Incremental gzip or brotli, flushed after every chunk so each NDJSON
+    line reaches the client as soon as it is written
+    """
+
+    def __init__(self, encoding: str):
+        self.encoding = encoding
+        if encoding == 'br':
+            self._compressor = brotli.Compressor(quality=BROTLI_QUALITY)
+        else:
+            self._compressor = zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+
+    def chunk(self, data: bytes) -> bytes:
+        if self.encoding == 'br':
+            return self._compressor.process(data) + self._compressor.flush()
+        return self._compressor.compress(data) + self._compressor.flush(zlib.Z_SYNC_FLUSH)
+
+    def finish(self) -> bytes:
+        return self._compressor.finish() if self.encoding == 'br' else self._compressor.flush()
+
+
+class WireOptions:
+    """Field projection, body format and compression chosen for one response"""
+
+    def __init__(self, names: Tuple[str, ...] = DEFAULT_FIELDS, fmt: str = 'json',
+                 encoding: Optional[str] = None):
+        self.names = names
+        self.format = fmt
+        self.encoding = encoding
+
+    @classmethod
+    def negotiate(cls, fields_spec=None, fmt: Optional[str] = None, accept: Optional[str] = None,
+                  accept_encoding: Optional[str] = None) -> 'WireOptions':
+        """Options from request parameters and headers; ValueError on bad parameters"""
+        return cls(parse_fields(fields_spec), negotiate_format(fmt, accept), negotiate_encoding(accept_encoding))
+
+    def shape(self, payload: Dict, key: str = 'transactions') -> Dict:
+        """Copy of ``payload`` with its ``key`` list projected (and made columnar)"""
+        if key not in payload:
+            return payload
+        transactions = payload[key]
+        shaped = columnar(transactions, self.names) if self.format == 'columnar' else project(transactions, self.names)
+        return dict(payload, **{key: shaped})
+
+    def encode(self, payload: Dict, key: str = 'transactions') -> Tuple[bytes, Dict[str, str]]:
+        """(body, headers) for ``payload`` with its ``key`` list shaped"""
+        payload = self.shape(payload, key)
+        if self.format == 'msgpack':
+            body = msgpack.packb(payload, use_bin_type=True)
+            content_type = 'application/msgpack'
+        else:
+            # Raw UTF-8 keeps Amharic text at 3 bytes a character rather than 6
+            body = json.dumps(payload, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+            content_type = 'application/json'
+        headers = {'Content-Type': content_type, 'Vary': 'Accept, Accept-Encoding'}
+        if self.encoding and len(body) >= MIN_COMPRESS_BYTES:
+            body = compress(body, self.encoding)
+            headers['Content-Encoding'] = self.encoding
+        return body, headers
+
+    def transaction(self, tx: Dict) -> Dict:
+        return {name: tx.get(name) for name in self.names}
+
+    def stream(self, chunks: Iterable[bytes]) -> Iterator[bytes]:
+        """Compress a streamed body chunk by chunk, if compression was negotiated"""
+        if not self.encoding:
+            yield from chunks
+            return
+        compressor = StreamCompressor(self.encoding)
+        for data in chunks:
+            yield compressor.chunk(data)
+        yield compressor.finish()
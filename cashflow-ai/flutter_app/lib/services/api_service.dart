@@ -18,6 +18,8 @@ class ApiService {
           'imap_server': imapServer,
           'email_address': emailAddress,
           'app_password': appPassword,
+          // Notes are shown in the app; raw_email is left out
+          'fields': 'default,notes',
         }),
       );
 